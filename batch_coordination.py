@@ -0,0 +1,288 @@
+import os
+import json
+import time
+import socket
+import hashlib
+import threading
+from datetime import datetime
+
+
+def parse_shard(shard):
+    """
+    Parses a shard specification of the form 'i/n', where n is the number of shards and i the zero-based index of the
+    shard, e.g. the index of an array job.
+
+    :param shard: shard specification 'i/n' (string)
+    :return: index of the shard (int), number of shards (int)
+    """
+    # split specification into index and number of shards
+    try:
+        shard_index, n_shards = (int(v) for v in shard.split('/'))
+    except ValueError:
+        raise ValueError(f'Invalid shard "{shard}", use "i/n" with the shard index i and the number of shards n!')
+    # check if the index is in the range of the shards
+    if not 0 <= shard_index < n_shards:
+        raise ValueError(f'Invalid shard "{shard}", the index must be in the range 0 to {n_shards - 1}!')
+    # return index and number of shards
+    return shard_index, n_shards
+
+
+def select_shard_jobs(conversion_jobs, shard_index, n_shards, input_directory):
+    """
+    Returns the conversion jobs of a shard. The jobs are sorted by the path of their input file relative to the input
+    directory and assigned to the shards round-robin, so the partition does not depend on the mount point of a shared
+    filesystem or on the order of the jobs, the shards differ in size by at most one job and all shards together cover
+    every job exactly once.
+
+    :param conversion_jobs: list of (path_to_input_file, path_to_output_file) tuples (list)
+    :param shard_index: index of the shard (int)
+    :param n_shards: number of shards (int)
+    :param input_directory: directory the input paths are taken relative to (string)
+    :return: conversion jobs of the shard (list)
+    """
+    # sort jobs by the relative path of their input file, which is the same on every node
+    sorted_jobs = sorted(conversion_jobs, key=lambda job: get_relative_input_path(job[0], input_directory))
+    # return every n-th job starting at the shard index
+    return sorted_jobs[shard_index::n_shards]
+
+
+def get_relative_input_path(path_to_input_file, input_directory=None):
+    """
+    Returns the path of an input file relative to the input directory with '/' as separator. Unlike the absolute path,
+    it is the same on all nodes, even if they mount the shared filesystem at different paths.
+
+    :param path_to_input_file: path to the input file (string)
+    :param input_directory: directory the path is taken relative to, if None the absolute path is returned (string)
+    :return: relative path of the input file (string)
+    """
+    # return absolute path if there is no input directory
+    if input_directory is None:
+        return os.path.abspath(path_to_input_file).replace(os.sep, '/')
+    # return path relative to the input directory
+    return os.path.relpath(os.path.abspath(path_to_input_file), os.path.abspath(input_directory)).replace(os.sep, '/')
+
+
+def get_worker_id():
+    """
+    Returns the id of the current worker process, consisting of host name and process id.
+
+    :return: worker id (string)
+    """
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def get_status_path(path_to_status_directory, path_to_input_file, extension='.json', input_directory=None):
+    """
+    Returns the path of the status or claim file of an input file. The name is built from the file name and a hash of
+    the path relative to the input directory, so files with the same name in different directories do not collide and
+    workers that mount the shared filesystem at different paths use the same status and claim files.
+
+    :param path_to_status_directory: path to the shared status directory (string)
+    :param path_to_input_file: path to the input file (string)
+    :param extension: '.json' for the status file or '.claim' for the claim file (string)
+    :param input_directory: directory the path is taken relative to, if None the absolute path is used (string)
+    :return: path of the status or claim file (string)
+    """
+    # get hash of the relative path
+    path_hash = hashlib.sha1(get_relative_input_path(path_to_input_file, input_directory).encode()).hexdigest()[:16]
+    # return path in the status directory
+    return os.path.join(path_to_status_directory, f'{os.path.basename(path_to_input_file)}-{path_hash}{extension}')
+
+
+def read_conversion_status(path_to_status_directory, path_to_input_file, input_directory=None):
+    """
+    Reads the status of an input file from the shared status directory. The status holds the state of the conversion
+    ('running', 'done' or 'failed'), the worker, the time and, like a manifest entry, the fingerprint of the input file,
+    the conversion options and the written output files.
+
+    :param path_to_status_directory: path to the shared status directory (string)
+    :param path_to_input_file: path to the input file (string)
+    :param input_directory: directory the input paths are taken relative to, if None absolute paths are used (string)
+    :return: status of the input file, None if the file has no status yet (dict)
+    """
+    # get path of the status file
+    path_to_status_file = get_status_path(path_to_status_directory, path_to_input_file, '.json', input_directory)
+    # return None if there is no status yet
+    if not os.path.exists(path_to_status_file):
+        return None
+    # read status
+    with open(path_to_status_file, 'r') as f:
+        return json.load(f)
+
+
+def write_conversion_status(path_to_status_directory, path_to_input_file, status, input_directory=None):
+    """
+    Writes the status of an input file atomically into the shared status directory. The temporary file is unique for
+    each worker, so workers on different nodes never write into the same file.
+
+    :param path_to_status_directory: path to the shared status directory (string)
+    :param path_to_input_file: path to the input file (string)
+    :param status: status of the input file, the relative input path, the worker and the time are added (dict)
+    :param input_directory: directory the input paths are taken relative to, if None absolute paths are used (string)
+    """
+    # get path of the status file and of a temporary file of this worker
+    path_to_status_file = get_status_path(path_to_status_directory, path_to_input_file, '.json', input_directory)
+    path_to_temporary_file = f'{path_to_status_file}.{get_worker_id().replace(":", ".")}.tmp'
+    # write status together with worker and time to the temporary file
+    with open(path_to_temporary_file, 'w') as f:
+        json.dump({**status, 'input': get_relative_input_path(path_to_input_file, input_directory),
+                   'worker': get_worker_id(),
+                   'time': datetime.now().isoformat()}, f, indent=4)
+    # atomically replace the old status
+    os.replace(path_to_temporary_file, path_to_status_file)
+
+
+def claim_conversion(path_to_status_directory, path_to_input_file, claim_timeout=None, input_directory=None):
+    """
+    Atomically claims the conversion of an input file for the current worker. The claim is a file that is created with
+    O_CREAT | O_EXCL, which fails if it already exists, so of several workers on a shared filesystem exactly one gets
+    the claim. Claims that are older than claim_timeout are considered left behind by a crashed worker and are broken,
+    so running conversions must refresh their claims, see start_claim_heartbeat.
+
+    :param path_to_status_directory: path to the shared status directory (string)
+    :param path_to_input_file: path to the input file (string)
+    :param claim_timeout: age in seconds after which a claim is broken, if None claims are never broken (float)
+    :param input_directory: directory the input paths are taken relative to, if None absolute paths are used (string)
+    :return: True if the worker claimed the file (bool)
+    """
+    # get path of the claim file
+    path_to_claim_file = get_status_path(path_to_status_directory, path_to_input_file, '.claim', input_directory)
+    try:
+        # create claim file, fails if another worker holds the claim
+        fd = os.open(path_to_claim_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        # check if the claim may be broken
+        if claim_timeout is None or not break_stale_claim(path_to_claim_file, claim_timeout):
+            return False
+        # claim the file again, another worker may have been faster
+        return claim_conversion(path_to_status_directory, path_to_input_file, input_directory=input_directory)
+    # write worker and time into the claim file
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'worker': get_worker_id(), 'time': datetime.now().isoformat()}, f)
+    # return that the file was claimed
+    return True
+
+
+def break_stale_claim(path_to_claim_file, claim_timeout):
+    """
+    Removes a claim file that is older than claim_timeout. The claim is first renamed to a name that is unique for the
+    worker, only one of several workers can rename it. If the claim was renewed in the meantime by another worker, it is
+    restored.
+
+    :param path_to_claim_file: path to the claim file (string)
+    :param claim_timeout: age in seconds after which a claim is broken (float)
+    :return: True if the claim was removed (bool)
+    """
+    # get path the claim is moved to
+    path_to_stale_file = f'{path_to_claim_file}.{get_worker_id().replace(":", ".")}.stale'
+    try:
+        # check if the claim is old enough
+        if time.time() - os.path.getmtime(path_to_claim_file) < claim_timeout:
+            return False
+        # move claim out of the way, fails if another worker moved it first
+        os.rename(path_to_claim_file, path_to_stale_file)
+    except FileNotFoundError:
+        # the claim was released or broken by another worker in the meantime
+        return True
+    # check if a fresh claim was moved instead of the stale one
+    if time.time() - os.path.getmtime(path_to_stale_file) < claim_timeout:
+        try:
+            # restore the fresh claim, fails if the file was claimed again in the meantime
+            os.link(path_to_stale_file, path_to_claim_file)
+        except FileExistsError:
+            pass
+        os.remove(path_to_stale_file)
+        return False
+    # remove the stale claim
+    os.remove(path_to_stale_file)
+    return True
+
+
+def refresh_conversion_claim(path_to_status_directory, path_to_input_file, input_directory=None):
+    """
+    Refreshes the modification time of the claim of the current worker on an input file, so other workers do not
+    consider it stale while the conversion is running. Claims that were broken or taken over by another worker are left
+    untouched.
+
+    :param path_to_status_directory: path to the shared status directory (string)
+    :param path_to_input_file: path to the input file (string)
+    :param input_directory: directory the input paths are taken relative to, if None absolute paths are used (string)
+    :return: True if the claim was refreshed (bool)
+    """
+    # get path of the claim file
+    path_to_claim_file = get_status_path(path_to_status_directory, path_to_input_file, '.claim', input_directory)
+    try:
+        # check if the claim belongs to the current worker
+        if not is_own_claim(path_to_claim_file):
+            return False
+        # set modification time to now
+        os.utime(path_to_claim_file)
+    except (FileNotFoundError, ValueError):
+        # the claim was broken or is being written by another worker
+        return False
+    # return that the claim was refreshed
+    return True
+
+
+def start_claim_heartbeat(path_to_status_directory, held_claims, interval, input_directory=None):
+    """
+    Starts a background thread that refreshes the claims of the current worker every interval seconds while they are
+    held. The interval must be well below the claim timeout, so a running conversion is never considered stale no
+    matter how long it takes.
+
+    :param path_to_status_directory: path to the shared status directory (string)
+    :param held_claims: set of the input files the worker currently holds claims on, updated by the caller (set)
+    :param interval: time between two refreshes in seconds (float)
+    :param input_directory: directory the input paths are taken relative to, if None absolute paths are used (string)
+    :return: event that stops the heartbeat when it is set (threading.Event)
+    """
+    # initialize event for stopping the heartbeat
+    stop = threading.Event()
+
+    def refresh_claims():
+        # refresh all held claims until the heartbeat is stopped
+        while not stop.wait(interval):
+            for path_to_input_file in held_claims.copy():
+                refresh_conversion_claim(path_to_status_directory, path_to_input_file, input_directory)
+
+    # start the heartbeat thread
+    threading.Thread(target=refresh_claims, daemon=True).start()
+    # return stop event
+    return stop
+
+
+def is_own_claim(path_to_claim_file):
+    """
+    Checks if a claim file belongs to the current worker.
+
+    :param path_to_claim_file: path to the claim file (string)
+    :return: True if the claim was created by the current worker (bool)
+    """
+    # read worker of the claim
+    with open(path_to_claim_file, 'r') as f:
+        return json.load(f).get('worker') == get_worker_id()
+
+
+def release_conversion_claim(path_to_status_directory, path_to_input_file, input_directory=None):
+    """
+    Releases the claim of the current worker on an input file by removing the claim file. Claims of other workers are
+    left untouched, e.g. if the claim of the current worker was broken as stale and another worker claimed the file.
+
+    :param path_to_status_directory: path to the shared status directory (string)
+    :param path_to_input_file: path to the input file (string)
+    :param input_directory: directory the input paths are taken relative to, if None absolute paths are used (string)
+    :return: True if the claim was removed (bool)
+    """
+    # get path of the claim file
+    path_to_claim_file = get_status_path(path_to_status_directory, path_to_input_file, '.claim', input_directory)
+    try:
+        # check if the claim belongs to the current worker
+        if not is_own_claim(path_to_claim_file):
+            return False
+        # remove claim file
+        os.remove(path_to_claim_file)
+    except (FileNotFoundError, ValueError):
+        # the claim was broken or is being written by another worker
+        return False
+    # return that the claim was removed
+    return True
@@ -0,0 +1,4 @@
+"""
+Benchmark suite of the ims file converter. The synthetic_ims module writes Imaris ims files with the layout of real
+acquisitions, the run_benchmark module times the converter and the utils scripts on these files.
+"""
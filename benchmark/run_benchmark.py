@@ -0,0 +1,338 @@
+import argparse
+import contextlib
+import copy
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import statistics
+import sys
+import tempfile
+import time
+import numpy as np
+import h5py
+import tifffile as tif
+
+# make the converter and the utils scripts importable
+path_to_repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.extend([path_to_repository, os.path.join(path_to_repository, 'utils'), os.path.dirname(__file__)])
+from ims_to_ome_tiff_converter import read_image_from_ims_file, save_ome_tiff_file
+from instrumentation import get_peak_rss
+from synthetic_ims import write_synthetic_ims_file, DEFAULT_CHANNEL_NAMES
+
+# stages of the benchmark in the order they are run, each stage reads the output of the previous one
+BENCHMARK_STAGES = ['read_ims', 'save_ome_tiff', 'unify_channels', 'nnUNet_tif', 'nnUNet_nifti']
+
+
+def get_directory_size(path_to_directory):
+    """
+    Returns the total size of all files in the passed directory and its subdirectories.
+
+    :param path_to_directory: path to the directory (string)
+    :return: size in bytes (int)
+    """
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path_to_directory) for f in files)
+
+
+def run_read_ims(path_to_work_directory, options):
+    """
+    Benchmark stage that reads the synthetic ims file with read_image_from_ims_file.
+
+    :param path_to_work_directory: directory with the synthetic ims file (string)
+    :param options: benchmark options (dict)
+    :return: number of image bytes, bytes read and bytes written (tuple)
+    """
+    path_to_ims_file = os.path.join(path_to_work_directory, 'synthetic.ims')
+    # read image data
+    image_data_array, _ = read_image_from_ims_file(path_to_ims_file, options['backend'], options['threads'])
+    # return number of image bytes, bytes read and written
+    return image_data_array.nbytes, os.path.getsize(path_to_ims_file), 0
+
+
+def prepare_save_ome_tiff(path_to_work_directory, options):
+    """
+    Reads the image of the synthetic ims file for the save_ome_tiff stage, reading is not part of the measured times.
+
+    :param path_to_work_directory: directory with the synthetic ims file (string)
+    :param options: benchmark options (dict)
+    :return: image_data_array (numpy.ndarray), metadata_dict (dict)
+    """
+    return read_image_from_ims_file(os.path.join(path_to_work_directory, 'synthetic.ims'), options['backend'],
+                                    options['threads'])
+
+
+def run_save_ome_tiff(path_to_work_directory, options, prepared_data):
+    """
+    Benchmark stage that writes the image of the synthetic ims file with save_ome_tiff_file.
+
+    :param path_to_work_directory: directory with the synthetic ims file (string)
+    :param options: benchmark options (dict)
+    :param prepared_data: image data array and metadata returned by prepare_save_ome_tiff (tuple)
+    :return: number of image bytes, bytes read and bytes written (tuple)
+    """
+    image_data_array, metadata_dict = prepared_data
+    path_to_ome_tiff_file = os.path.join(path_to_work_directory, 'ome_tiff', 'synthetic.ome.tif')
+    # write OME TIFF file
+    os.makedirs(os.path.dirname(path_to_ome_tiff_file), exist_ok=True)
+    save_ome_tiff_file(image_data_array, metadata_dict, path_to_ome_tiff_file)
+    # return number of image bytes, bytes read and written
+    return image_data_array.nbytes, 0, os.path.getsize(path_to_ome_tiff_file)
+
+
+def run_unify_channels(path_to_work_directory, options):
+    """
+    Benchmark stage that unifies the channels of the written OME TIFF file, the same way as the main function of
+    ome_tiff_unify_channels.py (copy or read and write the channels of interest).
+
+    :param path_to_work_directory: directory with the outputs of the previous stages (string)
+    :param options: benchmark options (dict)
+    :return: number of image bytes, bytes read and bytes written (tuple)
+    """
+    from ome_tiff_unify_channels import write_unified_ome_tiff_file, channels_of_interest, labels_of_interest
+    path_to_ome_tiff_file = os.path.join(path_to_work_directory, 'ome_tiff', 'synthetic.ome.tif')
+    path_to_unified_file = os.path.join(path_to_work_directory, 'unified', 'synthetic_unified.ome.tif')
+    # write the unified channels, the pages are copied without decoding if possible
+    os.makedirs(os.path.dirname(path_to_unified_file), exist_ok=True)
+    image_bytes = write_unified_ome_tiff_file(path_to_ome_tiff_file, path_to_unified_file, channels_of_interest,
+                                              labels_of_interest)
+    # return number of image bytes, bytes read and written
+    return image_bytes, os.path.getsize(path_to_ome_tiff_file), os.path.getsize(path_to_unified_file)
+
+
+def run_nnUNet_exporter(path_to_work_directory, module_name):
+    """
+    Runs the ome_tiff_to_nnUNet function of the passed module on the unified OME TIFF file.
+
+    :param path_to_work_directory: directory with the outputs of the previous stages (string)
+    :param module_name: 'ome_tiff_to_nnUNet' or 'ome_tiff_to_nifti' (string)
+    :return: number of image bytes, bytes read and bytes written (tuple)
+    """
+    from ome_tiff_unify_channels import channels_of_interest
+    module = __import__(module_name)
+    path_to_unified_directory = os.path.join(path_to_work_directory, 'unified')
+    path_to_dataset_directory = os.path.join(path_to_work_directory, module_name)
+    # export unified file, the exporters modify the passed channels dict, so a copy is passed
+    module.ome_tiff_to_nnUNet(path_to_unified_directory, path_to_dataset_directory, 'Dataset001_Benchmark', 'BM',
+                              copy.deepcopy(channels_of_interest), 'label_sinusoids')
+    # get number of image bytes from the shape of the unified file
+    with tif.TiffFile(os.path.join(path_to_unified_directory, 'synthetic_unified.ome.tif')) as f:
+        image_bytes = int(np.prod(f.series[0].shape)) * f.series[0].dtype.itemsize
+    # return number of image bytes, bytes read and written
+    return image_bytes, get_directory_size(path_to_unified_directory), get_directory_size(path_to_dataset_directory)
+
+
+def run_nnUNet_tif(path_to_work_directory, options):
+    """
+    Benchmark stage of the nnUNet TIFF exporter (utils/ome_tiff_to_nnUNet.py).
+
+    :param path_to_work_directory: directory with the outputs of the previous stages (string)
+    :param options: benchmark options (dict)
+    :return: number of image bytes, bytes read and bytes written (tuple)
+    """
+    return run_nnUNet_exporter(path_to_work_directory, 'ome_tiff_to_nnUNet')
+
+
+def run_nnUNet_nifti(path_to_work_directory, options):
+    """
+    Benchmark stage of the nnUNet NIfTI exporter (utils/ome_tiff_to_nifti.py).
+
+    :param path_to_work_directory: directory with the outputs of the previous stages (string)
+    :param options: benchmark options (dict)
+    :return: number of image bytes, bytes read and bytes written (tuple)
+    """
+    return run_nnUNet_exporter(path_to_work_directory, 'ome_tiff_to_nifti')
+
+
+def run_stage_in_process(stage, path_to_work_directory, options, result_queue):
+    """
+    Runs a single benchmark stage and puts its measurements into the result queue. It is the target of a fresh process,
+    so the peak RSS is the one of this stage alone (including prepared input data). The output of the stage is
+    suppressed.
+
+    :param stage: name of the stage (string)
+    :param path_to_work_directory: directory with the synthetic ims file and the outputs of the stages (string)
+    :param options: benchmark options (dict)
+    :param result_queue: queue for the measurements (multiprocessing.Queue)
+    """
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            # prepare the input data of stages that should not be part of the measured times
+            prepare_function = globals().get(f'prepare_{stage}')
+            prepared_data = [prepare_function(path_to_work_directory, options)] if prepare_function else []
+            # start timers
+            start_time = time.perf_counter()
+            start_cpu_time = time.process_time()
+            # run stage without printing status messages
+            result = globals()[f'run_{stage}'](path_to_work_directory, options, *prepared_data)
+            # stop timers
+            wall_time = time.perf_counter() - start_time
+            cpu_time = time.process_time() - start_cpu_time
+        # put measurements into the queue
+        result_queue.put({'wall_time_s': wall_time,
+                          'cpu_time_s': cpu_time,
+                          'image_bytes': result[0],
+                          'bytes_read': result[1],
+                          'bytes_written': result[2],
+                          'peak_rss_mb': get_peak_rss()})
+    except Exception as e:
+        # pass error to the parent process
+        result_queue.put({'error': f'{type(e).__name__}: {e}'})
+
+
+def run_stage(stage, path_to_work_directory, options):
+    """
+    Runs a benchmark stage in a fresh process and returns its measurements.
+
+    :param stage: name of the stage (string)
+    :param path_to_work_directory: directory with the synthetic ims file and the outputs of the stages (string)
+    :param options: benchmark options (dict)
+    :return: measurements of the stage (dict)
+    """
+    # spawn a fresh interpreter, so no memory of previous stages is counted
+    context = multiprocessing.get_context('spawn')
+    result_queue = context.Queue()
+    process = context.Process(target=run_stage_in_process, args=(stage, path_to_work_directory, options, result_queue))
+    process.start()
+    # wait for the measurements, a process that was killed (e.g. out of memory) never sends them
+    while True:
+        try:
+            result = result_queue.get(timeout=1)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                raise RuntimeError(f'Benchmark stage {stage} exited with code {process.exitcode}')
+    process.join()
+    # raise errors of the stage
+    if 'error' in result:
+        raise RuntimeError(f'Benchmark stage {stage} failed: {result["error"]}')
+    # return measurements
+    return result
+
+
+def summarize_stage_runs(runs):
+    """
+    Summarizes the measurements of the repeated runs of a stage. Throughput is given as uncompressed image megabytes
+    per second of the median wall time.
+
+    :param runs: list of measurements of the single runs (list of dicts)
+    :return: summary of the stage (dict)
+    """
+    # get median and minimum wall time
+    wall_times = [run['wall_time_s'] for run in runs]
+    median_wall_time = statistics.median(wall_times)
+    # return summary
+    return {'wall_time_s_median': median_wall_time,
+            'wall_time_s_min': min(wall_times),
+            'cpu_time_s_median': statistics.median(run['cpu_time_s'] for run in runs),
+            'throughput_mb_s': runs[0]['image_bytes'] / 1024 ** 2 / median_wall_time,
+            'image_mb': runs[0]['image_bytes'] / 1024 ** 2,
+            'read_mb': runs[0]['bytes_read'] / 1024 ** 2,
+            'written_mb': runs[0]['bytes_written'] / 1024 ** 2,
+            'peak_rss_mb': max(run['peak_rss_mb'] for run in runs),
+            'runs': runs}
+
+
+def run_benchmark(path_to_work_directory, synthetic_options, options, stages=BENCHMARK_STAGES, repeats=3):
+    """
+    Writes a synthetic ims file and runs the benchmark stages on it. Every stage runs repeats times in a fresh process.
+    The report contains the versions of the libraries and the options, so results of different machines and commits
+    can be compared.
+
+    :param path_to_work_directory: directory for the synthetic ims file and the outputs of the stages (string)
+    :param synthetic_options: keyword arguments of write_synthetic_ims_file (dict)
+    :param options: benchmark options, 'backend' and 'threads' of the ims reader (dict)
+    :param stages: names of the stages that are run, stages need the outputs of the previous stages (list)
+    :param repeats: number of runs of each stage (int)
+    :return: benchmark report (dict)
+    """
+    # write synthetic ims file
+    path_to_ims_file = os.path.join(path_to_work_directory, 'synthetic.ims')
+    start_time = time.perf_counter()
+    write_synthetic_ims_file(path_to_ims_file, **synthetic_options)
+    print(f'Wrote synthetic ims file ({os.path.getsize(path_to_ims_file) / 1024 ** 2:.1f} MB) in '
+          f'{time.perf_counter() - start_time:.1f} s!')
+
+    # initialize report
+    report = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'environment': {'python': platform.python_version(),
+                              'platform': platform.platform(),
+                              'cpu_count': os.cpu_count(),
+                              'numpy': np.__version__,
+                              'h5py': h5py.__version__,
+                              'hdf5': h5py.version.hdf5_version,
+                              'tifffile': tif.__version__},
+              'synthetic_file': {**synthetic_options, 'file_mb': os.path.getsize(path_to_ims_file) / 1024 ** 2},
+              'options': {**options, 'repeats': repeats},
+              'stages': {}}
+    # iterate stages
+    for stage in stages:
+        # run stage repeatedly and summarize the runs
+        report['stages'][stage] = summarize_stage_runs([run_stage(stage, path_to_work_directory, options)
+                                                        for _ in range(repeats)])
+        # print status message
+        print(f'{stage}: {report["stages"][stage]["throughput_mb_s"]:.1f} MB/s, '
+              f'peak RSS {report["stages"][stage]["peak_rss_mb"]:.0f} MB')
+    # return report
+    return report
+
+
+def main():
+    """
+    Main function of the benchmark. Writes a synthetic ims file with the passed size, channels, data type, chunk shape
+    and gzip level, times reading, OME TIFF writing, channel unification and both nnUNet exporters on it and saves
+    throughput and peak memory of each stage as JSON report.
+    """
+    # create the parser object
+    parser = argparse.ArgumentParser(description='Benchmarks the converter and utils scripts on a synthetic ims file.')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Path of the JSON report, if not passed the report is printed')
+    parser.add_argument('-w', '--work_directory', default=None,
+                        help='Directory for the synthetic file and the outputs, a temporary directory if not passed. '
+                             'Pass a directory on the filesystem that should be benchmarked.')
+    parser.add_argument('--size', type=int, nargs=3, default=[64, 512, 512], metavar=('Z', 'Y', 'X'),
+                        help='Size of the synthetic image (default: 64 512 512)')
+    parser.add_argument('--channels', nargs='+', default=DEFAULT_CHANNEL_NAMES,
+                        help='Channel names of the synthetic image, names starting with "gt " are written as labels. '
+                             'The nnUNet stages need the default channels (default: '
+                             f'{" ".join(DEFAULT_CHANNEL_NAMES)})')
+    parser.add_argument('--dtype', choices=['uint8', 'uint16', 'float32'], default='uint16',
+                        help='Data type of the synthetic image (default: uint16)')
+    parser.add_argument('--chunks', type=int, nargs=3, default=[16, 128, 128], metavar=('Z', 'Y', 'X'),
+                        help='Chunk shape of the synthetic image (default: 16 128 128)')
+    parser.add_argument('--compression_level', type=int, default=2,
+                        help='Gzip level of the synthetic image, 0 disables compression (default: 2)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the synthetic image (default: 0)')
+    parser.add_argument('--stages', nargs='+', choices=BENCHMARK_STAGES, default=BENCHMARK_STAGES,
+                        help='Stages that are run, stages need the outputs of the previous ones (default: all)')
+    parser.add_argument('-r', '--repeats', type=int, default=3,
+                        help='Number of runs of each stage (default: 3)')
+    parser.add_argument('-b', '--backend', choices=['h5py', 'threaded'], default='h5py',
+                        help='Backend for reading the ims file (default: h5py)')
+    parser.add_argument('-t', '--threads', type=int, default=None,
+                        help='Number of threads of the threaded backend (default: number of CPUs)')
+    # parse the arguments
+    args = parser.parse_args()
+
+    # collect options of the synthetic file and the benchmark
+    synthetic_options = {'image_size': tuple(args.size), 'channel_names': args.channels, 'dtype': args.dtype,
+                         'chunk_shape': tuple(args.chunks), 'compression_level': args.compression_level,
+                         'seed': args.seed}
+    options = {'backend': args.backend, 'threads': args.threads}
+
+    # run benchmark in the passed or a temporary work directory
+    with tempfile.TemporaryDirectory(dir=args.work_directory) as path_to_work_directory:
+        report = run_benchmark(path_to_work_directory, synthetic_options, options, args.stages, args.repeats)
+
+    # save or print report
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(f'Saved benchmark report at {args.output}!')
+    else:
+        print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+import argparse
+import datetime
+import numpy as np
+import h5py
+
+
+# default channel names, they match the channels and labels of interest of utils/ome_tiff_unify_channels.py
+DEFAULT_CHANNEL_NAMES = ['DAPI', 'Endomucin', 'GT Sinusoids']
+
+
+def to_ims_attribute(value):
+    """
+    Converts a value to an Imaris attribute, which is an array of single characters.
+
+    :param value: value of the attribute
+    :return: attribute value (numpy.ndarray)
+    """
+    return np.frombuffer(str(value).encode('ascii'), dtype='S1')
+
+
+def get_resolution_level_sizes(image_size, n_levels):
+    """
+    Returns the image sizes (Z, Y, X) of the resolution levels, every level halves the size of the previous one.
+
+    :param image_size: size of the full resolution image (Z, Y, X) (tuple)
+    :param n_levels: number of resolution levels (int)
+    :return: list of level sizes (list of tuples)
+    """
+    return [tuple(max(1, s >> level) for s in image_size) for level in range(n_levels)]
+
+
+def generate_synthetic_slab(z_start, z_stop, level_size, image_size, channel_nr, is_label, dtype, rng):
+    """
+    Generates a Z-slab of a synthetic channel. The intensities are a smooth pattern of the full resolution coordinates
+    plus noise, so all resolution levels show the same structures and the data compresses like real acquisitions
+    instead of random noise. Labels are a binary mask of the same pattern.
+
+    :param z_start: first plane of the slab (int)
+    :param z_stop: plane after the last plane of the slab (int)
+    :param level_size: size of the resolution level (Z, Y, X) (tuple)
+    :param image_size: size of the full resolution image (Z, Y, X) (tuple)
+    :param channel_nr: number of the channel, shifts the pattern (int)
+    :param is_label: if True a binary label mask is generated (bool)
+    :param dtype: data type of the channel (numpy.dtype)
+    :param rng: random number generator for the noise (numpy.random.Generator)
+    :return: slab of shape (z_stop - z_start, Y, X) (numpy.ndarray)
+    """
+    # get full resolution coordinates of the voxels of the slab
+    z = np.arange(z_start, z_stop, dtype=np.float32)[:, None, None] * image_size[0] / level_size[0]
+    y = np.arange(level_size[1], dtype=np.float32)[None, :, None] * image_size[1] / level_size[1]
+    x = np.arange(level_size[2], dtype=np.float32)[None, None, :] * image_size[2] / level_size[2]
+    # create smooth pattern in the range [0, 1]
+    pattern = (np.sin(x / (17 + channel_nr)) * np.sin(y / 23) + np.sin(z / 11 + channel_nr) + 2) / 4
+    # check if a label mask should be generated
+    if is_label:
+        return (pattern > 0.6).astype(dtype)
+    # scale pattern to a fraction of the value range of the data type and add noise
+    max_value = np.iinfo(dtype).max // 16 if np.issubdtype(dtype, np.integer) else 1.0
+    slab = pattern * max_value + rng.normal(0, max_value / 50, pattern.shape)
+    # clip to the value range of the data type and return slab
+    return np.clip(slab, 0, max_value).astype(dtype)
+
+
+def write_synthetic_ims_file(path_to_ims_file,
+                             image_size=(64, 512, 512),
+                             channel_names=DEFAULT_CHANNEL_NAMES,
+                             dtype='uint16',
+                             chunk_shape=(16, 128, 128),
+                             compression_level=2,
+                             n_levels=3,
+                             n_time_points=1,
+                             voxel_size=(2.0, 0.5, 0.5),
+                             slab_size=16,
+                             seed=0,
+                             shuffle=False):
+    """
+    Writes a synthetic Imaris ims file with the DataSet/ResolutionLevel/TimePoint/Channel and DataSetInfo layout that
+    the converter reads. Like Imaris, the datasets are padded to a multiple of the chunk shape and gzip compressed.
+    Channels whose name starts with 'gt ' are written as binary labels. The file is written slab by slab, so files
+    larger than the available memory can be generated. The same seed always produces the same file content.
+
+    :param path_to_ims_file: path of the ims file that is written (string)
+    :param image_size: size of the full resolution image (Z, Y, X) (tuple)
+    :param channel_names: names of the channels (list)
+    :param dtype: data type of the channels (string)
+    :param chunk_shape: chunk shape of the datasets (Z, Y, X) (tuple)
+    :param compression_level: gzip level of the datasets, 0 disables compression (int)
+    :param n_levels: number of resolution levels (int)
+    :param n_time_points: number of time points (int)
+    :param voxel_size: voxel size in micron (Z, Y, X) (tuple)
+    :param slab_size: number of Z planes that are generated and written at once (int)
+    :param seed: seed of the random number generator (int)
+    :param shuffle: if True, the shuffle filter is applied before the gzip compression (bool)
+    """
+    # create random number generator
+    rng = np.random.default_rng(seed)
+    dtype = np.dtype(dtype)
+    # get sizes of the resolution levels
+    level_sizes = get_resolution_level_sizes(image_size, n_levels)
+
+    with h5py.File(path_to_ims_file, 'w') as f:
+        # write image attributes, Imaris stores the extent of the image in micron
+        image_attributes = f.create_group('DataSetInfo/Image').attrs
+        for i, (d, size, voxel) in enumerate(zip('ZYX', image_size, voxel_size)):
+            image_attributes[d] = to_ims_attribute(size)
+            image_attributes[f'ExtMin{2 - i}'] = to_ims_attribute(0.0)
+            image_attributes[f'ExtMax{2 - i}'] = to_ims_attribute(size * voxel)
+        image_attributes['Unit'] = to_ims_attribute('um')
+        # write time stamps of the time points, one every minute
+        time_attributes = f.create_group('DataSetInfo/TimeInfo').attrs
+        time_attributes['DatasetTimePoints'] = to_ims_attribute(n_time_points)
+        for t in range(n_time_points):
+            time_stamp = datetime.datetime(2024, 1, 1) + datetime.timedelta(minutes=t)
+            time_attributes[f'TimePoint{t + 1}'] = to_ims_attribute(time_stamp.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3])
+        # write channel names
+        for c, name in enumerate(channel_names):
+            f.create_group(f'DataSetInfo/Channel {c}').attrs['Name'] = to_ims_attribute(name)
+
+        # iterate resolution levels, time points and channels
+        for level, level_size in enumerate(level_sizes):
+            # pad level size to a multiple of the chunk shape
+            padded_size = tuple(-(-s // min(c, s)) * min(c, s) for s, c in zip(level_size, chunk_shape))
+            for t in range(n_time_points):
+                for c, name in enumerate(channel_names):
+                    # create channel group with the size attributes of the level
+                    channel_group = f.create_group(f'DataSet/ResolutionLevel {level}/TimePoint {t}/Channel {c}')
+                    for d, size in zip('ZYX', level_size):
+                        channel_group.attrs[f'ImageSize{d}'] = to_ims_attribute(size)
+                    # create padded and chunked dataset
+                    dataset = channel_group.create_dataset(
+                        'Data', shape=padded_size, dtype=dtype,
+                        chunks=tuple(min(c, s) for c, s in zip(chunk_shape, padded_size)),
+                        compression='gzip' if compression_level > 0 else None,
+                        compression_opts=compression_level if compression_level > 0 else None,
+                        shuffle=shuffle)
+                    # write channel slab by slab
+                    for z_start in range(0, level_size[0], slab_size):
+                        z_stop = min(z_start + slab_size, level_size[0])
+                        dataset[z_start:z_stop, :level_size[1], :level_size[2]] = generate_synthetic_slab(
+                            z_start, z_stop, level_size, image_size, c + t, name.lower().startswith('gt '), dtype,
+                            rng)
+
+
+def main():
+    """
+    Main function for writing a synthetic Imaris ims file.
+    """
+    # create the parser object
+    parser = argparse.ArgumentParser(description='Writes a synthetic Imaris ims file for benchmarking.')
+    parser.add_argument('-o', '--output', required=True,
+                        help='Path of the ims file that is written')
+    parser.add_argument('--size', type=int, nargs=3, default=[64, 512, 512], metavar=('Z', 'Y', 'X'),
+                        help='Size of the full resolution image (default: 64 512 512)')
+    parser.add_argument('--channels', nargs='+', default=DEFAULT_CHANNEL_NAMES,
+                        help='Channel names, names starting with "gt " are written as labels '
+                             f'(default: {" ".join(DEFAULT_CHANNEL_NAMES)})')
+    parser.add_argument('--dtype', choices=['uint8', 'uint16', 'float32'], default='uint16',
+                        help='Data type of the channels (default: uint16)')
+    parser.add_argument('--chunks', type=int, nargs=3, default=[16, 128, 128], metavar=('Z', 'Y', 'X'),
+                        help='Chunk shape of the datasets (default: 16 128 128)')
+    parser.add_argument('--compression_level', type=int, default=2,
+                        help='Gzip level of the datasets, 0 disables compression (default: 2)')
+    parser.add_argument('--levels', type=int, default=3,
+                        help='Number of resolution levels (default: 3)')
+    parser.add_argument('--time_points', type=int, default=1,
+                        help='Number of time points (default: 1)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the random number generator (default: 0)')
+    parser.add_argument('--shuffle', action='store_true',
+                        help='Apply the shuffle filter before the gzip compression')
+    # parse the arguments
+    args = parser.parse_args()
+
+    # write synthetic ims file
+    write_synthetic_ims_file(args.output, tuple(args.size), args.channels, args.dtype, tuple(args.chunks),
+                             args.compression_level, args.levels, args.time_points, seed=args.seed,
+                             shuffle=args.shuffle)
+    # print status message
+    print(f'Saved synthetic ims file at {args.output}!')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import os
+import zlib
+import itertools
+from concurrent.futures import wait
+import numpy as np
+import h5py
+
+# imagecodecs is optional, its zlib decoder is faster than the one of the standard library
+try:
+    import imagecodecs
+except ImportError:
+    imagecodecs = None
+
+
+# HDF5 filter ids that can be decoded by the threaded reader
+SUPPORTED_FILTERS = {h5py.h5z.FILTER_DEFLATE, h5py.h5z.FILTER_SHUFFLE}
+
+
+def get_dataset_filters(dataset):
+    """
+    Returns the ids of the HDF5 filters of the passed dataset in the order they are applied when writing.
+
+    :param dataset: chunked HDF5 dataset (h5py.Dataset)
+    :return: list of filter ids (list of int)
+    """
+    # read dataset creation property list
+    plist = dataset.id.get_create_plist()
+    # return filter ids of the filter pipeline
+    return [plist.get_filter(i)[0] for i in range(plist.get_nfilters())]
+
+
+def is_threaded_reading_supported(dataset):
+    """
+    Checks if the passed dataset can be read by the threaded chunk reader. This is the case for chunked datasets that
+    only use the deflate (gzip) and shuffle filters, as Imaris does.
+
+    :param dataset: HDF5 dataset (h5py.Dataset)
+    :return: True if the dataset can be read by the threaded chunk reader (bool)
+    """
+    return dataset.chunks is not None and set(get_dataset_filters(dataset)).issubset(SUPPORTED_FILTERS)
+
+
+def decode_chunk(raw_bytes, filters, filter_mask, dtype):
+    """
+    Decodes the raw bytes of a single HDF5 chunk by applying the filter pipeline in reverse order. Filters that were
+    skipped for this chunk (bit set in the filter mask) are not applied. Both zlib decoders release the GIL, so chunks
+    can be decoded in parallel threads.
+
+    :param raw_bytes: raw (compressed) bytes of the chunk as stored in the file (bytes)
+    :param filters: list of filter ids of the dataset in the order they are applied when writing (list of int)
+    :param filter_mask: filter mask of the chunk (int)
+    :param dtype: data type of the dataset (numpy.dtype)
+    :return: decoded chunk as flat array (numpy.ndarray)
+    """
+    # iterate filters in reverse order
+    for i in reversed(range(len(filters))):
+        # skip filters that were not applied to this chunk
+        if filter_mask & (1 << i):
+            continue
+        # check if it is the deflate filter
+        if filters[i] == h5py.h5z.FILTER_DEFLATE:
+            # decompress the chunk
+            raw_bytes = imagecodecs.zlib_decode(raw_bytes) if imagecodecs is not None else zlib.decompress(raw_bytes)
+        # check if it is the shuffle filter
+        elif filters[i] == h5py.h5z.FILTER_SHUFFLE:
+            # restore the byte order of the single elements
+            raw_bytes = np.frombuffer(raw_bytes, dtype=np.uint8).reshape(dtype.itemsize, -1).T.tobytes()
+    # return decoded chunk
+    return np.frombuffer(raw_bytes, dtype=dtype)
+
+
+def iterate_chunks_in_region(dataset, region):
+    """
+    Generator that yields the offsets of all chunks of the passed dataset that overlap the passed region.
+
+    :param dataset: chunked HDF5 dataset (h5py.Dataset)
+    :param region: list of (start, stop) tuples, one for each dimension (list)
+    :return: iterator of chunk offsets (tuple)
+    """
+    # generate the chunk offsets for each dimension
+    offsets_per_dimension = [range((start // chunk) * chunk, stop, chunk)
+                             for (start, stop), chunk in zip(region, dataset.chunks)]
+    # yield all combinations of chunk offsets
+    yield from itertools.product(*offsets_per_dimension)
+
+
+def read_chunk_into_region(fd, chunk_offset, chunk_info, chunk_shape, filters, dtype, fillvalue, region, out):
+    """
+    Reads a single chunk from the file, decodes it and writes the part that overlaps the region into the output array.
+
+    :param fd: file descriptor of the HDF5 file (int)
+    :param chunk_offset: offset of the chunk in the dataset (tuple)
+    :param chunk_info: chunk storage info returned by h5py (h5py.h5d.StoreInfo)
+    :param chunk_shape: shape of the chunks of the dataset (tuple)
+    :param filters: list of filter ids of the dataset (list of int)
+    :param dtype: data type of the dataset (numpy.dtype)
+    :param fillvalue: fill value of the dataset that is used for unallocated chunks
+    :param region: list of (start, stop) tuples of the region that is read (list)
+    :param out: array with the shape of the region (numpy.ndarray)
+    """
+    # get slices of the overlap in chunk and output coordinates
+    chunk_slices = []
+    out_slices = []
+    for offset, size, (start, stop) in zip(chunk_offset, chunk_shape, region):
+        # get overlap of chunk and region
+        low, high = max(offset, start), min(offset + size, stop)
+        chunk_slices.append(slice(low - offset, high - offset))
+        out_slices.append(slice(low - start, high - start))
+
+    # check if the chunk was never written
+    if chunk_info.byte_offset is None:
+        # fill the overlap with the fill value of the dataset
+        out[tuple(out_slices)] = fillvalue
+        return
+
+    # read raw bytes of the chunk, pread is position independent and thus thread safe
+    raw_bytes = os.pread(fd, chunk_info.size, chunk_info.byte_offset)
+    # decode chunk
+    chunk = decode_chunk(raw_bytes, filters, chunk_info.filter_mask, dtype).reshape(chunk_shape)
+    # scatter the overlap into the output array
+    out[tuple(out_slices)] = chunk[tuple(chunk_slices)]
+
+
+def read_regions_threaded(read_requests, executor):
+    """
+    Reads regions of chunked HDF5 datasets by fetching the raw chunk bytes directly from the file and decoding them in
+    the threads of the passed executor. Only the chunks that overlap the requested regions are read. The chunks of all
+    requests are submitted at once, so the threads are kept busy across channels. The results are identical to reading
+    the regions with h5py.
+
+    :param read_requests: list of (dataset, region, out) tuples, where region is a list of (start, stop) tuples and out
+                          an array (or view) with the shape of the region (list)
+    :param executor: thread pool that is used for reading and decoding the chunks (ThreadPoolExecutor)
+    """
+    # initialize dict for opened file descriptors and list for futures
+    file_descriptors = {}
+    futures = []
+    try:
+        # iterate read requests
+        for dataset, region, out in read_requests:
+            # get the file descriptor of the dataset's file
+            filename = dataset.file.filename
+            if filename not in file_descriptors:
+                file_descriptors[filename] = os.open(filename, os.O_RDONLY)
+            # read dataset properties once for all chunks
+            filters = get_dataset_filters(dataset)
+            fillvalue = dataset.fillvalue
+            # iterate chunks that overlap the region
+            for chunk_offset in iterate_chunks_in_region(dataset, region):
+                # look up storage location of the chunk
+                chunk_info = dataset.id.get_chunk_info_by_coord(chunk_offset)
+                # submit reading and decoding of the chunk
+                futures.append(executor.submit(read_chunk_into_region, file_descriptors[filename], chunk_offset,
+                                               chunk_info, dataset.chunks, filters, dataset.dtype, fillvalue,
+                                               region, out))
+    finally:
+        # wait for all chunks before the file descriptors are closed
+        wait(futures)
+        # close file descriptors
+        for fd in file_descriptors.values():
+            os.close(fd)
+    # raise possible errors of the single chunks
+    for future in futures:
+        future.result()
@@ -0,0 +1,302 @@
+import os
+import sys
+import json
+import argparse
+import h5py
+from ims_to_ome_tiff_converter import read_metadata_from_ims_file, read_image_from_ims_file, \
+    read_resampled_image_from_ims_file, save_ome_tiff_file, find_ims_files
+from instrumentation import profile_stage, add_instrumentation_arguments, configure_instrumentation_from_arguments, \
+    print_stage_summary
+# make the scripts of the utils directory importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils'))
+from ome_tiff_unify_channels import channels_of_interest, labels_of_interest
+import ome_tiff_to_nifti
+import ome_tiff_to_nnUNet
+
+
+# nnUNet exporters of the supported output formats
+NNUNET_EXPORTERS = {'nifti': ome_tiff_to_nifti,
+                    'tif': ome_tiff_to_nnUNet}
+
+
+def get_export_options(output_format, nifti_options=None):
+    """
+    Returns the options that are passed to the exporter of the output format and the file ending of its files.
+
+    :param output_format: 'nifti' or 'tif' (string)
+    :param nifti_options: compression and threading of the NIfTI files, see ome_tiff_to_nifti.get_nifti_options (dict)
+    :return: keyword arguments of export_image_to_nnUNet (dict), file ending (string)
+    """
+    # check if NIfTI files are written
+    if output_format == 'nifti':
+        return {'nifti_options': nifti_options}, ome_tiff_to_nifti.get_nifti_file_ending(nifti_options)
+    # TIFF files have no options
+    return {}, '.tif'
+
+
+def get_global_channel_ids(channels_dict):
+    """
+    Returns the prefixed channel name and the id number of each global channel in the format the nnUNet exporters
+    expect. The id number is the position of the channel in the passed dictionary.
+
+    :param channels_dict: dictionary of the channels of interest, see channels_of_interest (dict)
+    :return: {'dapi': {'name': 'channel_dapi', 'id_nr': 0}, ...} (dict)
+    """
+    return {k: {'name': f'channel_{k}', 'id_nr': i} for i, k in enumerate(channels_dict.keys())}
+
+
+def write_nnUNet_dataset_json(path_to_nnUNet_dataset, channels_dict, global_label_id, num_training, file_ending):
+    """
+    Writes the dataset.json file of a nnUNet dataset.
+
+    :param path_to_nnUNet_dataset: path to the directory of the dataset (string)
+    :param channels_dict: dictionary of the channels of interest, see channels_of_interest (dict)
+    :param global_label_id: name of the label channel (string)
+    :param num_training: number of exported training images (int)
+    :param file_ending: file ending of the images and labels, e.g. '.nii.gz' (string)
+    """
+    # create dataset dict
+    dataset_dict = {
+        "channel_names": {str(i): k for i, k in enumerate(channels_dict.keys())},
+        "labels": {
+            "background": 0,
+            global_label_id: 1,
+        },
+        "numTraining": num_training,
+        "file_ending": file_ending
+    }
+    # write dataset dict to JSON file
+    with open(os.path.join(path_to_nnUNet_dataset, 'dataset.json'), "w") as f:
+        json.dump(dataset_dict, f, indent=4)
+
+
+def convert_ims_file_to_nnUNet(path_to_ims_file, image_nr, path_to_images_tr, path_to_labels_tr, dataset_abbreviation,
+                               global_label_id, output_format='nifti', channels_dict=channels_of_interest,
+                               labels_dict=labels_of_interest, path_to_ome_tiff_directory=None, backend='h5py',
+                               n_threads=None, rescale=None, rescale_level=None, nifti_options=None,
+                               target_spacing=None, label_kernel='majority'):
+    """
+    Exports a single Imaris ims file into the nnUNet file structure without intermediate files. The channels of interest
+    are unified while the file is read, so only the unified channels are decoded, and the ZCYX array is handed to the
+    nnUNet exporter in memory. Files the exporter would not export, e.g. without the label channel or, for NIfTI
+    output, without one of the global channels, are skipped before any pixel data is read. If a target spacing is
+    passed, the image is read from the Imaris resolution level that matches it and downsampled while it is read if
+    needed, see read_resampled_image_from_ims_file.
+
+    :param path_to_ims_file: path to the ims file (string)
+    :param image_nr: number of the image in the dataset (int)
+    :param path_to_images_tr: path to the imagesTr directory of the dataset (string)
+    :param path_to_labels_tr: path to the labelsTr directory of the dataset (string)
+    :param dataset_abbreviation: short identifier as prefix to the single file names (string)
+    :param global_label_id: unified name of the label channel, e.g. 'label_sinusoids' (string)
+    :param output_format: 'nifti' for NIfTI files or 'tif' for TIFF files with JSON spacing files (string)
+    :param channels_dict: dictionary of the channels of interest, see channels_of_interest (dict)
+    :param labels_dict: dictionary of the labels of interest, see labels_of_interest (dict)
+    :param path_to_ome_tiff_directory: if passed, the unified image is saved as OME TIFF file in this directory as
+                                       well (string)
+    :param backend: 'h5py' for reading with h5py or 'threaded' for decoding the chunks in a thread pool (string)
+    :param n_threads: number of threads of the 'threaded' backend, if None the number of CPUs is used (int)
+    :param rescale: lower and upper percentile that are mapped to 0 and 255 for rescaling to 8 bit, if None the
+                    original bit depth is kept (tuple)
+    :param rescale_level: resolution level the percentiles are computed on, if None it is selected automatically (int)
+    :param nifti_options: compression and threading of the NIfTI files, see ome_tiff_to_nifti.get_nifti_options (dict)
+    :param target_spacing: spacing of the exported images in the order (Z,Y,X), if None the full resolution is
+                           exported (list)
+    :param label_kernel: 'majority' or 'nearest', kernel the label channels are downsampled with (string)
+    :return: True if the image was exported (bool)
+    """
+    # define selection of the unified channels and labels
+    channel_selection = {'channels': channels_dict, 'labels': labels_dict}
+    # resolve the unified channel names from the metadata only
+    with h5py.File(path_to_ims_file, 'r') as f:
+        _, metadata_dict = read_metadata_from_ims_file(f, path_to_ims_file, channel_selection)
+    # skip file if the exporter of the output format would not export it, e.g. if the label channel is not available
+    if NNUNET_EXPORTERS[output_format].select_export_channels(metadata_dict['channel_names'],
+                                                              get_global_channel_ids(channels_dict),
+                                                              global_label_id) is None:
+        return False
+
+    # check if the image is exported at its full resolution
+    if target_spacing is None:
+        # read the unified channels of the image
+        image_data_array, metadata_dict = read_image_from_ims_file(path_to_ims_file, backend, n_threads,
+                                                                   channel_selection=channel_selection,
+                                                                   rescale=rescale, rescale_level=rescale_level)
+    else:
+        # read the unified channels of the image at the target spacing, labels are resampled with the label kernel
+        image_data_array, metadata_dict = read_resampled_image_from_ims_file(
+            path_to_ims_file, target_spacing, backend, n_threads, channel_selection=channel_selection,
+            rescale=rescale, rescale_level=rescale_level,
+            label_channel_names=[n for n in metadata_dict['channel_names'] if n.startswith('label_')],
+            label_kernel=label_kernel)
+    # check if the unified image should be kept as OME TIFF file
+    if path_to_ome_tiff_directory is not None:
+        # define output file name
+        path_to_unified_ome_tiff_file = os.path.join(path_to_ome_tiff_directory,
+                                                     f'{os.path.basename(path_to_ims_file)[:-4]}_unified.ome.tif')
+        # save the unified image
+        save_ome_tiff_file(image_data_array, metadata_dict, path_to_unified_ome_tiff_file)
+
+    # read voxel size from metadata
+    voxel_size = metadata_dict['voxel_size']
+    # convert voxel size from dict to list of order (Z,Y,X)
+    resolution = [voxel_size['Z'], voxel_size['Y'], voxel_size['X']]
+    # export label and channels with the exporter of the output format
+    export_options, _ = get_export_options(output_format, nifti_options)
+    return NNUNET_EXPORTERS[output_format].export_image_to_nnUNet(image_data_array, metadata_dict['channel_names'],
+                                                                  resolution, path_to_images_tr, path_to_labels_tr,
+                                                                  image_nr, dataset_abbreviation,
+                                                                  get_global_channel_ids(channels_dict),
+                                                                  global_label_id, **export_options)
+
+
+def ims_to_nnUNet(ims_files, path_to_nnUNet_dataset, dataset_id, dataset_abbreviation, global_label_id,
+                  output_format='nifti', channels_dict=channels_of_interest, labels_dict=labels_of_interest,
+                  path_to_ome_tiff_directory=None, backend='h5py', n_threads=None, rescale=None, rescale_level=None,
+                  nifti_options=None, target_spacing=None, label_kernel='majority'):
+    """
+    Builds a nnUNet dataset from Imaris ims files in a single process. Every file is read, unified and exported in
+    memory, see convert_ims_file_to_nnUNet, and the dataset.json is written at the end.
+
+    :param ims_files: paths to the ims files (list)
+    :param path_to_nnUNet_dataset: directory for storing the nnUNet structured dataset (string)
+    :param dataset_id: dataset name of structure "DatasetXXX_NAME" (string)
+    :param dataset_abbreviation: short identifier as prefix to the single file names (string)
+    :param global_label_id: unified name of the label channel, e.g. 'label_sinusoids' (string)
+    :param output_format: 'nifti' for NIfTI files or 'tif' for TIFF files with JSON spacing files (string)
+    :param channels_dict: dictionary of the channels of interest, see channels_of_interest (dict)
+    :param labels_dict: dictionary of the labels of interest, see labels_of_interest (dict)
+    :param path_to_ome_tiff_directory: if passed, the unified images are saved as OME TIFF files in this directory as
+                                       well (string)
+    :param backend: 'h5py' for reading with h5py or 'threaded' for decoding the chunks in a thread pool (string)
+    :param n_threads: number of threads of the 'threaded' backend, if None the number of CPUs is used (int)
+    :param rescale: lower and upper percentile that are mapped to 0 and 255 for rescaling to 8 bit, if None the
+                    original bit depth is kept (tuple)
+    :param rescale_level: resolution level the percentiles are computed on, if None it is selected automatically (int)
+    :param nifti_options: compression and threading of the NIfTI files, see ome_tiff_to_nifti.get_nifti_options (dict)
+    :param target_spacing: spacing of the exported images in the order (Z,Y,X), if None the full resolution is
+                           exported (list)
+    :param label_kernel: 'majority' or 'nearest', kernel the label channels are downsampled with (string)
+    :return: number of exported images (int)
+    """
+    # read file ending of the output format
+    _, file_ending = get_export_options(output_format, nifti_options)
+    # set up the folder structure for nnUNet
+    path_to_nnUNet_dataset, path_to_images_tr, path_to_labels_tr = \
+        NNUNET_EXPORTERS[output_format].set_up_nnUNet_file_structure(path_to_nnUNet_dataset, dataset_id)
+    # create directory for the intermediate OME TIFF files if requested
+    if path_to_ome_tiff_directory is not None:
+        os.makedirs(path_to_ome_tiff_directory, exist_ok=True)
+
+    # initialize number of exported images
+    num_training = 0
+    # iterate ims files
+    for i, path_to_ims_file in enumerate(ims_files):
+        # measure the export of the whole file as a stage
+        with profile_stage('ims_to_nnUNet', file=path_to_ims_file):
+            exported = convert_ims_file_to_nnUNet(path_to_ims_file, i, path_to_images_tr, path_to_labels_tr,
+                                                  dataset_abbreviation, global_label_id, output_format, channels_dict,
+                                                  labels_dict, path_to_ome_tiff_directory, backend, n_threads,
+                                                  rescale, rescale_level, nifti_options, target_spacing,
+                                                  label_kernel)
+        # check if the file was exported
+        if exported:
+            num_training += 1
+            # print status message
+            print(f'[{i + 1}/{len(ims_files)}] Converted "{path_to_ims_file}" into nnUNet file structure!')
+        else:
+            # print status message
+            print(f'[{i + 1}/{len(ims_files)}] Skipped "{path_to_ims_file}", label or channels are missing!')
+
+    # write dataset.json
+    write_nnUNet_dataset_json(path_to_nnUNet_dataset, channels_dict, global_label_id, num_training, file_ending)
+    # return number of exported images
+    return num_training
+
+
+def main():
+    """
+    Main function for building a nnUNet dataset from a single ims file or all ims files of a directory without writing
+    and reading intermediate OME TIFF files.
+    """
+    # create the parser object
+    parser = argparse.ArgumentParser(description='Converts Imaris ims files into a nnUNet structured dataset in a '
+                                                 'single pass, the channels are unified in memory.')
+
+    # add arguments for the input path and output directory
+    parser.add_argument('-i', '--input', required=True,
+                        help='Path to input ims file or directory of ims files')
+    parser.add_argument('-o', '--output', required=True,
+                        help='Directory for storing the nnUNet structured Dataset')
+    parser.add_argument('-d', '--dataset_id', required=True,
+                        help='Dataset name, should be of structure "DatasetXXX_NAME" where XXX refers to a 3 digit '
+                             'id-number and NAME can be freely chosen.')
+    parser.add_argument('-a', '--dataset_abbreviation', required=True,
+                        help='short identifier as prefix to the single file names')
+    parser.add_argument('-l', '--label', required=True,
+                        help='unified name of the label channel, e.g. "label_sinusoids"')
+    parser.add_argument('-f', '--format', default='nifti', choices=list(NNUNET_EXPORTERS.keys()),
+                        help='File format of the nnUNet images and labels (default: nifti)')
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help='Search subdirectories of the input directory for ims files as well')
+    parser.add_argument('--save_ome_tiff', default=None,
+                        help='Directory for additionally saving the unified images as OME TIFF files')
+    # add arguments for the reader
+    parser.add_argument('-b', '--backend', default='h5py', choices=['h5py', 'threaded'],
+                        help='Backend for reading the ims files (default: h5py)')
+    parser.add_argument('-t', '--threads', type=int, default=None,
+                        help='Number of decoding threads of the threaded backend (default: number of CPUs)')
+    parser.add_argument('--to_uint8', action='store_true',
+                        help='Rescale every channel to 8 bit between the intensity percentiles, labels are kept')
+    parser.add_argument('--percentiles', type=float, nargs=2, default=[0.1, 99.9], metavar=('LOW', 'HIGH'),
+                        help='Percentiles that are mapped to 0 and 255 when rescaling to 8 bit (default: 0.1 99.9)')
+    parser.add_argument('--percentile_level', type=int, default=None,
+                        help='Resolution level the percentiles are computed on (default: coarsest level with at '
+                             'least 2^20 voxels)')
+    # add arguments for resampling to the spacing of the nnUNet model
+    parser.add_argument('--target_spacing', type=float, nargs=3, default=None, metavar=('Z', 'Y', 'X'),
+                        help='Spacing of the exported images, a matching Imaris resolution level is read directly, '
+                             'otherwise the images are downsampled by whole voxels (default: full resolution)')
+    parser.add_argument('--label_resampling', default='majority', choices=['majority', 'nearest'],
+                        help='Kernel the labels are downsampled with, intensities are averaged (default: majority)')
+    # add arguments for the compression of the NIfTI files
+    parser.add_argument('--compression_level', type=int, default=1, choices=range(10), metavar='[0-9]',
+                        help='gzip level of the .nii.gz files (default: 1)')
+    parser.add_argument('--write_threads', type=int, default=1,
+                        help='Number of threads for writing the NIfTI files of an image concurrently and compressing '
+                             'them block by block into multi-member gzip files (default: 1)')
+    parser.add_argument('--uncompressed', action='store_true',
+                        help='Write uncompressed .nii files, e.g. for fast local scratch disks')
+    # add arguments for profiling the processing stages
+    add_instrumentation_arguments(parser)
+    # parse the arguments
+    args = parser.parse_args()
+    # enable the instrumentation if requested
+    configure_instrumentation_from_arguments(args)
+
+    # check if passed input path belongs to a file or directory
+    if os.path.isfile(args.input):
+        ims_files = [args.input]
+    else:
+        ims_files = find_ims_files(args.input, args.recursive)
+
+    # build the nnUNet dataset
+    num_training = ims_to_nnUNet(ims_files, args.output, args.dataset_id, args.dataset_abbreviation, args.label,
+                                 args.format, path_to_ome_tiff_directory=args.save_ome_tiff, backend=args.backend,
+                                 n_threads=args.threads,
+                                 rescale=tuple(args.percentiles) if args.to_uint8 else None,
+                                 rescale_level=args.percentile_level,
+                                 nifti_options={'compress': not args.uncompressed,
+                                                'compression_level': args.compression_level,
+                                                'n_threads': args.write_threads},
+                                 target_spacing=args.target_spacing, label_kernel=args.label_resampling)
+
+    # print status message
+    print(f'Finished nnUNet conversion of dataset: {args.dataset_id} ({num_training} images)!')
+    # print time, bytes and memory of the processing stages if requested
+    if args.profile:
+        print_stage_summary()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,58 +2,177 @@ import tifffile
 import h5py
 import numpy as np
 import os
+import sys
 import argparse
+import io
+import json
+import math
+import time
+import hashlib
+import shutil
+import queue
+import threading
+from datetime import datetime
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from ims_chunk_reader import is_threaded_reading_supported, read_regions_threaded
+from batch_coordination import parse_shard, select_shard_jobs, read_conversion_status, write_conversion_status, \
+    claim_conversion, release_conversion_claim, start_claim_heartbeat
+from ome_zarr_writer import get_zarr_compressor, encode_zarr_chunk, create_zarr_array, submit_zarr_slab, \
+    get_ome_zarr_attributes, write_ome_zarr_group
+from resampling import DEFAULT_SPACING_TOLERANCE, get_resampling_factors, get_resampled_shape, \
+    get_resampled_origin, get_resampling_slab_size, resample_slab
+from instrumentation import profile_stage, run_instrumented, get_instrumentation_configuration, merge_stage_records, \
+    start_progress, update_progress, print_stage_summary, add_instrumentation_arguments, \
+    configure_instrumentation_from_arguments
 
+# make the helper scripts of the utils directory importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils'))
+from ome_tiff_unify_channels import select_unified_channels, channels_of_interest, labels_of_interest
 
-def read_image_from_ims_file(path_to_ims_file):
+
+def read_ims_attribute(attributes, key):
     """
-    Reads image data together with relevant metadata from an Imaris ims file and returns the image data together
-    with the extracted metadata.
+    Reads a single attribute value from an Imaris ims file. Imaris stores attribute values as arrays of single
+    characters, therefore the characters are joined and decoded to a string.
 
-    :param path_to_ims_file: path to the ims file from which the data should be extracted (string)
-    :return: image_data_array (numpy.ndarray), metadata_dict (dict)
+    :param attributes: attribute manager of a h5py group or dataset (h5py.AttributeManager)
+    :param key: name of the attribute (string)
+    :return: attribute value (string)
     """
-    # print status message
-    print(f'Read "{path_to_ims_file}" ...')
-    # open ims file
-    with h5py.File(path_to_ims_file, 'r') as f:
-        # generate list of available channels
-        channel_list = [ch_id for ch_id in f['DataSetInfo'] if ch_id.startswith('Channel')]
-        # initialize empty lists for storing the data arrays and names of each channel
-        image_data_array = []
-        channel_names = []
+    return attributes[key].tobytes().decode('ascii', 'ignore')
+
+
+def get_ims_time_points(f):
+    """
+    Returns the sorted indices of all time points that are stored in an opened Imaris ims file.
+
+    :param f: opened Imaris ims file (h5py.File)
+    :return: list of time point indices (list of int)
+    """
+    return sorted(int(key.split(sep=' ')[-1]) for key in f['DataSet']['ResolutionLevel 0']
+                  if key.startswith('TimePoint'))
+
+
+def read_ims_time_interval(f):
+    """
+    Reads the mean interval between the time points of an opened Imaris ims file from the TimePoint1, TimePoint2, ...
+    attributes of the DataSetInfo/TimeInfo group.
+
+    :param f: opened Imaris ims file (h5py.File)
+    :return: mean time interval in seconds, None if the file has less than two time points or no time info (float)
+    """
+    # check if time info is available
+    if 'TimeInfo' not in f['DataSetInfo']:
+        return None
+    # read time info attributes
+    attributes = f['DataSetInfo']['TimeInfo'].attrs
+    # initialize empty list for time stamps
+    time_stamps = []
+    # iterate time point attributes, Imaris counts them starting at 1
+    while f'TimePoint{len(time_stamps) + 1}' in attributes:
+        # read and parse time stamp
+        time_stamp = read_ims_attribute(attributes, f'TimePoint{len(time_stamps) + 1}')
+        try:
+            time_stamps.append(datetime.strptime(time_stamp, '%Y-%m-%d %H:%M:%S.%f'))
+        except ValueError:
+            return None
+    # check if an interval can be calculated
+    if len(time_stamps) < 2:
+        return None
+    # return mean interval between the time points
+    return (time_stamps[-1] - time_stamps[0]).total_seconds() / (len(time_stamps) - 1)
+
+
+def get_ims_channel_datasets(f, channel_list, resolution_level=0, time_point=0):
+    """
+    Returns the data sets of the passed channels at the passed resolution level and time point.
+
+    :param f: opened Imaris ims file (h5py.File)
+    :param channel_list: list of channel group names (list)
+    :param resolution_level: resolution level, 0 is the full resolution (int)
+    :param time_point: index of the time point (int)
+    :return: list of 3D (Z,Y,X) channel datasets (list of h5py.Dataset)
+    """
+    return [f['DataSet'][f'ResolutionLevel {resolution_level}'][f'TimePoint {time_point}'][channel]['Data']
+            for channel in channel_list]
 
-        # iterate channels
-        for channel in channel_list:
-            # read data array
-            image_data_array.append(np.array(f['DataSet']['ResolutionLevel 0']['TimePoint 0'][channel]['Data']))
-            # read channel names
-            channel_names.append(f['DataSetInfo'][channel].attrs['Name'].tobytes().decode('ascii', 'ignore'))
-
-        # combine 3D arrays into a 4D array
-        image_data_array = np.stack(image_data_array)
-
-        # initialize empty dict for voxel and image sizes
-        voxel_size = {}
-        image_size = {}
-        # read min and max metric coordinates as well as pixel size in all three dimensions and calculate voxel size
-        for i, d in [(0, 'X'), (1, 'Y'), (2, 'Z')]:
-            # read the highest metrical coordinate
-            max_coord = float(f['DataSetInfo']['Image'].attrs[f'ExtMax{i}'].tobytes().decode('ascii', 'decode'))
-            # read the lowest metrical coordinate
-            min_coord = float(f['DataSetInfo']['Image'].attrs[f'ExtMin{i}'].tobytes().decode('ascii', 'decode'))
-            # read the pixel size
-            pixel_size = int(f['DataSetInfo']['Image'].attrs[d].tobytes().decode('ascii', 'decode'))
-
-            # calculate metrical voxel size
-            voxel_size[d] = (max_coord - min_coord) / pixel_size
-
-            # add dimension size to image size dict
-            image_size[d] = pixel_size
-
-    # crop array size to image size
-    image_data_array = np.transpose(image_data_array[:, :image_size['Z'], :image_size['Y'], :image_size['X']],
-                                    (1, 0, 2, 3))
+
+def resolve_channel_selection(channel_names, channel_selection=None):
+    """
+    Resolves a channel selection against the (lower case) channel names of an ims file. The selection is either a list
+    of channel names that are kept in the given order, or a dictionary with the keys 'channels' and 'labels' holding
+    mappings in the format of channels_of_interest and labels_of_interest, which are resolved like in unify_channels.
+
+    :param channel_names: list of channel names of the ims file (list)
+    :param channel_selection: list of channel names or {'channels': {...}, 'labels': {...}} (list or dict)
+    :return: channel_indices (list of int), selected_channel_names (list)
+    """
+    # keep all channels if no selection is passed
+    if channel_selection is None:
+        return list(range(len(channel_names))), list(channel_names)
+
+    # check if a mapping of channels and labels of interest is passed
+    if isinstance(channel_selection, dict):
+        # resolve mapping like unify_channels does
+        return select_unified_channels(channel_names,
+                                       channel_selection.get('channels', {}),
+                                       channel_selection.get('labels', {}))
+
+    # check if all explicitly selected channels are available
+    missing_channels = [name for name in channel_selection if name.lower() not in channel_names]
+    if missing_channels:
+        raise ValueError(f'Channels {missing_channels} are not available, available channels: {channel_names}!')
+    # return indices and names of the selected channels
+    return ([channel_names.index(name.lower()) for name in channel_selection],
+            [name.lower() for name in channel_selection])
+
+
+def read_metadata_from_ims_file(f, path_to_ims_file, channel_selection=None):
+    """
+    Reads the relevant metadata from an opened Imaris ims file without touching any pixel data. If a channel selection
+    is passed, it is resolved against the channel names here, so the returned channel list only holds the selected
+    channels and the pixel data of all other channels is never read.
+
+    :param f: opened Imaris ims file (h5py.File)
+    :param path_to_ims_file: path to the ims file, used for the original file entry of the metadata (string)
+    :param channel_selection: list of channel names or mapping of channels and labels of interest, see
+                              resolve_channel_selection (list or dict)
+    :return: channel_list (list of channel group names), metadata_dict (dict)
+    """
+    # generate list of available channels
+    channel_list = [ch_id for ch_id in f['DataSetInfo'] if ch_id.startswith('Channel')]
+    # read channel names
+    channel_names = [read_ims_attribute(f['DataSetInfo'][channel].attrs, 'Name').lower() for channel in channel_list]
+    # resolve channel selection against the channel names
+    channel_indices, channel_names = resolve_channel_selection(channel_names, channel_selection)
+    # reduce channel list to the selected channels
+    channel_list = [channel_list[i] for i in channel_indices]
+
+    # initialize empty dict for voxel sizes, image sizes and the metrical origin
+    voxel_size = {}
+    image_size = {}
+    origin = {}
+    # read min and max metric coordinates as well as pixel size in all three dimensions and calculate voxel size
+    for i, d in [(0, 'X'), (1, 'Y'), (2, 'Z')]:
+        # read the highest metrical coordinate
+        max_coord = float(read_ims_attribute(f['DataSetInfo']['Image'].attrs, f'ExtMax{i}'))
+        # read the lowest metrical coordinate
+        min_coord = float(read_ims_attribute(f['DataSetInfo']['Image'].attrs, f'ExtMin{i}'))
+        # read the pixel size
+        pixel_size = int(read_ims_attribute(f['DataSetInfo']['Image'].attrs, d))
+
+        # calculate metrical voxel size
+        voxel_size[d] = (max_coord - min_coord) / pixel_size
+
+        # add dimension size to image size dict
+        image_size[d] = pixel_size
+        # add lowest metrical coordinate to origin dict
+        origin[d] = min_coord
+
+    # read number of time points and the mean interval between them
+    time_points = get_ims_time_points(f)
+    time_interval = read_ims_time_interval(f)
 
     # generate meta data dict
     metadata_dict = {'axes': 'ZCYX',
@@ -62,20 +181,1113 @@ def read_image_from_ims_file(path_to_ims_file):
                      'slices': image_size['Z'],
                      'hyperstack': True,
                      'mode': 'grayscale',
-                     'channel_names': [s.lower() for s in channel_names],
+                     'channel_names': channel_names,
                      'image_size': image_size,
                      'voxel_size': voxel_size,
+                     'origin': origin,
+                     'time_points': len(time_points),
+                     'time_interval': time_interval,
                      'original_file': path_to_ims_file.split(sep='/')[-1]}
 
+    # return list of channel groups and dictionary with relevant metadata
+    return channel_list, metadata_dict
+
+
+def create_reader_executor(backend='h5py', n_threads=None):
+    """
+    Returns the executor that is used for reading the pixel data with the passed backend. The 'h5py' backend reads the
+    data with h5py and does not need an executor, the 'threaded' backend decodes the compressed chunks in a thread pool.
+    The returned object is a context manager in both cases.
+
+    :param backend: either 'h5py' or 'threaded' (string)
+    :param n_threads: number of threads of the 'threaded' backend, if None the number of CPUs is used (int)
+    :return: thread pool or an empty context (ThreadPoolExecutor or nullcontext)
+    """
+    # check if the threaded backend is requested
+    if backend == 'threaded':
+        # return thread pool for decoding the chunks
+        return ThreadPoolExecutor(max_workers=n_threads or os.cpu_count())
+    # check if backend is unknown
+    if backend != 'h5py':
+        raise ValueError(f'Unknown reader backend "{backend}", use either "h5py" or "threaded"!')
+    # return empty context
+    return nullcontext()
+
+
+def read_ims_slab_into_buffer(channel_datasets, buffer, z_start, z_stop, image_size, executor=None, offset=None):
+    """
+    Reads the Z range [z_start, z_stop) of all passed channel datasets directly into a preallocated ZCYX buffer.
+    Only the valid image region is read, the padding Imaris adds to fill up its chunks is skipped. If an offset is
+    passed, the Z range and the image size refer to a region of interest starting at this offset, so only the chunks
+    that overlap the region are read. If a thread pool is passed, the compressed chunks are decoded in parallel threads
+    instead of by h5py.
+
+    :param channel_datasets: list of 3D (Z,Y,X) channel datasets (list of h5py.Dataset)
+    :param buffer: C-contiguous array of shape (>= z_stop - z_start, C, Y, X) (numpy.ndarray)
+    :param z_start: first Z plane that should be read (int)
+    :param z_stop: Z plane at which reading stops, exclusive (int)
+    :param image_size: dictionary with the image size in X, Y and Z (dict)
+    :param executor: thread pool for the threaded chunk reader, if None the data is read with h5py (ThreadPoolExecutor)
+    :param offset: dictionary with the offset of the region of interest in X, Y and Z in voxels (dict)
+    """
+    # read region starting at the origin if no offset is passed
+    offset = offset or {'X': 0, 'Y': 0, 'Z': 0}
+    # get region of the slab in dataset coordinates
+    region = [(offset['Z'] + z_start, offset['Z'] + z_stop),
+              (offset['Y'], offset['Y'] + image_size['Y']),
+              (offset['X'], offset['X'] + image_size['X'])]
+    # initialize empty list for regions that are read by the threaded chunk reader
+    read_requests = []
+    # measure the read as a stage, it covers the HDF5 decompression
+    with profile_stage('read_ims') as stage:
+        # count the uncompressed bytes of the slab
+        stage['bytes_read'] = buffer[:z_stop - z_start].nbytes
+        # iterate channels
+        for c, dataset in enumerate(channel_datasets):
+            # check if the channel can be read by the threaded chunk reader
+            if isinstance(executor, ThreadPoolExecutor) and is_threaded_reading_supported(dataset):
+                # add valid hyperslab of the channel and its slot of the buffer to the read requests
+                read_requests.append((dataset, region, buffer[:z_stop - z_start, c]))
+            else:
+                # HDF5 scatters element by element into strided memory selections, which is several times slower
+                # than a contiguous read, so the channel is read in chunk rows into a contiguous scratch buffer
+                step = min(dataset.chunks[0] if dataset.chunks else z_stop - z_start, z_stop - z_start)
+                scratch = np.empty((step, image_size['Y'], image_size['X']), dtype=dataset.dtype)
+                # iterate chunk rows of the slab
+                for z in range(z_start, z_stop, step):
+                    n_planes = min(step, z_stop - z)
+                    # read valid hyperslab of the chunk row and copy it into the slot of the channel
+                    dataset.read_direct(scratch,
+                                        source_sel=(slice(offset['Z'] + z, offset['Z'] + z + n_planes),
+                                                    slice(*region[1]), slice(*region[2])),
+                                        dest_sel=np.s_[:n_planes])
+                    buffer[z - z_start:z - z_start + n_planes, c] = scratch[:n_planes]
+        # check if there are regions for the threaded chunk reader
+        if read_requests:
+            # read and decode the chunks of all channels in the thread pool
+            read_regions_threaded(read_requests, executor)
+
+
+def iterate_slabs_read_ahead(read_slab, slab_ranges, slots):
+    """
+    Generator that fills the passed buffer slots slab by slab with read_slab and yields each filled slot. With more
+    than one slot, the slabs are read in a background thread that runs ahead of the consumer by up to len(slots) - 1
+    slabs, so reading the next slabs overlaps with processing the current one. The free slots form a bounded queue, so
+    the memory usage never exceeds the passed slots. A slot is handed back to the reader when the consumer requests the
+    next slab, so it must not be used after that. With read-ahead, the slabs are read in the reader thread, so their
+    read_ims stages are not nested into the stage of the consumer. The time the consumer waits for the reader is thus
+    measured as a wait_read stage of its own, which is subtracted from the self time of the consumer's stage.
+
+    :param read_slab: function that is called with a slot and the Z range (z_start, z_stop) of a slab (callable)
+    :param slab_ranges: list of (z_start, z_stop) tuples of the slabs in reading order (list)
+    :param slots: list of preallocated buffers or tuples of buffers the slabs are read into (list)
+    :return: iterator of (slot, z_start, z_stop) tuples
+    """
+    # read the slabs in the calling thread if there is no slot to read ahead into
+    if len(slots) == 1:
+        for z_start, z_stop in slab_ranges:
+            read_slab(slots[0], z_start, z_stop)
+            yield slots[0], z_start, z_stop
+        return
+
+    # initialize queues for free and filled slots and an event for stopping the reader
+    free_slots = queue.Queue()
+    filled_slots = queue.Queue()
+    stop = threading.Event()
+    for slot in slots:
+        free_slots.put(slot)
+
+    def read_slabs():
+        # iterate slabs
+        for z_start, z_stop in slab_ranges:
+            # wait for a free slot and check if the consumer stopped
+            slot = free_slots.get()
+            if stop.is_set():
+                return
+            try:
+                # read the slab into the slot
+                read_slab(slot, z_start, z_stop)
+            except BaseException as error:
+                # hand the error over to the consumer
+                filled_slots.put((None, error))
+                return
+            # hand the filled slot over to the consumer
+            filled_slots.put((slot, (z_start, z_stop)))
+
+    # start the reader thread
+    reader = threading.Thread(target=read_slabs, daemon=True)
+    reader.start()
+    try:
+        # iterate slabs in reading order
+        for _ in slab_ranges:
+            # wait for the next filled slot and measure the wait as a stage nested into the consumer's stage
+            with profile_stage('wait_read'):
+                slot, z_range = filled_slots.get()
+            # raise errors of the reader
+            if slot is None:
+                raise z_range
+            yield slot, z_range[0], z_range[1]
+            # hand the slot back to the reader
+            free_slots.put(slot)
+    finally:
+        # stop the reader and wake it up if it waits for a free slot
+        stop.set()
+        free_slots.put(None)
+        # wait until the reader does not access the datasets anymore
+        reader.join()
+
+
+def iterate_ims_pages(channel_datasets, image_size, slab_size=16, executor=None, offset=None, intensity_bounds=None,
+                      read_ahead=0):
+    """
+    Generator that reads the passed channel datasets slab by slab and yields the 2D (Y,X) pages in ZCYX order. The slab
+    buffers are reused for the whole volume, so memory usage is bounded by read_ahead + 1 slabs of all channels. If
+    intensity bounds are passed, each slab is rescaled to 8 bit before its pages are yielded. With read_ahead > 0, the
+    next slabs are read and rescaled in a background thread while the pages of the current slab are written.
+
+    :param channel_datasets: list of 3D (Z,Y,X) channel datasets (list of h5py.Dataset)
+    :param image_size: dictionary with the image size in X, Y and Z (dict)
+    :param slab_size: number of Z planes that are read at once (int)
+    :param executor: thread pool for the threaded chunk reader, if None the data is read with h5py (ThreadPoolExecutor)
+    :param offset: dictionary with the offset of the region of interest in X, Y and Z in voxels (dict)
+    :param intensity_bounds: list of [low, high] bounds or None for each channel for rescaling to 8 bit, see
+                             estimate_intensity_bounds (list)
+    :param read_ahead: number of slabs that are read ahead of the slab whose pages are yielded (int)
+    :return: iterator of 2D pages (numpy.ndarray)
+    """
+    # get shape of the slab buffers
+    shape = (min(slab_size, image_size['Z']), len(channel_datasets), image_size['Y'], image_size['X'])
+    # initialize empty list for the slots of the slabs
+    slots = []
+    # iterate slots
+    for _ in range(read_ahead + 1):
+        # allocate slab buffer that is reused for all slabs
+        buffer = np.empty(shape, dtype=channel_datasets[0].dtype)
+        # allocate 8 bit slab buffer if the slabs are rescaled
+        slots.append((buffer, buffer if intensity_bounds is None else np.empty(shape, dtype=np.uint8)))
+
+    def read_slab(slot, z_start, z_stop):
+        # read all channels of the slab
+        read_ims_slab_into_buffer(channel_datasets, slot[0], z_start, z_stop, image_size, executor, offset)
+        # rescale slab to 8 bit
+        if intensity_bounds is not None:
+            rescale_slab_to_uint8(slot[0][:z_stop - z_start], intensity_bounds, slot[1][:z_stop - z_start])
+
+    # iterate slabs
+    for (_, output_buffer), z_start, z_stop in iterate_slabs_read_ahead(
+            read_slab, [(z, min(z + slab_size, image_size['Z'])) for z in range(0, image_size['Z'], slab_size)],
+            slots):
+        # iterate Z planes and channels of the slab and yield single pages
+        for plane in output_buffer[:z_stop - z_start]:
+            yield from plane
+
+
+def apply_roi_to_metadata(metadata_dict, roi=None, roi_unit='voxel'):
+    """
+    Resolves a region of interest against the image size and updates the metadata dictionary to the region. The
+    region is given as (start, stop) range per dimension, either in voxels or in microns. Microns refer to the metrical
+    coordinates of the ims file (ExtMin/ExtMax), ranges are extended to the voxels they touch and clipped to the image.
+    The image size, number of slices and the metrical origin are updated, the voxel size stays the same.
+
+    :param metadata_dict: dictionary with the metadata of the image, updated in place (dict)
+    :param roi: dictionary with (start, stop) ranges for 'Z', 'Y' and/or 'X', missing dimensions are not cropped (dict)
+    :param roi_unit: unit of the ranges, either 'voxel' or 'micron' (string)
+    :return: dictionary with the offset of the region in X, Y and Z in voxels (dict)
+    """
+    # initialize offset at the origin
+    offset = {'X': 0, 'Y': 0, 'Z': 0}
+    # check if a region of interest is passed
+    if not roi or not any(roi.values()):
+        return offset
+    # check if unit is known
+    if roi_unit not in ('voxel', 'micron'):
+        raise ValueError(f'Unknown ROI unit "{roi_unit}", use either "voxel" or "micron"!')
+
+    # read image size, voxel size and origin from metadata
+    image_size = metadata_dict['image_size']
+    voxel_size = metadata_dict['voxel_size']
+    origin = metadata_dict['origin']
+    # iterate dimensions
+    for d in 'XYZ':
+        # skip dimensions without range
+        if not roi.get(d):
+            continue
+        # read range of the current dimension
+        start, stop = roi[d]
+        # convert metrical coordinates to voxels
+        if roi_unit == 'micron':
+            start = math.floor((start - origin[d]) / voxel_size[d])
+            stop = math.ceil((stop - origin[d]) / voxel_size[d])
+        # clip range to the image
+        start, stop = max(0, int(start)), min(image_size[d], int(stop))
+        # check if range is empty
+        if stop <= start:
+            raise ValueError(f'Region of interest {roi[d]} ({roi_unit}) does not overlap the image in {d}!')
+
+        # update offset, image size and origin
+        offset[d] = start
+        image_size[d] = stop - start
+        origin[d] = origin[d] + start * voxel_size[d]
+
+    # update number of slices and record the region in voxels of the original image ('roi' is reserved by ImageJ)
+    metadata_dict['slices'] = image_size['Z']
+    metadata_dict['region_of_interest'] = {d: (offset[d], offset[d] + image_size[d]) for d in 'XYZ'}
+    # return offset of the region
+    return offset
+
+
+def read_ims_resolution_level_sizes(f, channel_list, image_size):
+    """
+    Reads the image size of all resolution levels that are stored in an opened Imaris ims file. Imaris stores the size
+    of each level as ImageSizeX/Y/Z attributes of the channel groups, if they are missing the shape of the (padded)
+    dataset is used.
+
+    :param f: opened Imaris ims file (h5py.File)
+    :param channel_list: list of channel group names (list)
+    :param image_size: dictionary with the image size of resolution level 0 (dict)
+    :return: list of image size dictionaries, one for each resolution level (list)
+    """
+    # initialize list of level sizes with the size of resolution level 0
+    level_sizes = [image_size]
+    # iterate the other resolution levels in ascending order
+    for level in range(1, len([key for key in f['DataSet'] if key.startswith('ResolutionLevel')])):
+        # get group of the first channel at the current level
+        channel_group = f['DataSet'][f'ResolutionLevel {level}']['TimePoint 0'][channel_list[0]]
+        # read the level size from the attributes if available, otherwise from the dataset shape
+        if all(f'ImageSize{d}' in channel_group.attrs for d in 'XYZ'):
+            level_sizes.append({d: int(read_ims_attribute(channel_group.attrs, f'ImageSize{d}')) for d in 'XYZ'})
+        else:
+            level_sizes.append(dict(zip('ZYX', channel_group['Data'].shape)))
+    # return sizes of all levels
+    return level_sizes
+
+
+def select_statistics_resolution_level(level_sizes, min_voxels=2 ** 20):
+    """
+    Returns the coarsest resolution level that still holds at least min_voxels voxels. Percentiles of such a level are
+    close to the ones of the full resolution image, but it can be read in a fraction of the time.
+
+    :param level_sizes: list of image size dictionaries of the resolution levels, see read_ims_resolution_level_sizes
+                        (list)
+    :param min_voxels: minimal number of voxels of the selected level (int)
+    :return: index of the resolution level (int)
+    """
+    # iterate levels from coarse to fine
+    for level in reversed(range(len(level_sizes))):
+        # check if the level is large enough
+        if level_sizes[level]['X'] * level_sizes[level]['Y'] * level_sizes[level]['Z'] >= min_voxels:
+            return level
+    # use the full resolution if all levels are smaller
+    return 0
+
+
+def estimate_intensity_bounds(f, channel_list, channel_names, image_size, percentiles=(0.1, 99.9), level=None,
+                              time_point=0):
+    """
+    Estimates per-channel intensity bounds for rescaling from the percentiles of a coarse resolution level of an
+    opened Imaris ims file, so no pass over the full resolution data is needed. Label channels (unified names starting
+    with 'label_') get no bounds, their values are kept.
+
+    :param f: opened Imaris ims file (h5py.File)
+    :param channel_list: list of channel group names (list)
+    :param channel_names: list of channel names (list)
+    :param image_size: dictionary with the image size of resolution level 0 (dict)
+    :param percentiles: lower and upper percentile that are mapped to 0 and 255 (tuple)
+    :param level: resolution level the percentiles are computed on, if None the coarsest level with at least 2 ** 20
+                  voxels is used (int)
+    :param time_point: index of the time point the percentiles are computed on (int)
+    :return: list of [low, high] bounds or None for each channel (list), used resolution level (int)
+    """
+    # get size of all resolution levels
+    level_sizes = read_ims_resolution_level_sizes(f, channel_list, image_size)
+    # select the resolution level if it is not passed
+    level = select_statistics_resolution_level(level_sizes) if level is None else min(level, len(level_sizes) - 1)
+    level_size = level_sizes[level]
+
+    # initialize empty list for the bounds of all channels
+    bounds = []
+    # iterate channels
+    for dataset, channel_name in zip(get_ims_channel_datasets(f, channel_list, level, time_point), channel_names):
+        # keep values of label channels
+        if channel_name.startswith('label_'):
+            bounds.append(None)
+            continue
+        # read valid region of the level and compute the percentiles
+        low, high = np.percentile(dataset[:level_size['Z'], :level_size['Y'], :level_size['X']], percentiles)
+        # avoid an empty range for constant channels, by one step of the integer or float values
+        if high <= low:
+            high = low + (1 if np.issubdtype(dataset.dtype, np.integer) else
+                          np.finfo(dataset.dtype).eps * max(1.0, abs(float(low))))
+        bounds.append([float(low), float(high)])
+    # return bounds and the used level
+    return bounds, level
+
+
+def rescale_slab_to_uint8(slab, bounds, out):
+    """
+    Linearly maps the intensities of each channel of a ZCYX slab from its [low, high] bounds to [0, 255] and writes
+    the result as 8 bit into the output array. Values outside of the bounds are clipped. For 8 and 16 bit integer data a
+    lookup table with one entry per possible value is applied, which is cheaper than computing the scaling for every
+    voxel. Channels without bounds are label channels, their values are kept and must be in the range [0, 255].
+
+    :param slab: ZCYX slab (numpy.ndarray)
+    :param bounds: list of [low, high] bounds or None for each channel, see estimate_intensity_bounds (list)
+    :param out: uint8 array with the shape of the slab (numpy.ndarray)
+    """
+    # measure the rescaling as a stage
+    with profile_stage('rescale_uint8') as stage:
+        # count the bytes of the slab and of the output
+        stage['bytes_read'], stage['bytes_written'] = slab.nbytes, out.nbytes
+        # iterate channels
+        for c, channel_bounds in enumerate(bounds):
+            # check if the labels of a channel without bounds fit into 8 bit, clipping would merge label ids
+            if channel_bounds is None and slab.dtype != np.uint8 and slab.shape[0] > 0 and \
+                    (slab[:, c].min() < 0 or slab[:, c].max() > 255):
+                raise ValueError(f'Label channel {c} holds values outside of 0 to 255 that do not fit into 8 bit, '
+                                 f'convert the file without rescaling to 8 bit!')
+            # get bounds of the channel, label ids are kept
+            low, high = channel_bounds if channel_bounds is not None else (0, 255)
+            # check if a lookup table can be used
+            if slab.dtype in (np.uint8, np.uint16):
+                # map every possible value once and look up the values of the slab
+                lut = np.clip((np.arange(np.iinfo(slab.dtype).max + 1) - low) * (255 / (high - low)) + 0.5, 0, 255)
+                np.take(lut.astype(np.uint8), slab[:, c], out=out[:, c], mode='clip')
+            else:
+                # scale, clip and round the values of the channel
+                out[:, c] = np.clip((slab[:, c] - low) * (255 / (high - low)) + 0.5, 0, 255)
+
+
+def get_intensity_bounds(f, channel_list, metadata_dict, rescale=None, rescale_level=None, time_point=0):
+    """
+    Estimates the intensity bounds for rescaling to 8 bit and records them in the metadata dictionary, so the original
+    intensities can be restored approximately (value = low + value_8bit * (high - low) / 255). Must be called before
+    the metadata is cropped to a region of interest, the bounds always refer to the whole image.
+
+    :param f: opened Imaris ims file (h5py.File)
+    :param channel_list: list of channel group names (list)
+    :param metadata_dict: dictionary with the metadata of the image, updated in place (dict)
+    :param rescale: lower and upper percentile that are mapped to 0 and 255, if None no bounds are estimated (tuple)
+    :param rescale_level: resolution level the percentiles are computed on, if None it is selected automatically (int)
+    :param time_point: index of the time point the percentiles are computed on (int)
+    :return: list of [low, high] bounds or None for each channel, None if the image is not rescaled (list)
+    """
+    # check if the image should be rescaled
+    if rescale is None:
+        return None
+    # estimate bounds on a coarse resolution level
+    with profile_stage('estimate_intensity_bounds'):
+        bounds, level = estimate_intensity_bounds(f, channel_list, metadata_dict['channel_names'],
+                                                  metadata_dict['image_size'], rescale, rescale_level, time_point)
+    # record bounds, percentiles and level in the metadata
+    metadata_dict['intensity_bounds'] = bounds
+    metadata_dict['intensity_percentiles'] = list(rescale)
+    metadata_dict['intensity_level'] = level
+    # return bounds
+    return bounds
+
+
+def iterate_ims_level_pages(channel_datasets, level_size, n_planes, slab_size=16, executor=None,
+                            intensity_bounds=None):
+    """
+    Generator that yields the 2D (Y,X) pages of a resolution level in ZCYX order for n_planes Z planes. OME TIFF
+    pyramids need the same number of planes in every level, so if Imaris reduced the number of Z planes at this level,
+    each plane is repeated for the full resolution planes it covers (nearest plane, no resampling).
+
+    :param channel_datasets: list of 3D (Z,Y,X) channel datasets of the resolution level (list of h5py.Dataset)
+    :param level_size: dictionary with the image size of the resolution level in X, Y and Z (dict)
+    :param n_planes: number of Z planes of the full resolution image (int)
+    :param slab_size: number of Z planes that are read at once (int)
+    :param executor: thread pool for the threaded chunk reader, if None the data is read with h5py (ThreadPoolExecutor)
+    :param intensity_bounds: list of [low, high] bounds or None for each channel for rescaling to 8 bit, see
+                             estimate_intensity_bounds (list)
+    :return: iterator of 2D pages (numpy.ndarray)
+    """
+    # allocate slab buffer that is reused for all slabs
+    buffer = np.empty((min(slab_size, level_size['Z']), len(channel_datasets), level_size['Y'], level_size['X']),
+                      dtype=channel_datasets[0].dtype)
+    # allocate 8 bit slab buffer if the slabs are rescaled
+    output_buffer = buffer if intensity_bounds is None else np.empty(buffer.shape, dtype=np.uint8)
+    # initialize Z range of the slab that is currently held in the buffer
+    z_start, z_stop = 0, 0
+    # iterate Z planes of the full resolution image
+    for z in range(n_planes):
+        # get corresponding Z plane of the resolution level
+        z_level = z * level_size['Z'] // n_planes
+        # check if the plane is not in the current slab
+        if not z_start <= z_level < z_stop:
+            # read the next slab starting at this plane
+            z_start, z_stop = z_level, min(z_level + slab_size, level_size['Z'])
+            read_ims_slab_into_buffer(channel_datasets, buffer, z_start, z_stop, level_size, executor)
+            # rescale slab to 8 bit
+            if intensity_bounds is not None:
+                rescale_slab_to_uint8(buffer[:z_stop - z_start], intensity_bounds, output_buffer[:z_stop - z_start])
+        # yield pages of all channels of the plane
+        yield from output_buffer[z_level - z_start]
+
+
+def get_ome_metadata(metadata_dict):
+    """
+    Translates the metadata dictionary of the converter into OME metadata as expected by tifffile's OME-XML writer.
+
+    :param metadata_dict: dictionary with the metadata of the image (dict)
+    :return: OME metadata (dict)
+    """
+    # initialize OME metadata with axes and channel names
+    ome_metadata = {'axes': metadata_dict['axes'],
+                    'Channel': {'Name': metadata_dict['channel_names']}}
+    # add physical voxel size of all dimensions
+    for d in 'XYZ':
+        ome_metadata[f'PhysicalSize{d}'] = metadata_dict['voxel_size'][d]
+        ome_metadata[f'PhysicalSize{d}Unit'] = 'µm'
+    # store the intensity bounds of rescaled images in the description
+    if 'intensity_bounds' in metadata_dict:
+        ome_metadata['Description'] = json.dumps({k: metadata_dict[k] for k in ('intensity_bounds',
+                                                                                'intensity_percentiles',
+                                                                                'intensity_level')})
+    # return OME metadata
+    return ome_metadata
+
+
+def read_image_from_ims_file(path_to_ims_file, backend='h5py', n_threads=None, time_point=0, roi=None,
+                             roi_unit='voxel', channel_selection=None, rescale=None, rescale_level=None,
+                             slab_size=16):
+    """
+    Reads image data together with relevant metadata from an Imaris ims file and returns the image data together
+    with the extracted metadata. The image data is read into a single preallocated, C-contiguous ZCYX array, so no
+    intermediate copies are made and the padding of the Imaris chunks is never read. If the image is rescaled to 8 bit,
+    it is read slab by slab and each slab is rescaled into the 8 bit array, so the full image is never held in its
+    original bit depth.
+
+    :param path_to_ims_file: path to the ims file from which the data should be extracted (string)
+    :param backend: 'h5py' for reading with h5py or 'threaded' for decoding the chunks in a thread pool (string)
+    :param n_threads: number of threads of the 'threaded' backend, if None the number of CPUs is used (int)
+    :param time_point: index of the time point that should be read (int)
+    :param roi: region of interest with (start, stop) ranges for 'Z', 'Y' and/or 'X', only the chunks that overlap the
+                region are read (dict)
+    :param roi_unit: unit of the region of interest, either 'voxel' or 'micron' (string)
+    :param channel_selection: list of channel names or mapping of channels and labels of interest, only the selected
+                              channels are read, see resolve_channel_selection (list or dict)
+    :param rescale: lower and upper percentile that are mapped to 0 and 255 for rescaling to 8 bit, if None the
+                    original bit depth is kept (tuple)
+    :param rescale_level: resolution level the percentiles are computed on, if None it is selected automatically (int)
+    :param slab_size: number of Z planes that are read and rescaled at once when rescaling (int)
+    :return: image_data_array (numpy.ndarray), metadata_dict (dict)
+    """
+    # print status message
+    print(f'Read "{path_to_ims_file}" ...')
+    # open ims file
+    with h5py.File(path_to_ims_file, 'r') as f, create_reader_executor(backend, n_threads) as executor:
+        # read list of channels and metadata
+        channel_list, metadata_dict = read_metadata_from_ims_file(f, path_to_ims_file, channel_selection)
+        # get datasets of all channels
+        channel_datasets = get_ims_channel_datasets(f, channel_list, time_point=time_point)
+        # get intensity bounds on the whole image if the image should be rescaled to 8 bit
+        bounds = get_intensity_bounds(f, channel_list, metadata_dict, rescale, rescale_level, time_point)
+        # crop metadata to the region of interest
+        offset = apply_roi_to_metadata(metadata_dict, roi, roi_unit)
+        # read image size from metadata
+        image_size = metadata_dict['image_size']
+
+        # preallocate a single contiguous ZCYX array for the whole image
+        image_data_array = np.empty((image_size['Z'], len(channel_datasets), image_size['Y'], image_size['X']),
+                                    dtype=channel_datasets[0].dtype if bounds is None else np.uint8)
+        # check if the image is read in its original bit depth
+        if bounds is None:
+            # read the valid hyperslab of every channel straight into its slot of the ZCYX array
+            read_ims_slab_into_buffer(channel_datasets, image_data_array, 0, image_size['Z'], image_size, executor,
+                                      offset)
+        else:
+            # allocate slab buffer that is reused for all slabs
+            buffer = np.empty((min(slab_size, image_size['Z']),) + image_data_array.shape[1:],
+                              dtype=channel_datasets[0].dtype)
+            # iterate slabs
+            for z_start in range(0, image_size['Z'], slab_size):
+                # get end of current slab
+                z_stop = min(z_start + slab_size, image_size['Z'])
+                # read the slab and rescale it into the 8 bit array
+                read_ims_slab_into_buffer(channel_datasets, buffer, z_start, z_stop, image_size, executor, offset)
+                rescale_slab_to_uint8(buffer[:z_stop - z_start], bounds, image_data_array[z_start:z_stop])
+
+    # return image data array and dictionary with relevant metadata
+    return image_data_array, metadata_dict
+
+
+def select_resampling_resolution_level(voxel_size, level_sizes, target_spacing, tolerance=DEFAULT_SPACING_TOLERANCE):
+    """
+    Selects the resolution level an image is read from when it is resampled to the target spacing. The coarsest level
+    whose voxel size, directly or downsampled by integer factors, matches the target spacing within the tolerance is
+    selected, so the least data is read. Imaris computes its levels itself, a level that matches the target spacing
+    directly is used without any resampling. If no level matches, the full resolution is downsampled by the factors
+    that come closest to the target spacing.
+
+    :param voxel_size: dictionary with the voxel size of the full resolution in X, Y and Z (dict)
+    :param level_sizes: list of image size dictionaries of the resolution levels, see read_ims_resolution_level_sizes
+                        (list)
+    :param target_spacing: target spacing in the order (Z,Y,X) (list)
+    :param tolerance: accepted relative deviation from the target spacing (float)
+    :return: resolution level (int), factors in the order (Z,Y,X) (tuple of int), resulting spacing in the order
+             (Z,Y,X) (list), True if the spacing matches the target within the tolerance (bool)
+    """
+    # iterate levels from coarse to fine
+    for level in reversed(range(len(level_sizes))):
+        # get voxel size of the level in order (Z,Y,X), all levels cover the same metrical extent
+        level_voxel_size = [voxel_size[d] * level_sizes[0][d] / level_sizes[level][d] for d in 'ZYX']
+        # get factors that bring the voxel size of the level to the target spacing
+        factors, spacing, is_matching = get_resampling_factors(level_voxel_size, target_spacing, tolerance)
+        # check if the level matches the target spacing
+        if is_matching:
+            return level, factors, spacing, True
+    # downsample the full resolution as close to the target spacing as possible
+    return (0,) + get_resampling_factors([voxel_size[d] for d in 'ZYX'], target_spacing, tolerance)
+
+
+def read_resampled_image_from_ims_file(path_to_ims_file, target_spacing, backend='h5py', n_threads=None, time_point=0,
+                                       channel_selection=None, rescale=None, rescale_level=None, slab_size=16,
+                                       label_channel_names=(), label_kernel='majority',
+                                       tolerance=DEFAULT_SPACING_TOLERANCE):
+    """
+    Reads an image from an Imaris ims file at the target spacing, see select_resampling_resolution_level. The selected
+    resolution level is read slab by slab and every slab is downsampled into the returned array, intensity channels by
+    the mean and label channels by the majority or the center voxel of each block, so the image is never held at the
+    finer spacing. The voxel size, image size and origin in the returned metadata refer to the resampled image.
+
+    :param path_to_ims_file: path to the ims file from which the data should be extracted (string)
+    :param target_spacing: target spacing in the order (Z,Y,X) (list)
+    :param backend: 'h5py' for reading with h5py or 'threaded' for decoding the chunks in a thread pool (string)
+    :param n_threads: number of threads of the 'threaded' backend, if None the number of CPUs is used (int)
+    :param time_point: index of the time point that should be read (int)
+    :param channel_selection: list of channel names or mapping of channels and labels of interest, only the selected
+                              channels are read, see resolve_channel_selection (list or dict)
+    :param rescale: lower and upper percentile that are mapped to 0 and 255 for rescaling to 8 bit, if None the
+                    original bit depth is kept (tuple)
+    :param rescale_level: resolution level the percentiles are computed on, if None it is selected automatically (int)
+    :param slab_size: number of Z planes that are read at once, rounded up to a multiple of the Z factor (int)
+    :param label_channel_names: names of the channels that are resampled with the label kernel (list)
+    :param label_kernel: 'majority' or 'nearest' (string)
+    :param tolerance: accepted relative deviation from the target spacing (float)
+    :return: image_data_array (numpy.ndarray), metadata_dict (dict)
+    """
+    # print status message
+    print(f'Read "{path_to_ims_file}" at spacing {list(target_spacing)} ...')
+    # open ims file
+    with h5py.File(path_to_ims_file, 'r') as f, create_reader_executor(backend, n_threads) as executor:
+        # read list of channels and metadata
+        channel_list, metadata_dict = read_metadata_from_ims_file(f, path_to_ims_file, channel_selection)
+        # read sizes of all resolution levels
+        level_sizes = read_ims_resolution_level_sizes(f, channel_list, metadata_dict['image_size'])
+        # select resolution level and factors
+        level, factors, spacing, is_matching = select_resampling_resolution_level(metadata_dict['voxel_size'],
+                                                                                  level_sizes, target_spacing,
+                                                                                  tolerance)
+        # print status message if the target spacing can not be met by whole voxels
+        if not is_matching:
+            print(f'Spacing {list(target_spacing)} is not reached by whole voxels, resampled to {spacing}!')
+        # get datasets of all channels at the selected level
+        channel_datasets = get_ims_channel_datasets(f, channel_list, level, time_point)
+        # get intensity bounds on the whole image if the image should be rescaled to 8 bit
+        bounds = get_intensity_bounds(f, channel_list, metadata_dict, rescale, rescale_level, time_point)
+        # get size of the selected level and of the resampled image
+        level_size = level_sizes[level]
+        resampled_shape = get_resampled_shape([level_size[d] for d in 'ZYX'], factors)
+        resampled_size = {d: resampled_shape['ZYX'.index(d)] for d in 'XYZ'}
+        # get indices of the label channels
+        label_channels = [c for c, n in enumerate(metadata_dict['channel_names']) if n in label_channel_names]
+
+        # preallocate a single contiguous ZCYX array for the resampled image
+        dtype = channel_datasets[0].dtype if bounds is None else np.uint8
+        image_data_array = np.empty((resampled_size['Z'], len(channel_datasets), resampled_size['Y'],
+                                     resampled_size['X']), dtype=dtype)
+        # get number of Z planes of a slab, so no block is split between two slabs
+        slab_size = min(get_resampling_slab_size(slab_size, factors[0]), level_size['Z'])
+        # allocate slab buffer that is reused for all slabs and an 8 bit buffer if the slabs are rescaled
+        buffer = np.empty((slab_size, len(channel_datasets), level_size['Y'], level_size['X']),
+                          dtype=channel_datasets[0].dtype)
+        output_buffer = buffer if bounds is None else np.empty(buffer.shape, dtype=np.uint8)
+        # iterate slabs
+        for z_start in range(0, level_size['Z'], slab_size):
+            # get end of current slab
+            z_stop = min(z_start + slab_size, level_size['Z'])
+            # read the slab and rescale it to 8 bit
+            read_ims_slab_into_buffer(channel_datasets, buffer, z_start, z_stop, level_size, executor)
+            if bounds is not None:
+                rescale_slab_to_uint8(buffer[:z_stop - z_start], bounds, output_buffer[:z_stop - z_start])
+            # get planes of the slab in the resampled image
+            resampled_z_start, resampled_z_stop = z_start // factors[0], -(-z_stop // factors[0])
+            # resample the slab into its planes of the resampled image
+            with profile_stage('resample') as stage:
+                stage['bytes_read'] = output_buffer[:z_stop - z_start].nbytes
+                stage['bytes_written'] = image_data_array[resampled_z_start:resampled_z_stop].nbytes
+                resample_slab(output_buffer[:z_stop - z_start], factors,
+                              image_data_array[resampled_z_start:resampled_z_stop], label_channels, label_kernel)
+
+    # update origin, image size and voxel size to the resampled image, the first voxel is centered on the first block
+    resampled_origin = get_resampled_origin([metadata_dict['origin'][d] for d in 'ZYX'],
+                                            [s / n for s, n in zip(spacing, factors)],
+                                            [level_size[d] for d in 'ZYX'], factors)
+    metadata_dict['origin'] = {d: resampled_origin['ZYX'.index(d)] for d in 'XYZ'}
+    metadata_dict['image_size'] = resampled_size
+    metadata_dict['slices'] = resampled_size['Z']
+    metadata_dict['voxel_size'] = {d: spacing['ZYX'.index(d)] for d in 'XYZ'}
+    # record the resolution level and the factors the image was resampled from
+    metadata_dict['resolution_level'] = level
+    metadata_dict['resampling_factors'] = list(factors)
     # return image data array and dictionary with relevant metadata
     return image_data_array, metadata_dict
 
 
+# candidate codecs and levels that are compared when the compression is selected automatically
+COMPRESSION_CANDIDATES = [(None, None), ('zlib', 1), ('zlib', 6), ('zstd', 1), ('zstd', 3), ('zstd', 9), ('lzw', None)]
+
+
+def get_tifffile_write_arguments(tiff_options=None):
+    """
+    Translates the TIFF output options of the converter into keyword arguments of tifffile.imwrite.
+
+    :param tiff_options: dictionary with the optional keys 'compression' (None, 'zlib', 'zstd' or 'lzw'),
+                         'compression_level' (int), 'tile' ((Y, X) tuple), 'predictor' (bool) and 'n_write_threads'
+                         (number of threads that encode tiles or strips in parallel) (dict)
+    :return: keyword arguments for tifffile.imwrite (dict)
+    """
+    # use uncompressed contiguous output if no options are passed
+    if not tiff_options:
+        return {}
+
+    # initialize empty dict for the tifffile arguments
+    write_arguments = {}
+    # check if the output should be compressed
+    if tiff_options.get('compression') not in (None, 'none'):
+        # set codec
+        write_arguments['compression'] = tiff_options['compression']
+        # set compression level if passed
+        if tiff_options.get('compression_level') is not None:
+            write_arguments['compressionargs'] = {'level': tiff_options['compression_level']}
+        # set horizontal differencing predictor if requested
+        if tiff_options.get('predictor'):
+            write_arguments['predictor'] = True
+    # check if the output should be tiled
+    if tiff_options.get('tile'):
+        write_arguments['tile'] = tuple(tiff_options['tile'])
+    # set number of threads that encode tiles or strips in parallel
+    if tiff_options.get('n_write_threads'):
+        write_arguments['maxworkers'] = tiff_options['n_write_threads']
+    # return tifffile arguments
+    return write_arguments
+
+
+def iterate_tiles(pages, tile):
+    """
+    Generator that splits the passed 2D pages into tiles in the order tifffile expects them. Incomplete tiles at the
+    right and bottom border are zero-padded by tifffile.
+
+    :param pages: iterator of 2D pages (numpy.ndarray)
+    :param tile: tile shape (Y, X) (tuple)
+    :return: iterator of 2D tiles (numpy.ndarray)
+    """
+    # iterate pages
+    for page in pages:
+        # iterate tile rows and columns
+        for y in range(0, page.shape[0], tile[0]):
+            for x in range(0, page.shape[1], tile[1]):
+                # yield tile
+                yield page[y:y + tile[0], x:x + tile[1]]
+
+
+def get_tiff_segments(pages, write_arguments):
+    """
+    Returns the data of streamed pages in the segments tifffile expects, tiles for tiled output and whole pages
+    otherwise. Compressed segments are encoded in a thread pool unless maxworkers is 1, tifffile then takes several
+    segments from the iterator before it encodes them. The page generators reuse their slab buffers, so in that case
+    each segment is copied before the next slab is read into the buffer it points to.
+
+    :param pages: iterator of 2D pages that may be views into reused buffers (numpy.ndarray)
+    :param write_arguments: keyword arguments for tifffile, see get_tifffile_write_arguments (dict)
+    :return: iterator of 2D pages or tiles (numpy.ndarray)
+    """
+    # split pages into tiles for tiled output
+    segments = iterate_tiles(pages, write_arguments['tile']) if 'tile' in write_arguments else pages
+    # check if tifffile may encode the segments in parallel
+    if 'compression' in write_arguments and write_arguments.get('maxworkers') != 1:
+        # copy each segment, so it stays valid while it waits for encoding
+        return (segment.copy() for segment in segments)
+    # return segments unchanged
+    return segments
+
+
+def benchmark_tiff_compression(sample_array, candidates=COMPRESSION_CANDIDATES, tiff_options=None,
+                               write_bandwidth=200):
+    """
+    Encodes the passed sample array with each candidate codec and level and measures the encoding throughput and the
+    compression ratio. Based on these values the time for encoding and writing one GB of raw data is estimated, where
+    the writing time is the compressed size divided by the passed write bandwidth of the target filesystem.
+
+    :param sample_array: representative sample of the image data (numpy.ndarray)
+    :param candidates: list of (codec, level) tuples that should be compared (list)
+    :param tiff_options: further TIFF output options (tile, predictor, n_write_threads) (dict)
+    :param write_bandwidth: write bandwidth of the target filesystem in MB/s (float)
+    :return: list of result dicts sorted by the estimated time per GB, fastest first (list)
+    """
+    # initialize empty list for results
+    results = []
+    # iterate candidate codecs and levels
+    for compression, compression_level in candidates:
+        # get tifffile arguments for current candidate
+        write_arguments = get_tifffile_write_arguments({**(tiff_options or {}),
+                                                        'compression': compression,
+                                                        'compression_level': compression_level})
+        # encode sample into memory and measure the time
+        buffer = io.BytesIO()
+        start_time = time.perf_counter()
+        tifffile.imwrite(buffer, sample_array, **write_arguments)
+        encoding_time = max(time.perf_counter() - start_time, 1e-9)
+
+        # calculate compression ratio and encoding throughput
+        ratio = sample_array.nbytes / buffer.getbuffer().nbytes
+        encoding_throughput = sample_array.nbytes / 1024 ** 2 / encoding_time
+        # add results of current candidate
+        results.append({'compression': compression,
+                        'compression_level': compression_level,
+                        'ratio': ratio,
+                        'encoding_throughput': encoding_throughput,
+                        'seconds_per_gb': 1024 / encoding_throughput + 1024 / ratio / write_bandwidth})
+
+    # return results sorted by estimated time per GB
+    return sorted(results, key=lambda result: result['seconds_per_gb'])
+
+
+def select_tiff_compression(path_to_ims_file, tiff_options=None, write_bandwidth=200, sample_size=8,
+                            channel_selection=None):
+    """
+    Selects the codec and level with the best throughput/size trade-off for the passed ims file. A slab from the
+    middle of the volume is used as sample and encoded with all candidates of COMPRESSION_CANDIDATES, the candidate with
+    the shortest estimated time for encoding and writing is returned.
+
+    :param path_to_ims_file: path to the ims file (string)
+    :param tiff_options: further TIFF output options (tile, predictor, n_write_threads) (dict)
+    :param write_bandwidth: write bandwidth of the target filesystem in MB/s (float)
+    :param sample_size: number of Z planes of the sample slab (int)
+    :param channel_selection: list of channel names or mapping of channels and labels of interest, only the selected
+                              channels are read, see resolve_channel_selection (list or dict)
+    :return: compression (string or None), compression_level (int or None)
+    """
+    # open ims file
+    with h5py.File(path_to_ims_file, 'r') as f:
+        # read list of channels and metadata
+        channel_list, metadata_dict = read_metadata_from_ims_file(f, path_to_ims_file, channel_selection)
+        # get datasets of all channels
+        channel_datasets = get_ims_channel_datasets(f, channel_list)
+        # read image size from metadata
+        image_size = metadata_dict['image_size']
+
+        # get Z range of the sample slab in the middle of the volume
+        z_start = max(0, (image_size['Z'] - sample_size) // 2)
+        z_stop = min(z_start + sample_size, image_size['Z'])
+        # read sample slab
+        sample_array = np.empty((z_stop - z_start, len(channel_datasets), image_size['Y'], image_size['X']),
+                                dtype=channel_datasets[0].dtype)
+        read_ims_slab_into_buffer(channel_datasets, sample_array, z_start, z_stop, image_size)
+
+    # compare candidates on the sample slab
+    with profile_stage('select_compression', file=path_to_ims_file) as stage:
+        results = benchmark_tiff_compression(sample_array, tiff_options=tiff_options, write_bandwidth=write_bandwidth)
+        stage['bytes_read'] = sample_array.nbytes
+    # print status message
+    print(f'Selected compression {results[0]["compression"]} (level {results[0]["compression_level"]}, '
+          f'ratio {results[0]["ratio"]:.2f}) for "{path_to_ims_file}"!')
+    # return codec and level of the fastest candidate
+    return results[0]['compression'], results[0]['compression_level']
+
+
+def add_time_points_to_metadata(metadata_dict, time_points):
+    """
+    Updates the axes and frames of the metadata dictionary for writing the passed time points. A single time point is
+    written as ZCYX hyperstack and its index is recorded, several time points are written as TZCYX hyperstack.
+
+    :param metadata_dict: dictionary with the metadata of the image, updated in place (dict)
+    :param time_points: list of time point indices that are written (list)
+    :return: leading (T,Z) or (Z,) part of the shape of the written image (tuple)
+    """
+    # check if a single time point is written
+    if len(time_points) == 1:
+        # record the index of the written time point
+        metadata_dict['time_point'] = time_points[0]
+        # return shape of the Z dimension
+        return (metadata_dict['image_size']['Z'],)
+
+    # update axes and add number of frames
+    metadata_dict['axes'] = 'TZCYX'
+    metadata_dict['axes_info'] = 'TZCYX'
+    metadata_dict['frames'] = len(time_points)
+    # add frame interval if known
+    if metadata_dict['time_interval'] is not None:
+        metadata_dict['finterval'] = metadata_dict['time_interval']
+    # return shape of the T and Z dimensions
+    return len(time_points), metadata_dict['image_size']['Z']
+
+
+def stream_ims_to_ome_tiff_file(path_to_ims_file, path_to_new_ome_file, slab_size=16, backend='h5py',
+                                n_threads=None, tiff_options=None, time_points=None, roi=None, roi_unit='voxel',
+                                channel_selection=None, rescale=None, rescale_level=None, read_ahead=1):
+    """
+    Converts an Imaris ims file into an OME TIFF file without loading the whole volume into memory. Z slabs of all
+    channels are read from the ims file and appended as pages in ZCYX order, so the peak memory usage stays near the
+    size of read_ahead + 1 slabs independent of the size of the volume. The next slabs are read while the current one is
+    written, so reading and writing overlap. If several time points are passed, they are written one after another into
+    a TZCYX hyperstack.
+
+    :param path_to_ims_file: path to the ims file that should be converted (string)
+    :param path_to_new_ome_file: path of the OME TIFF file that should be written (string)
+    :param slab_size: number of Z planes that are read and written at once (int)
+    :param backend: 'h5py' for reading with h5py or 'threaded' for decoding the chunks in a thread pool (string)
+    :param n_threads: number of threads of the 'threaded' backend, if None the number of CPUs is used (int)
+    :param tiff_options: compression, tiling and encoding options of the TIFF output, see get_tifffile_write_arguments
+                         (dict)
+    :param time_points: list of time point indices that should be written, if None only time point 0 is written (list)
+    :param roi: region of interest with (start, stop) ranges for 'Z', 'Y' and/or 'X', only the chunks that overlap the
+                region are read (dict)
+    :param roi_unit: unit of the region of interest, either 'voxel' or 'micron' (string)
+    :param channel_selection: list of channel names or mapping of channels and labels of interest, only the selected
+                              channels are read, see resolve_channel_selection (list or dict)
+    :param rescale: lower and upper percentile that are mapped to 0 and 255 for rescaling each slab to 8 bit, if None
+                    the original bit depth is kept (tuple)
+    :param rescale_level: resolution level the percentiles are computed on, if None it is selected automatically (int)
+    :param read_ahead: number of slabs that are read ahead of the slab that is written, 0 reads and writes one after
+                       another (int)
+    :return: metadata_dict (dict)
+    """
+    # get tifffile arguments for compression and tiling
+    write_arguments = get_tifffile_write_arguments(tiff_options)
+    # write only the first time point if no time points are passed
+    time_points = time_points or [0]
+    # print status message
+    print(f'Stream "{path_to_ims_file}" ...')
+    # open ims file
+    with h5py.File(path_to_ims_file, 'r') as f, create_reader_executor(backend, n_threads) as executor:
+        # read list of channels and metadata
+        channel_list, metadata_dict = read_metadata_from_ims_file(f, path_to_ims_file, channel_selection)
+        # get intensity bounds on the whole image if the slabs should be rescaled to 8 bit
+        bounds = get_intensity_bounds(f, channel_list, metadata_dict, rescale, rescale_level, time_points[0])
+        # crop metadata to the region of interest
+        offset = apply_roi_to_metadata(metadata_dict, roi, roi_unit)
+        # add time points to metadata
+        shape = add_time_points_to_metadata(metadata_dict, time_points)
+        # read image size from metadata
+        image_size = metadata_dict['image_size']
+
+        # read pages of the ims file slab by slab, one time point after another
+        pages = (page for t in time_points
+                 for page in iterate_ims_pages(get_ims_channel_datasets(f, channel_list, time_point=t), image_size,
+                                               slab_size, executor, offset, bounds, read_ahead))
+        # get shape and data type of the written image
+        shape = shape + (len(channel_list), image_size['Y'], image_size['X'])
+        dtype = get_ims_channel_datasets(f, channel_list[:1])[0].dtype if bounds is None else np.dtype(np.uint8)
+        # measure the write as a stage, the slab reads or, with read-ahead, the waits for the reader thread are measured
+        # as nested stages
+        with profile_stage('write_ome_tiff', file=path_to_ims_file) as stage:
+            # write pages into the ome tiff file, tiled output expects the pages split into tiles
+            tifffile.imwrite(path_to_new_ome_file,
+                             get_tiff_segments(pages, write_arguments),
+                             shape=shape,
+                             dtype=dtype,
+                             imagej=True,
+                             metadata=metadata_dict,
+                             **write_arguments)
+            # count the uncompressed image bytes and the bytes of the file
+            stage['bytes_written'] = math.prod(shape) * dtype.itemsize
+            stage['file_bytes'] = os.path.getsize(path_to_new_ome_file)
+
+    # return metadata dict
+    return metadata_dict
+
+
+def stream_ims_to_pyramidal_ome_tiff_file(path_to_ims_file, path_to_new_ome_file, slab_size=16, backend='h5py',
+                                          n_threads=None, tiff_options=None, n_levels=None, time_points=None,
+                                          channel_selection=None, rescale=None, rescale_level=None):
+    """
+    Converts an Imaris ims file into a multi-resolution OME TIFF file. The full resolution image is written as main
+    series and each resolution level that is already stored in the ims file is copied into the SubIFDs of the pages, so
+    the pyramid only costs I/O and no downsampling is computed. Like stream_ims_to_ome_tiff_file, all levels are
+    streamed slab by slab.
+
+    :param path_to_ims_file: path to the ims file that should be converted (string)
+    :param path_to_new_ome_file: path of the OME TIFF file that should be written (string)
+    :param slab_size: number of Z planes that are read and written at once (int)
+    :param backend: 'h5py' for reading with h5py or 'threaded' for decoding the chunks in a thread pool (string)
+    :param n_threads: number of threads of the 'threaded' backend, if None the number of CPUs is used (int)
+    :param tiff_options: compression, tiling and encoding options of the TIFF output, see get_tifffile_write_arguments
+                         (dict)
+    :param n_levels: maximal number of resolution levels including the full resolution, if None all levels are used
+                     (int)
+    :param time_points: list of time point indices that should be written, if None only time point 0 is written (list)
+    :param channel_selection: list of channel names or mapping of channels and labels of interest, only the selected
+                              channels are read, see resolve_channel_selection (list or dict)
+    :param rescale: lower and upper percentile that are mapped to 0 and 255 for rescaling all levels to 8 bit, if None
+                    the original bit depth is kept (tuple)
+    :param rescale_level: resolution level the percentiles are computed on, if None it is selected automatically (int)
+    :return: metadata_dict (dict)
+    """
+    # get tifffile arguments for compression and tiling
+    write_arguments = get_tifffile_write_arguments(tiff_options)
+    # write only the first time point if no time points are passed
+    time_points = time_points or [0]
+    # print status message
+    print(f'Stream "{path_to_ims_file}" into pyramid ...')
+    # open ims file
+    with h5py.File(path_to_ims_file, 'r') as f, create_reader_executor(backend, n_threads) as executor:
+        # read list of channels and metadata
+        channel_list, metadata_dict = read_metadata_from_ims_file(f, path_to_ims_file, channel_selection)
+        # get intensity bounds if all levels should be rescaled to 8 bit
+        bounds = get_intensity_bounds(f, channel_list, metadata_dict, rescale, rescale_level, time_points[0])
+        # read image size of all resolution levels
+        level_sizes = read_ims_resolution_level_sizes(f, channel_list, metadata_dict['image_size'])[:n_levels]
+        # add number of resolution levels to metadata
+        metadata_dict['resolution_levels'] = len(level_sizes)
+        # add time points to metadata
+        shape = add_time_points_to_metadata(metadata_dict, time_points)
+
+        # open ome tiff file and measure the write as a stage, the slab reads are measured as nested stages
+        with tifffile.TiffWriter(path_to_new_ome_file, bigtiff=True, ome=True) as tif, \
+                profile_stage('write_ome_tiff_pyramid', file=path_to_ims_file) as stage:
+            # iterate resolution levels
+            for level, level_size in enumerate(level_sizes):
+                # read pages of the level slab by slab, one time point after another
+                pages = (page for t in time_points
+                         for page in iterate_ims_level_pages(get_ims_channel_datasets(f, channel_list, level, t),
+                                                             level_size, level_sizes[0]['Z'], slab_size, executor,
+                                                             bounds))
+                # get shape and data type of the level
+                level_shape = shape + (len(channel_list), level_size['Y'], level_size['X'])
+                dtype = get_ims_channel_datasets(f, channel_list[:1], level)[0].dtype if bounds is None \
+                    else np.dtype(np.uint8)
+                # write the full resolution as main series and the other levels as SubIFDs
+                tif.write(get_tiff_segments(pages, write_arguments),
+                          shape=level_shape,
+                          dtype=dtype,
+                          **({'subifds': len(level_sizes) - 1, 'metadata': get_ome_metadata(metadata_dict)}
+                             if level == 0 else {'subfiletype': 1, 'metadata': None}),
+                          **write_arguments)
+                # count the uncompressed image bytes of the level
+                stage['bytes_written'] += math.prod(level_shape) * dtype.itemsize
+
+    # return metadata dict
+    return metadata_dict
+
+
+# default options of the OME-Zarr output, chunk shape in order (Z,Y,X)
+DEFAULT_ZARR_OPTIONS = {'chunks': (32, 256, 256), 'compressor': 'zlib', 'compression_level': None,
+                        'n_write_threads': None}
+
+
+def get_zarr_options(zarr_options=None):
+    """
+    Completes the passed OME-Zarr options with the default options.
+
+    :param zarr_options: chunk shape, compressor, compression level and number of write threads of the OME-Zarr output,
+                         missing options are set to their default (dict)
+    :return: complete OME-Zarr options (dict)
+    """
+    return {**DEFAULT_ZARR_OPTIONS, **(zarr_options or {})}
+
+
+def stream_ims_to_ome_zarr(path_to_ims_file, path_to_zarr, backend='h5py', n_threads=None, zarr_options=None,
+                           n_levels=None, time_point=0, channel_selection=None, rescale=None, rescale_level=None):
+    """
+    Converts an Imaris ims file into an OME-Zarr (NGFF v0.4) store with one CZYX array per resolution level. Like the
+    pyramidal OME TIFF, the levels are copied from the ims file, so no downsampling is computed. Each level is read in
+    Z slabs of one chunk row, and the chunks of a slab are encoded and written in a thread pool while the next slab is
+    read into a second buffer. The peak memory usage is thus about two chunk rows of all channels.
+
+    :param path_to_ims_file: path to the ims file that should be converted (string)
+    :param path_to_zarr: path of the OME-Zarr store that should be written (string)
+    :param backend: 'h5py' for reading with h5py or 'threaded' for decoding the chunks in a thread pool (string)
+    :param n_threads: number of threads of the 'threaded' backend, if None the number of CPUs is used (int)
+    :param zarr_options: chunk shape, compressor, compression level and number of write threads, see
+                         DEFAULT_ZARR_OPTIONS (dict)
+    :param n_levels: maximal number of resolution levels including the full resolution, if None all levels are used
+                     (int)
+    :param time_point: index of the time point that should be written (int)
+    :param channel_selection: list of channel names or mapping of channels and labels of interest, only the selected
+                              channels are read, see resolve_channel_selection (list or dict)
+    :param rescale: lower and upper percentile that are mapped to 0 and 255 for rescaling all levels to 8 bit, if None
+                    the original bit depth is kept (tuple)
+    :param rescale_level: resolution level the percentiles are computed on, if None it is selected automatically (int)
+    :return: metadata_dict (dict)
+    """
+    # complete the options and get the compressor configuration
+    zarr_options = get_zarr_options(zarr_options)
+    compressor = get_zarr_compressor(zarr_options['compressor'], zarr_options['compression_level'])
+    # print status message
+    print(f'Stream "{path_to_ims_file}" into OME-Zarr ...')
+    # open ims file, create the reader executor and the thread pool for the chunk writes
+    with h5py.File(path_to_ims_file, 'r') as f, create_reader_executor(backend, n_threads) as executor, \
+            ThreadPoolExecutor(max_workers=zarr_options['n_write_threads'] or os.cpu_count()) as writer:
+        # read list of channels and metadata
+        channel_list, metadata_dict = read_metadata_from_ims_file(f, path_to_ims_file, channel_selection)
+        # get intensity bounds if all levels should be rescaled to 8 bit
+        bounds = get_intensity_bounds(f, channel_list, metadata_dict, rescale, rescale_level, time_point)
+        # read image size of all resolution levels
+        level_sizes = read_ims_resolution_level_sizes(f, channel_list, metadata_dict['image_size'])[:n_levels]
+        # add number of resolution levels and the written time point to metadata
+        metadata_dict['resolution_levels'] = len(level_sizes)
+        add_time_points_to_metadata(metadata_dict, [time_point])
+
+        # measure the write as a stage, the slab reads are measured as nested stages
+        with profile_stage('write_ome_zarr', file=path_to_ims_file) as stage:
+            # iterate resolution levels
+            for level, level_size in enumerate(level_sizes):
+                # get channel datasets, data type and shape of the level
+                channel_datasets = get_ims_channel_datasets(f, channel_list, level, time_point)
+                dtype = channel_datasets[0].dtype if bounds is None else np.dtype(np.uint8)
+                shape = (len(channel_list), level_size['Z'], level_size['Y'], level_size['X'])
+                # create the array of the level, the channels are chunked one by one
+                path_to_array = os.path.join(path_to_zarr, str(level))
+                zarray = create_zarr_array(path_to_array, shape, (1,) + tuple(zarr_options['chunks']), dtype,
+                                           compressor)
+                # read one chunk row per slab, so every chunk is written at once
+                slab_size = zarray['chunks'][1]
+                # allocate two slab buffers, one is read while the chunks of the other one are written
+                buffers = [np.empty((slab_size, len(channel_list), level_size['Y'], level_size['X']),
+                                    dtype=channel_datasets[0].dtype) for _ in range(2)]
+                # allocate two 8 bit slab buffers if the slabs are rescaled
+                output_buffers = buffers if bounds is None else [np.empty(b.shape, dtype=np.uint8) for b in buffers]
+                # initialize empty lists for the chunk writes of both buffers
+                pending_writes = [[], []]
+                # iterate slabs
+                for i, z_start in enumerate(range(0, level_size['Z'], slab_size)):
+                    # get end of current slab
+                    z_stop = min(z_start + slab_size, level_size['Z'])
+                    # wait until the chunks of the buffer are written and raise possible errors
+                    for future in pending_writes[i % 2]:
+                        future.result()
+                    # read all channels of the current slab
+                    read_ims_slab_into_buffer(channel_datasets, buffers[i % 2], z_start, z_stop, level_size, executor)
+                    # rescale slab to 8 bit
+                    if bounds is not None:
+                        rescale_slab_to_uint8(buffers[i % 2][:z_stop - z_start], bounds,
+                                              output_buffers[i % 2][:z_stop - z_start])
+                    # encode and write the chunks of the slab in the thread pool
+                    pending_writes[i % 2] = submit_zarr_slab(path_to_array, zarray,
+                                                             output_buffers[i % 2][:z_stop - z_start], z_start,
+                                                             writer)
+                    # count the uncompressed image bytes of the slab
+                    stage['bytes_written'] += output_buffers[i % 2][:z_stop - z_start].nbytes
+                # wait until all chunks of the level are written and raise possible errors
+                for future in pending_writes[0] + pending_writes[1]:
+                    future.result()
+
+        # write the multiscales metadata after all levels are complete
+        write_ome_zarr_group(path_to_zarr, get_ome_zarr_attributes(metadata_dict, level_sizes,
+                                                                   os.path.basename(path_to_ims_file)))
+
+    # return metadata dict
+    return metadata_dict
+
+
 def save_ome_tiff_file(image_data_array,
                        metadata_dict,
                        path_to_new_ome_file,
                        default_prefix='image_',
-                       default_suffix='ome.tif'):
+                       default_suffix='ome.tif',
+                       tiff_options=None):
     """
     Saves passed image and metadata as OME TIFF file. If a directory is passed es destination for saving the image,
     images are stored in consecutive order (dafault_prefix_{number}.default_suffix), if filename is passed image is
@@ -86,6 +1298,8 @@ def save_ome_tiff_file(image_data_array,
     :param path_to_new_ome_file: path to a directory or file name (string)
     :param default_prefix: (string) if not passed default value 'image' is used
     :param default_suffix: (string) if not passed default value 'ome.tif' is used
+    :param tiff_options: compression, tiling and encoding options of the TIFF output, see get_tifffile_write_arguments
+                         (dict)
     """
 
     # check if axis is defined in metadata_dict
@@ -120,27 +1334,1172 @@ def save_ome_tiff_file(image_data_array,
         path_to_new_ome_file = os.path.join(path_to_new_ome_file, new_filename)
 
     # save the image data array as ome-tiff file
-    tifffile.imwrite(path_to_new_ome_file,
-                     image_data_array,
-                     shape=image_data_array.shape,
-                     imagej=True,
-                     metadata=metadata_dict)
+    write_ome_tiff_file(image_data_array, metadata_dict, path_to_new_ome_file, tiff_options)
     # print status message
     print(f'Saved file at {path_to_new_ome_file}!')
 
 
+def write_ome_tiff_file(image_data_array, metadata_dict, path_to_new_ome_file, tiff_options=None):
+    """
+    Writes passed image and metadata into an OME TIFF file at the passed path without printing a status message.
+
+    :param image_data_array: array with the image pixel data (numpy.ndarray)
+    :param metadata_dict: dictionary with all necessary metadata for the passed image, including the axes (dict)
+    :param path_to_new_ome_file: path of the OME TIFF file (string)
+    :param tiff_options: compression, tiling and encoding options of the TIFF output, see get_tifffile_write_arguments
+                         (dict)
+    """
+    # measure the write as a stage, it covers the TIFF encoding
+    with profile_stage('write_ome_tiff', file=path_to_new_ome_file) as stage:
+        # save the image data array as ome-tiff file
+        tifffile.imwrite(path_to_new_ome_file,
+                         image_data_array,
+                         shape=image_data_array.shape,
+                         imagej=True,
+                         metadata=metadata_dict,
+                         **get_tifffile_write_arguments(tiff_options))
+        # count the uncompressed image bytes and the bytes of the file
+        stage['bytes_written'] = image_data_array.nbytes
+        stage['file_bytes'] = os.path.getsize(path_to_new_ome_file)
+
+
+def get_temporary_file_path(path_to_file):
+    """
+    Returns the temporary path a file is written to before it is atomically renamed to its final path. Temporary files
+    are placed in a hidden '.partial' subdirectory of the target directory, so they are on the same filesystem as the
+    target and an interrupted conversion never leaves an incomplete file that looks valid behind.
+
+    :param path_to_file: final path of the file (string)
+    :return: temporary path of the file (string)
+    """
+    # get hidden subdirectory for incomplete files
+    path_to_partial_directory = os.path.join(os.path.dirname(os.path.abspath(path_to_file)), '.partial')
+    # check if subdirectory exists, if not create it
+    os.makedirs(path_to_partial_directory, exist_ok=True)
+    # return temporary path with the same file name
+    return os.path.join(path_to_partial_directory, os.path.basename(path_to_file))
+
+
+def remove_partial_directory(path_to_directory):
+    """
+    Removes the hidden '.partial' subdirectory of an output directory if it is empty, it is kept as long as it holds
+    files of running or interrupted conversions.
+
+    :param path_to_directory: path to the output directory (string)
+    """
+    try:
+        # remove subdirectory, fails if it does not exist or is not empty
+        os.rmdir(os.path.join(os.path.abspath(path_to_directory), '.partial'))
+    except OSError:
+        pass
+
+
+def convert_ims_file(path_to_ims_file, path_to_new_ome_file, stream=False, slab_size=16, backend='h5py',
+                     n_threads=None, tiff_options=None, write_bandwidth=200, pyramid=False, n_levels=None,
+                     time_points='first', roi=None, roi_unit='voxel', channel_selection=None, rescale=None,
+                     rescale_level=None, output_format='ome_tiff', zarr_options=None, read_ahead=1, image=None,
+                     strategy=None, max_memory=None):
+    """
+    Converts a single Imaris ims file into an OME TIFF file, either in memory or in streaming mode, or into an OME-Zarr
+    store.
+
+    :param path_to_ims_file: path to the ims file that should be converted (string)
+    :param path_to_new_ome_file: path of the OME TIFF file that should be written (string)
+    :param stream: if True the file is converted slab by slab with bounded memory (bool)
+    :param slab_size: number of Z planes that are read and written at once in streaming mode (int)
+    :param backend: 'h5py' for reading with h5py or 'threaded' for decoding the chunks in a thread pool (string)
+    :param n_threads: number of threads of the 'threaded' backend, if None the number of CPUs is used (int)
+    :param tiff_options: compression, tiling and encoding options of the TIFF output, see get_tifffile_write_arguments,
+                         with compression 'auto' the codec and level are selected on a sample of the file (dict)
+    :param write_bandwidth: write bandwidth of the target filesystem in MB/s, used for the 'auto' compression (float)
+    :param pyramid: if True a multi-resolution OME TIFF is written from the resolution levels of the ims file (bool)
+    :param n_levels: maximal number of resolution levels of the pyramid, if None all levels are used (int)
+    :param time_points: 'first' for converting only the first time point, 'all' for streaming all time points into a
+                        TZCYX hyperstack or 'split' for writing one file per time point (<name>_t0000.ome.tif, ...)
+                        (string)
+    :param roi: region of interest with (start, stop) ranges for 'Z', 'Y' and/or 'X' (dict)
+    :param roi_unit: unit of the region of interest, either 'voxel' or 'micron' (string)
+    :param channel_selection: list of channel names or mapping of channels and labels of interest, only the selected
+                              channels are read, see resolve_channel_selection (list or dict)
+    :param rescale: lower and upper percentile that are mapped to 0 and 255 for rescaling to 8 bit, if None the
+                    original bit depth is kept (tuple)
+    :param rescale_level: resolution level the percentiles are computed on, if None it is selected automatically (int)
+    :param output_format: 'ome_tiff' or 'ome_zarr', OME-Zarr stores always hold the resolution levels of the ims file
+                          up to n_levels (string)
+    :param zarr_options: chunk shape, compressor, compression level and number of write threads of the OME-Zarr
+                         output, see DEFAULT_ZARR_OPTIONS (dict)
+    :param read_ahead: number of slabs that are read ahead of the slab that is written in streaming mode (int)
+    :param image: tuple of image data array and metadata dict as returned by read_image_from_ims_file with the same
+                  options, if passed it is written instead of reading the image again in memory mode (tuple)
+    :param strategy: 'auto', 'memory', 'stream' or 'tiled' for selecting the strategy of OME TIFF conversions within
+                     max_memory, see select_conversion_strategy, tiles are written into separate files
+                     (<name>_y00000_x00000.ome.tif, ...), if None the stream option decides (string)
+    :param max_memory: memory budget in bytes for selecting the strategy, if None the physical memory is used (int)
+    :return: list of paths to the written files (list)
+    """
+    # check if the output format is unknown
+    if output_format not in ('ome_tiff', 'ome_zarr'):
+        raise ValueError(f'Unknown output format "{output_format}", use either "ome_tiff" or "ome_zarr"!')
+    # check if a region of interest is requested for a pyramid
+    if (pyramid or output_format == 'ome_zarr') and roi and any(roi.values()):
+        raise ValueError('Regions of interest are not supported for pyramidal and OME-Zarr output!')
+    # check if several time points should be written into a single OME-Zarr store
+    if output_format == 'ome_zarr' and time_points == 'all':
+        raise ValueError('OME-Zarr stores hold a single time point, use time points "first" or "split"!')
+    # get file ending of the output files
+    file_ending = '.ome.zarr' if output_format == 'ome_zarr' else '.ome.tif'
+
+    # check if codec and level should be selected automatically
+    if output_format == 'ome_tiff' and tiff_options and tiff_options.get('compression') == 'auto':
+        # select codec and level on a sample of the file
+        compression, compression_level = select_tiff_compression(path_to_ims_file, tiff_options, write_bandwidth,
+                                                                 channel_selection=channel_selection)
+        tiff_options = {**tiff_options, 'compression': compression, 'compression_level': compression_level}
+
+    # initialize regions of interest of the tiles, the whole region is converted at once if it is not tiled
+    tiles = None
+    # check if the strategy should be selected within the memory budget
+    if strategy is not None and output_format == 'ome_tiff' and not pyramid:
+        # select strategy and get the tiles of the tiled strategy
+        plan = select_conversion_strategy(path_to_ims_file, max_memory, slab_size, roi, roi_unit, channel_selection,
+                                          read_ahead, strategy)
+        stream, tiles = stream or plan['strategy'] == 'stream', plan['tiles']
+        # print status message
+        print(f'Convert "{path_to_ims_file}" with strategy {plan["strategy"]} '
+              f'({plan["memory"][plan["strategy"]] / 1024 ** 2:.1f} MB)!')
+
+    # check if only the first time point should be converted
+    if time_points == 'first':
+        # convert first time point into the passed file
+        output_files = [(path_to_new_ome_file, [0])]
+    else:
+        # read indices of all time points
+        with h5py.File(path_to_ims_file, 'r') as f:
+            all_time_points = get_ims_time_points(f)
+        # check if all time points should be written into a single file
+        if time_points == 'all':
+            output_files = [(path_to_new_ome_file, all_time_points)]
+        # check if one file per time point should be written
+        elif time_points == 'split':
+            output_files = [(f'{path_to_new_ome_file[:-len(file_ending)]}_t{t:04d}{file_ending}', [t])
+                            for t in all_time_points]
+        else:
+            raise ValueError(f'Unknown time point mode "{time_points}", use "first", "all" or "split"!')
+
+    # add the region of interest of each output file, tiled output gets one file per tile
+    output_files = [(output_file_path, output_time_points, roi, roi_unit)
+                    for output_file_path, output_time_points in output_files] if tiles is None else \
+        [(f'{output_file_path[:-len(file_ending)]}_y{tile["Y"][0]:05d}_x{tile["X"][0]:05d}{file_ending}',
+          output_time_points, tile, 'voxel')
+         for output_file_path, output_time_points in output_files for tile in tiles]
+
+    # iterate output files, the time points and the region they hold
+    for output_file_path, output_time_points, output_roi, output_roi_unit in output_files:
+        # get temporary path the file is written to before it is renamed to its final name
+        temporary_file_path = get_temporary_file_path(output_file_path)
+        # remove a store that was left behind by an interrupted conversion
+        if os.path.isdir(temporary_file_path):
+            shutil.rmtree(temporary_file_path)
+        try:
+            # measure the whole conversion of the output file as a stage
+            with profile_stage('convert_ims', file=path_to_ims_file):
+                # check if an OME-Zarr store should be written
+                if output_format == 'ome_zarr':
+                    # stream all resolution levels chunk row by chunk row from the ims file into the store
+                    stream_ims_to_ome_zarr(path_to_ims_file, temporary_file_path, backend, n_threads, zarr_options,
+                                           n_levels, output_time_points[0], channel_selection, rescale,
+                                           rescale_level)
+                # check if a multi-resolution file should be written
+                elif pyramid:
+                    # stream all resolution levels slab by slab from the ims file into the ome tiff file
+                    stream_ims_to_pyramidal_ome_tiff_file(path_to_ims_file, temporary_file_path, slab_size, backend,
+                                                          n_threads, tiff_options, n_levels, output_time_points,
+                                                          channel_selection, rescale, rescale_level)
+                # check if the file should be converted in streaming mode, several time points and tiles are always
+                # streamed
+                elif stream or len(output_time_points) > 1 or tiles is not None:
+                    # stream data slab by slab from the ims file into the ome tiff file
+                    stream_ims_to_ome_tiff_file(path_to_ims_file, temporary_file_path, slab_size, backend, n_threads,
+                                                tiff_options, output_time_points, output_roi, output_roi_unit,
+                                                channel_selection, rescale, rescale_level, read_ahead)
+                else:
+                    # read image from ims file if it was not read ahead
+                    data_array, metadata_dict = image or read_image_from_ims_file(path_to_ims_file, backend,
+                                                                                  n_threads, output_time_points[0],
+                                                                                  roi, roi_unit, channel_selection,
+                                                                                  rescale, rescale_level, slab_size)
+                    # record the index of the written time point
+                    add_time_points_to_metadata(metadata_dict, output_time_points)
+                    # write data to ome tiff file
+                    write_ome_tiff_file(data_array, metadata_dict, temporary_file_path, tiff_options)
+        except BaseException:
+            # remove the incomplete file or store
+            if os.path.isdir(temporary_file_path):
+                shutil.rmtree(temporary_file_path)
+            elif os.path.exists(temporary_file_path):
+                os.remove(temporary_file_path)
+            raise
+        # remove a store of a previous conversion, directories can not be replaced by a rename
+        if os.path.isdir(output_file_path):
+            shutil.rmtree(output_file_path)
+        # atomically move the complete file to its final name
+        os.replace(temporary_file_path, output_file_path)
+        # print status message
+        print(f'Saved {"OME-Zarr store" if output_format == "ome_zarr" else "file"} at {output_file_path}!')
+    # return paths to the written files
+    return [output_file_path for output_file_path, _, _, _ in output_files]
+
+
+def find_ims_files(path_to_directory, recursive=False):
+    """
+    Returns a sorted list of all Imaris ims files in the passed directory and, if requested, in all of its
+    subdirectories.
+
+    :param path_to_directory: path to the directory that should be searched (string)
+    :param recursive: if True subdirectories are searched as well (bool)
+    :return: list of paths to ims files (list)
+    """
+    # check if subdirectories should be searched as well
+    if not recursive:
+        # read all ims files from the passed directory
+        return sorted(os.path.join(path_to_directory, f) for f in os.listdir(path_to_directory) if f.endswith('.ims'))
+
+    # initialize empty list for ims files
+    ims_file_list = []
+    # walk directory tree
+    for root, _, files in os.walk(path_to_directory):
+        # add all ims files of the current directory
+        ims_file_list.extend(os.path.join(root, f) for f in files if f.endswith('.ims'))
+    # return sorted list of ims files
+    return sorted(ims_file_list)
+
+
+def get_available_memory():
+    """
+    Returns the physical memory of the machine in bytes.
+
+    :return: physical memory in bytes (int)
+    """
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def estimate_conversion_memory(path_to_ims_file, stream=False, slab_size=16, roi=None, roi_unit='voxel',
+                               channel_selection=None, output_format='ome_tiff', zarr_options=None, read_ahead=1):
+    """
+    Estimates the peak memory that is needed for converting the passed ims file. Only the metadata of the file is read,
+    the estimate is based on the image size, the number of channels and the data type.
+
+    :param path_to_ims_file: path to the ims file (string)
+    :param stream: if True the estimate refers to the streaming mode (bool)
+    :param slab_size: number of Z planes that are read at once in streaming mode (int)
+    :param roi: region of interest with (start, stop) ranges for 'Z', 'Y' and/or 'X' (dict)
+    :param roi_unit: unit of the region of interest, either 'voxel' or 'micron' (string)
+    :param channel_selection: list of channel names or mapping of channels and labels of interest, only the selected
+                              channels are read, see resolve_channel_selection (list or dict)
+    :param output_format: 'ome_tiff' or 'ome_zarr', OME-Zarr stores are always streamed with two chunk rows (string)
+    :param zarr_options: OME-Zarr options with the chunk shape, see DEFAULT_ZARR_OPTIONS (dict)
+    :param read_ahead: number of slabs that are read ahead of the written slab in streaming mode (int)
+    :return: estimated peak memory in bytes (int)
+    """
+    # open ims file
+    with h5py.File(path_to_ims_file, 'r') as f:
+        # read list of channels and metadata
+        channel_list, metadata_dict = read_metadata_from_ims_file(f, path_to_ims_file, channel_selection)
+        # crop metadata to the region of interest
+        apply_roi_to_metadata(metadata_dict, roi, roi_unit)
+        # read data type of the first channel
+        itemsize = get_ims_channel_datasets(f, channel_list[:1])[0].dtype.itemsize
+
+    # read image size from metadata
+    image_size = metadata_dict['image_size']
+    # get number of Z planes that are held in memory at once
+    if output_format == 'ome_zarr':
+        # two slabs of one chunk row each are held by the double buffering
+        n_planes = 2 * min(get_zarr_options(zarr_options)['chunks'][0], image_size['Z'])
+    else:
+        n_planes = (read_ahead + 1) * min(slab_size, image_size['Z']) if stream else image_size['Z']
+    # return size of the buffer that holds all channels of these planes
+    return n_planes * len(channel_list) * image_size['Y'] * image_size['X'] * itemsize
+
+
+def estimate_conversion_memory_from_options(path_to_ims_file, conversion_options, max_memory=None):
+    """
+    Estimates the peak memory that is needed for converting the passed ims file with the passed conversion options, see
+    estimate_conversion_memory. If a strategy is passed, the memory of the strategy that is selected within the memory
+    budget is returned, see select_conversion_strategy.
+
+    :param path_to_ims_file: path to the ims file (string)
+    :param conversion_options: keyword arguments that are passed to convert_ims_file (dict)
+    :param max_memory: memory budget in bytes for selecting the strategy (int)
+    :return: estimated peak memory in bytes (int)
+    """
+    # get output format
+    output_format = conversion_options.get('output_format', 'ome_tiff')
+    # check if the strategy is selected within the budget
+    if conversion_options.get('strategy') and output_format == 'ome_tiff' and not conversion_options.get('pyramid'):
+        # select strategy and return its memory
+        plan = select_conversion_strategy(path_to_ims_file, max_memory, conversion_options.get('slab_size', 16),
+                                          conversion_options.get('roi'), conversion_options.get('roi_unit', 'voxel'),
+                                          conversion_options.get('channel_selection'),
+                                          conversion_options.get('read_ahead', 1), conversion_options['strategy'])
+        return plan['memory'][plan['strategy']]
+    # check if a pyramid is written, it is streamed without reading ahead
+    if output_format == 'ome_tiff' and conversion_options.get('pyramid'):
+        return estimate_conversion_memory(path_to_ims_file, True, conversion_options.get('slab_size', 16),
+                                          channel_selection=conversion_options.get('channel_selection'), read_ahead=0)
+    # return memory of the streamed or in-memory conversion
+    return estimate_conversion_memory(path_to_ims_file, conversion_options.get('stream', False),
+                                      conversion_options.get('slab_size', 16),
+                                      conversion_options.get('roi'),
+                                      conversion_options.get('roi_unit', 'voxel'),
+                                      conversion_options.get('channel_selection'),
+                                      output_format,
+                                      conversion_options.get('zarr_options'),
+                                      conversion_options.get('read_ahead', 1))
+
+
+def select_conversion_strategy(path_to_ims_file, max_memory=None, slab_size=16, roi=None, roi_unit='voxel',
+                               channel_selection=None, read_ahead=1, strategy='auto'):
+    """
+    Selects how an ims file is converted into an OME TIFF file within a memory budget. Only the metadata of the file is
+    read, the peak memory of each strategy follows from the image size, the number of channels and the data type:
+        memory: the whole image is read and then written
+        stream: read_ahead + 1 slabs of all channels are held, see stream_ims_to_ome_tiff_file
+        tiled:  the image is split into regions of interest along Y and X that are streamed one after another into
+                separate files, so even slabs that exceed the budget can be converted
+    All estimates include the scratch buffer the h5py reader reads a chunk row of one channel into. With strategy
+    'auto' the first strategy of this list that fits into the budget is selected.
+
+    :param path_to_ims_file: path to the ims file (string)
+    :param max_memory: memory budget in bytes, if None the physical memory of the machine is used (int)
+    :param slab_size: number of Z planes that are read at once in streaming mode (int)
+    :param roi: region of interest with (start, stop) ranges for 'Z', 'Y' and/or 'X' (dict)
+    :param roi_unit: unit of the region of interest, either 'voxel' or 'micron' (string)
+    :param channel_selection: list of channel names or mapping of channels and labels of interest, only the selected
+                              channels are read, see resolve_channel_selection (list or dict)
+    :param read_ahead: number of slabs that are read ahead of the written slab in streaming mode (int)
+    :param strategy: 'auto', 'memory', 'stream' or 'tiled' (string)
+    :return: dictionary with the selected 'strategy', the estimated peak 'memory' of each strategy in bytes, the
+             voxel regions of the 'tiles' (None if the image is not tiled), the 'image_size' of the converted region,
+             the number of 'channels' and the 'dtype' (dict)
+    """
+    # check if the strategy is unknown
+    if strategy not in ('auto', 'memory', 'stream', 'tiled'):
+        raise ValueError(f'Unknown strategy "{strategy}", use "auto", "memory", "stream" or "tiled"!')
+    # use physical memory as budget if no budget is passed
+    if max_memory is None:
+        max_memory = get_available_memory()
+
+    # open ims file
+    with h5py.File(path_to_ims_file, 'r') as f:
+        # read list of channels and metadata
+        channel_list, metadata_dict = read_metadata_from_ims_file(f, path_to_ims_file, channel_selection)
+        # crop metadata to the region of interest
+        offset = apply_roi_to_metadata(metadata_dict, roi, roi_unit)
+        # read data type and chunk shape of the first channel
+        dataset = get_ims_channel_datasets(f, channel_list[:1])[0]
+        dtype, chunk_z = dataset.dtype, dataset.chunks[0] if dataset.chunks else metadata_dict['image_size']['Z']
+    # read image size from metadata
+    image_size = metadata_dict['image_size']
+
+    # get number of planes of the scratch buffer the h5py reader reads a chunk row of one channel into
+    scratch_planes = min(chunk_z, slab_size, image_size['Z'])
+    # get bytes of one image row of all channels and all planes that are held in streaming mode and of the scratch row
+    row_bytes = ((read_ahead + 1) * min(slab_size, image_size['Z']) * len(channel_list) + scratch_planes) * \
+        image_size['X'] * dtype.itemsize
+    # get number of rows and columns of a tile that fit into the budget, columns are only split if a row does not fit
+    tile_y = int(min(image_size['Y'], max(1, max_memory // row_bytes)))
+    tile_x = image_size['X'] if tile_y > 1 or row_bytes <= max_memory else \
+        int(max(1, max_memory * image_size['X'] // row_bytes))
+    # balance the tile shape, so all tiles have about the same size
+    tile_y = -(-image_size['Y'] // -(-image_size['Y'] // tile_y))
+    tile_x = -(-image_size['X'] // -(-image_size['X'] // tile_x))
+    # estimate peak memory of each strategy
+    memory = {'memory': (image_size['Z'] * len(channel_list) + min(chunk_z, image_size['Z'])) * image_size['Y'] *
+              image_size['X'] * dtype.itemsize,
+              'stream': row_bytes * image_size['Y'],
+              'tiled': row_bytes * tile_y * tile_x // image_size['X']}
+
+    # select the first strategy that fits into the budget
+    if strategy == 'auto':
+        strategy = next((s for s in ('memory', 'stream') if memory[s] <= max_memory), 'tiled')
+    # get regions of interest of the tiles in voxels of the whole image
+    tiles = None
+    if strategy == 'tiled':
+        tiles = [{'Z': (offset['Z'], offset['Z'] + image_size['Z']),
+                  'Y': (y, min(y + tile_y, offset['Y'] + image_size['Y'])),
+                  'X': (x, min(x + tile_x, offset['X'] + image_size['X']))}
+                 for y in range(offset['Y'], offset['Y'] + image_size['Y'], tile_y)
+                 for x in range(offset['X'], offset['X'] + image_size['X'], tile_x)]
+    # return plan
+    return {'strategy': strategy, 'memory': memory, 'tiles': tiles, 'image_size': image_size,
+            'channels': len(channel_list), 'dtype': dtype.name}
+
+
+def measure_conversion_throughput(path_to_ims_file, conversion_options, write_bandwidth=200, sample_size=4,
+                                  sample_width=1024):
+    """
+    Measures the throughput of the single steps of a conversion on a sample of an ims file: a few Z planes of all
+    channels from the middle of the volume, limited to sample_width in Y and X, so the sample stays small for any image
+    size. The sample is read with the configured backend and encoded with the configured codec, the write time follows
+    from the compressed size and the write bandwidth of the target filesystem.
+
+    :param path_to_ims_file: path to the ims file (string)
+    :param conversion_options: keyword arguments that are passed to convert_ims_file (dict)
+    :param write_bandwidth: write bandwidth of the target filesystem in MB/s (float)
+    :param sample_size: number of Z planes of the sample (int)
+    :param sample_width: maximal size of the sample in Y and X (int)
+    :return: dictionary with the 'read_throughput' and 'encoding_throughput' in MB/s of raw data, the compression
+             'ratio' and the used 'compression' and 'compression_level' (dict)
+    """
+    # open ims file
+    with h5py.File(path_to_ims_file, 'r') as f, \
+            create_reader_executor(conversion_options.get('backend', 'h5py'), conversion_options.get('n_threads')) \
+            as executor:
+        # read list of channels and metadata
+        channel_list, metadata_dict = read_metadata_from_ims_file(f, path_to_ims_file,
+                                                                  conversion_options.get('channel_selection'))
+        # get datasets of all channels
+        channel_datasets = get_ims_channel_datasets(f, channel_list)
+        # get size and offset of the sample in the middle of the volume
+        image_size = metadata_dict['image_size']
+        sample_shape = {'Z': min(sample_size, image_size['Z']), 'Y': min(sample_width, image_size['Y']),
+                        'X': min(sample_width, image_size['X'])}
+        offset = {d: (image_size[d] - sample_shape[d]) // 2 for d in 'XYZ'}
+        # read sample and measure the time
+        sample_array = np.empty((sample_shape['Z'], len(channel_list), sample_shape['Y'], sample_shape['X']),
+                                dtype=channel_datasets[0].dtype)
+        start_time = time.perf_counter()
+        read_ims_slab_into_buffer(channel_datasets, sample_array, 0, sample_shape['Z'], sample_shape, executor, offset)
+        read_throughput = sample_array.nbytes / 1024 ** 2 / max(time.perf_counter() - start_time, 1e-9)
+
+    # check if the output is an OME-Zarr store
+    if conversion_options.get('output_format', 'ome_tiff') == 'ome_zarr':
+        # encode the sample as a single chunk with the configured compressor and measure the time
+        zarr_options = get_zarr_options(conversion_options.get('zarr_options'))
+        compressor = get_zarr_compressor(zarr_options['compressor'], zarr_options['compression_level'])
+        start_time = time.perf_counter()
+        encoded_size = len(encode_zarr_chunk(np.ascontiguousarray(sample_array), compressor))
+        encoding_time = max(time.perf_counter() - start_time, 1e-9)
+        result = {'compression': zarr_options['compressor'], 'compression_level': (compressor or {}).get('level'),
+                  'ratio': sample_array.nbytes / encoded_size,
+                  'encoding_throughput': sample_array.nbytes / 1024 ** 2 / encoding_time}
+    else:
+        # encode the sample with the configured codec, all candidates are compared for the 'auto' compression
+        tiff_options = conversion_options.get('tiff_options') or {}
+        candidates = COMPRESSION_CANDIDATES if tiff_options.get('compression') == 'auto' else \
+            [(tiff_options.get('compression'), tiff_options.get('compression_level'))]
+        result = benchmark_tiff_compression(sample_array, candidates, tiff_options, write_bandwidth)[0]
+    # return throughput and compression ratio
+    return {'read_throughput': read_throughput,
+            'encoding_throughput': result['encoding_throughput'],
+            'ratio': result['ratio'],
+            'compression': result['compression'],
+            'compression_level': result['compression_level']}
+
+
+def plan_conversion(path_to_ims_file, conversion_options, max_memory=None, write_bandwidth=200):
+    """
+    Plans the conversion of an ims file without converting it: selects the strategy within the memory budget, see
+    select_conversion_strategy, and estimates the peak memory, the size of the written files and the runtime. The
+    runtime is extrapolated from the throughput of reading, encoding and writing a sample of the file, see
+    measure_conversion_throughput. If reading and writing overlap (streamed with read_ahead > 0), the runtime is given
+    by the slower of both, otherwise by their sum.
+
+    :param path_to_ims_file: path to the ims file (string)
+    :param conversion_options: keyword arguments that are passed to convert_ims_file (dict)
+    :param max_memory: memory budget in bytes, if None the physical memory of the machine is used (int)
+    :param write_bandwidth: write bandwidth of the target filesystem in MB/s (float)
+    :return: plan of the conversion (dict)
+    """
+    # use physical memory as budget if no budget is passed
+    if max_memory is None:
+        max_memory = get_available_memory()
+    # get output format and number of slabs that are read ahead
+    output_format = conversion_options.get('output_format', 'ome_tiff')
+    read_ahead = conversion_options.get('read_ahead', 1)
+
+    # select strategy and estimate the memory of all strategies
+    plan = select_conversion_strategy(path_to_ims_file, max_memory, conversion_options.get('slab_size', 16),
+                                      conversion_options.get('roi'), conversion_options.get('roi_unit', 'voxel'),
+                                      conversion_options.get('channel_selection'), read_ahead,
+                                      conversion_options.get('strategy') or
+                                      ('stream' if conversion_options.get('stream') else 'memory'))
+    # check if the output is always streamed level by level
+    if output_format == 'ome_zarr' or conversion_options.get('pyramid'):
+        # replace the strategy by the output and use its memory estimate
+        plan['strategy'] = output_format if output_format == 'ome_zarr' else 'pyramid'
+        plan['tiles'] = None
+        plan['memory'][plan['strategy']] = estimate_conversion_memory_from_options(path_to_ims_file,
+                                                                                   conversion_options, max_memory)
+
+    # open ims file
+    with h5py.File(path_to_ims_file, 'r') as f:
+        # read list of channels, number of time points and the image size of all resolution levels
+        channel_list, metadata_dict = read_metadata_from_ims_file(f, path_to_ims_file,
+                                                                  conversion_options.get('channel_selection'))
+        n_time_points = 1 if conversion_options.get('time_points', 'first') == 'first' else \
+            len(get_ims_time_points(f))
+        level_sizes = read_ims_resolution_level_sizes(f, channel_list, metadata_dict['image_size'])
+        level_sizes = level_sizes[:conversion_options.get('n_levels')]
+    # several time points in a single file are always streamed
+    if conversion_options.get('time_points') == 'all' and plan['strategy'] == 'memory':
+        plan['strategy'] = 'stream'
+    # get number of voxels that are read relative to the full resolution, pyramids repeat the planes of coarse levels
+    if plan['strategy'] == 'ome_zarr':
+        level_factor = sum(s['X'] * s['Y'] * s['Z'] for s in level_sizes) / math.prod(level_sizes[0].values())
+    elif plan['strategy'] == 'pyramid':
+        level_factor = sum(s['X'] * s['Y'] for s in level_sizes) / (level_sizes[0]['X'] * level_sizes[0]['Y'])
+    else:
+        level_factor = 1
+
+    # measure the throughput of the single steps on a sample
+    throughput = measure_conversion_throughput(path_to_ims_file, conversion_options, write_bandwidth)
+    # get raw bytes that are read and written, rescaled images are written with 8 bit
+    read_bytes = math.prod(plan['image_size'].values()) * plan['channels'] * np.dtype(plan['dtype']).itemsize * \
+        n_time_points * level_factor
+    written_bytes = read_bytes if conversion_options.get('rescale') is None else \
+        read_bytes / np.dtype(plan['dtype']).itemsize
+    # estimate the time of reading, encoding and writing
+    read_time = read_bytes / 1024 ** 2 / throughput['read_throughput']
+    write_time = written_bytes / 1024 ** 2 / throughput['encoding_throughput'] + \
+        written_bytes / throughput['ratio'] / 1024 ** 2 / write_bandwidth
+    # reading and writing overlap in all streamed strategies
+    overlap = read_ahead > 0 and plan['strategy'] in ('stream', 'tiled') or plan['strategy'] == 'ome_zarr'
+
+    # complete the plan
+    plan.update({'file': path_to_ims_file,
+                 'max_memory': max_memory,
+                 'peak_memory': plan['memory'][plan['strategy']],
+                 'fits': plan['memory'][plan['strategy']] <= max_memory,
+                 'output_bytes': int(written_bytes / throughput['ratio']),
+                 'runtime': max(read_time, write_time) if overlap else read_time + write_time,
+                 'throughput': throughput})
+    # return plan
+    return plan
+
+
+def print_conversion_plan(plans):
+    """
+    Prints the plans of a batch conversion as a table, one row per ims file, followed by the totals of the batch.
+
+    :param plans: list of plans, see plan_conversion (list)
+    """
+    # print header
+    print(f'{"file":<40} {"strategy":>9} {"tiles":>6} {"RAM GB":>8} {"budget GB":>10} {"output GB":>10} '
+          f'{"runtime s":>10}')
+    # iterate plans
+    for plan in plans:
+        # print estimates of the file, files that exceed the budget are marked
+        print(f'{os.path.basename(plan["file"])[-40:]:<40} {plan["strategy"]:>9} '
+              f'{len(plan["tiles"]) if plan["tiles"] else 1:>6} '
+              f'{plan["peak_memory"] / 1024 ** 3:>8.2f} {plan["max_memory"] / 1024 ** 3:>10.2f} '
+              f'{plan["output_bytes"] / 1024 ** 3:>10.2f} {plan["runtime"]:>10.1f}'
+              f'{"" if plan["fits"] else "  exceeds budget"}')
+    # print totals of the batch
+    print(f'Total: {len(plans)} files, {sum(p["output_bytes"] for p in plans) / 1024 ** 3:.2f} GB output, '
+          f'{sum(p["runtime"] for p in plans):.1f} s runtime')
+
+
+def convert_ims_files_in_parallel(conversion_jobs, n_jobs, max_memory=None, on_finished=None, claim_job=None,
+                                  on_failed=None, **conversion_options):
+    """
+    Converts several ims files in a process pool. Files are scheduled largest first, so a single huge file does not run
+    alone at the end of the batch. Beside the number of jobs, the concurrency is limited by the estimated memory of the
+    running conversions, a file is only started if its estimate fits into the remaining memory budget. A file that
+    exceeds the budget on its own is converted as soon as no other conversion is running.
+
+    :param conversion_jobs: list of (path_to_ims_file, path_to_new_ome_file) tuples (list)
+    :param n_jobs: maximal number of parallel conversions (int)
+    :param max_memory: memory budget in bytes, if None the physical memory of the machine is used (int)
+    :param on_finished: function that is called with the ims file and the list of written files after each finished
+                        conversion (callable)
+    :param claim_job: function that is called with the ims file right before its conversion is submitted, the file is
+                      skipped if it returns False (callable)
+    :param on_failed: function that is called with the ims file and the error of a failed conversion before the error
+                      is raised (callable)
+    :param conversion_options: keyword arguments that are passed to convert_ims_file
+    """
+    # use physical memory as budget if no budget is passed
+    if max_memory is None:
+        max_memory = get_available_memory()
+
+    # estimate memory of each conversion and sort jobs largest first
+    pending = sorted(((estimate_conversion_memory_from_options(ims_file, conversion_options, max_memory), ims_file,
+                       output_file_path)
+                      for ims_file, output_file_path in conversion_jobs), reverse=True)
+    # initialize dicts for running conversions with their memory estimates and their ims files
+    running = {}
+    submitted = {}
+    # initialize counter for finished conversions
+    n_finished = 0
+
+    # create process pool
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        # iterate until all jobs are submitted and finished
+        while pending or running:
+            # get memory budget that is not used by running conversions
+            free_memory = max_memory - sum(running.values())
+            # iterate pending jobs from largest to smallest and submit every job that fits into the free budget
+            for job in list(pending):
+                # check if all workers are busy
+                if len(running) >= n_jobs:
+                    break
+                # check if job fits into the free memory or if nothing else is running
+                if job[0] <= free_memory or not running:
+                    # skip the job if it can not be claimed
+                    if claim_job is not None and not claim_job(job[1]):
+                        pending.remove(job)
+                        continue
+                    # submit conversion, the stages measured in the worker are returned together with the result
+                    future = executor.submit(run_instrumented, get_instrumentation_configuration(), convert_ims_file,
+                                             job[1], job[2], max_memory=max_memory, **conversion_options)
+                    running[future] = job[0]
+                    submitted[future] = job[1]
+                    free_memory -= job[0]
+                    pending.remove(job)
+
+            # stop if all remaining jobs were skipped
+            if not running:
+                break
+            # wait until at least one conversion is finished
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            # iterate finished conversions
+            for future in done:
+                # release memory of finished conversion and raise possible errors
+                del running[future]
+                n_finished += 1
+                try:
+                    output_files, stage_records = future.result()
+                except BaseException as error:
+                    # report failed conversion
+                    if on_failed is not None:
+                        on_failed(submitted[future], error)
+                    raise
+                # add the stages of the worker to the records of the main process
+                merge_stage_records(stage_records)
+                # report finished conversion or print status message
+                if on_finished is not None:
+                    on_finished(submitted.pop(future), output_files)
+                else:
+                    print(f'[{n_finished}/{len(conversion_jobs)}] Finished conversion into {output_files}!')
+
+
+def is_in_memory_conversion(conversion_options):
+    """
+    Checks if files are converted in memory with the passed conversion options, i.e. the whole image is read before it
+    is written.
+
+    :param conversion_options: keyword arguments that are passed to convert_ims_file (dict)
+    :return: True if the whole image is read into memory (bool)
+    """
+    return (not conversion_options.get('stream', False)
+            and conversion_options.get('strategy') in (None, 'memory')
+            and not conversion_options.get('pyramid', False)
+            and conversion_options.get('time_points', 'first') == 'first'
+            and conversion_options.get('output_format', 'ome_tiff') == 'ome_tiff')
+
+
+def convert_ims_files_read_ahead(conversion_jobs, max_memory=None, on_finished=None, on_failed=None,
+                                 **conversion_options):
+    """
+    Converts several ims files in memory one after another, while the image of the next file is read in a background
+    thread during the write of the current file. Read images are handed over in a queue that holds at most one image.
+    Beside that, an image is only read if the estimated memory of all images that are held fits into the memory budget,
+    a file that exceeds the budget on its own is read as soon as no other image is held. Like this the throughput of
+    the batch approaches the slower one of reading and writing instead of their sum.
+
+    :param conversion_jobs: list of (path_to_ims_file, path_to_new_ome_file) tuples (list)
+    :param max_memory: memory budget in bytes, if None the physical memory of the machine is used (int)
+    :param on_finished: function that is called with the ims file and the list of written files after each finished
+                        conversion (callable)
+    :param on_failed: function that is called with the ims file and the error of a failed conversion before the error
+                      is raised (callable)
+    :param conversion_options: keyword arguments that are passed to convert_ims_file, they must describe an in-memory
+                               conversion, see is_in_memory_conversion
+    """
+    # use physical memory as budget if no budget is passed
+    if max_memory is None:
+        max_memory = get_available_memory()
+
+    # initialize bounded queue for read images, condition for the held memory and event for stopping the reader
+    read_images = queue.Queue(maxsize=1)
+    budget = threading.Condition()
+    held = {'memory': 0}
+    stop = threading.Event()
+
+    def read_images_ahead():
+        # iterate conversion jobs
+        for ims_file, _ in conversion_jobs:
+            # initialize memory of the image
+            memory = 0
+            try:
+                # estimate memory of the image
+                memory = estimate_conversion_memory_from_options(ims_file, conversion_options, max_memory)
+                # wait until the image fits into the budget or no other image is held
+                with budget:
+                    budget.wait_for(lambda: stop.is_set() or held['memory'] == 0
+                                    or held['memory'] + memory <= max_memory)
+                    if stop.is_set():
+                        return
+                    held['memory'] += memory
+                # read image from ims file
+                image = read_image_from_ims_file(ims_file, conversion_options.get('backend', 'h5py'),
+                                                 conversion_options.get('n_threads'), 0,
+                                                 conversion_options.get('roi'),
+                                                 conversion_options.get('roi_unit', 'voxel'),
+                                                 conversion_options.get('channel_selection'),
+                                                 conversion_options.get('rescale'),
+                                                 conversion_options.get('rescale_level'),
+                                                 conversion_options.get('slab_size', 16))
+            except BaseException as error:
+                # hand the error over to the writer
+                read_images.put((None, memory, error))
+                return
+            # hand the image over to the writer, waits while the previous image is not taken
+            read_images.put((image, memory, None))
+
+    # start the reader thread
+    reader = threading.Thread(target=read_images_ahead, daemon=True)
+    reader.start()
+    try:
+        # iterate conversion jobs
+        for i, (ims_file, output_file_path) in enumerate(conversion_jobs):
+            # wait for the image of the file
+            image, memory, error = read_images.get()
+            try:
+                # raise errors of the reader
+                if error is not None:
+                    raise error
+                # write the image that was read ahead
+                output_files = convert_ims_file(ims_file, output_file_path, image=image, max_memory=max_memory,
+                                                **conversion_options)
+            except BaseException as error:
+                # report failed conversion
+                if on_failed is not None:
+                    on_failed(ims_file, error)
+                raise
+            finally:
+                # release the image and its memory
+                image = None
+                with budget:
+                    held['memory'] -= memory
+                    budget.notify_all()
+            # report finished conversion or print status message
+            if on_finished is not None:
+                on_finished(ims_file, output_files)
+            else:
+                print(f'[{i + 1}/{len(conversion_jobs)}] Finished conversion into {output_files}!')
+    finally:
+        # stop the reader and wake it up if it waits for memory
+        stop.set()
+        with budget:
+            budget.notify_all()
+        # take a possibly read image, so the reader is not blocked by the full queue
+        while reader.is_alive():
+            try:
+                read_images.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        reader.join()
+
+
+# conversion options that do not change the written files and are thus ignored by the manifest
+MANIFEST_IGNORED_OPTIONS = {'backend', 'n_threads', 'write_bandwidth'}
+# conversion options that only change the written files if a strategy is selected, as they set the memory per tile
+MANIFEST_STRATEGY_OPTIONS = {'read_ahead', 'slab_size'}
+
+
+def get_file_fingerprint(path_to_file, use_hash=False):
+    """
+    Returns the fingerprint of a file that is used for detecting changes of input files, consisting of size and
+    modification time and, if requested, the SHA-256 hash of the content.
+
+    :param path_to_file: path to the file (string)
+    :param use_hash: if True the SHA-256 hash of the file content is added (bool)
+    :return: fingerprint (dict)
+    """
+    # read size and modification time
+    stat = os.stat(path_to_file)
+    fingerprint = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    # check if the content should be hashed
+    if use_hash:
+        # hash file content block by block
+        sha256 = hashlib.sha256()
+        with open(path_to_file, 'rb') as f:
+            for block in iter(lambda: f.read(16 * 1024 ** 2), b''):
+                sha256.update(block)
+        fingerprint['sha256'] = sha256.hexdigest()
+    # return fingerprint
+    return fingerprint
+
+
+def get_manifest_options(conversion_options):
+    """
+    Returns the conversion options that determine the written files in a JSON compatible form, options that only
+    affect the speed of the conversion are left out. The slab size and read-ahead are kept if a strategy is selected,
+    as the memory they need decides the strategy and the tile layout of tiled conversions.
+
+    :param conversion_options: keyword arguments that are passed to convert_ims_file (dict)
+    :return: conversion options as stored in the manifest (dict)
+    """
+    # remove options that do not change the written files
+    options = {k: v for k, v in conversion_options.items() if k not in MANIFEST_IGNORED_OPTIONS}
+    # remove the options of the OME-Zarr output from OME TIFF conversions, so older manifests stay valid
+    if options.get('output_format', 'ome_tiff') == 'ome_tiff':
+        options.pop('output_format', None)
+        options.pop('zarr_options', None)
+    # remove the memory budget and the options that only set the memory if no strategy is selected within it, so older
+    # manifests stay valid
+    if options.get('strategy') is None:
+        options.pop('strategy', None)
+        options.pop('max_memory', None)
+        options = {k: v for k, v in options.items() if k not in MANIFEST_STRATEGY_OPTIONS}
+    # remove number of encoding threads from the tiff and zarr options
+    for key in ('tiff_options', 'zarr_options'):
+        if options.get(key):
+            options[key] = {k: v for k, v in options[key].items() if k != 'n_write_threads'}
+    # convert tuples to lists by a JSON round trip
+    return json.loads(json.dumps(options))
+
+
+def read_conversion_manifest(path_to_manifest):
+    """
+    Reads the manifest of a batch conversion. The manifest maps the absolute path of each converted ims file to the
+    fingerprint of the file, the conversion options and the written output files.
+
+    :param path_to_manifest: path to the JSON manifest file (string)
+    :return: manifest, empty if the file does not exist (dict)
+    """
+    # return empty manifest if there is no manifest file yet
+    if not os.path.exists(path_to_manifest):
+        return {}
+    # read manifest
+    with open(path_to_manifest, 'r') as f:
+        return json.load(f)
+
+
+def write_conversion_manifest(path_to_manifest, manifest):
+    """
+    Writes the manifest of a batch conversion atomically, so a crash never leaves a truncated manifest behind.
+
+    :param path_to_manifest: path to the JSON manifest file (string)
+    :param manifest: manifest of the batch conversion (dict)
+    """
+    # write manifest to a temporary file
+    with open(f'{path_to_manifest}.tmp', 'w') as f:
+        json.dump(manifest, f, indent=4)
+    # atomically replace the old manifest
+    os.replace(f'{path_to_manifest}.tmp', path_to_manifest)
+
+
+def is_conversion_up_to_date(manifest_entry, fingerprint, manifest_options):
+    """
+    Checks if the output of a previous conversion is up to date, this is the case if the input file did not change,
+    the same conversion options were used and all output files still exist.
+
+    :param manifest_entry: entry of the ims file in the manifest, None if the file was never converted (dict)
+    :param fingerprint: current fingerprint of the ims file (dict)
+    :param manifest_options: current conversion options as stored in the manifest (dict)
+    :return: True if the conversion can be skipped (bool)
+    """
+    return (manifest_entry is not None
+            and manifest_entry.get('state', 'done') == 'done'
+            and manifest_entry['fingerprint'] == fingerprint
+            and manifest_entry['options'] == manifest_options
+            and all(os.path.exists(f) for f in manifest_entry['outputs']))
+
+
+def convert_ims_files(conversion_jobs, conversion_options, n_jobs=1, max_memory=None, path_to_manifest=None,
+                      use_hash=False, force=False, path_to_status_directory=None, claim=False, claim_timeout=None,
+                      input_directory=None):
+    """
+    Converts a batch of ims files, either one after another or in parallel. If a manifest is passed, files that were
+    already converted with the same options and did not change since are skipped and the manifest is updated after
+    each finished file, so an interrupted batch can be resumed.
+
+    Several workers, e.g. on different nodes of a cluster, can share a status directory instead of the manifest. Each
+    input file gets its own status file there, which is written atomically, so workers never overwrite the status of
+    other files. Files whose last conversion failed with the same fingerprint and options are only converted again if
+    force is set. With claim, a worker atomically claims each file right before converting it, so several workers can
+    process the same list of jobs without converting a file twice. Held claims are refreshed four times per claim
+    timeout, so only the claims of crashed workers become stale, no matter how long a conversion takes. Status and
+    claim files are named after the path of the input file relative to the input directory, so workers that mount the
+    shared filesystem at different paths use the same files.
+
+    :param conversion_jobs: list of (path_to_ims_file, path_to_new_ome_file) tuples (list)
+    :param conversion_options: keyword arguments that are passed to convert_ims_file (dict)
+    :param n_jobs: maximal number of parallel conversions (int)
+    :param max_memory: memory budget in bytes for parallel conversions, reading ahead and selecting the strategy (int)
+    :param path_to_manifest: path to the JSON manifest file, if None no manifest is used (string)
+    :param use_hash: if True changes of the input files are detected by their SHA-256 hash as well (bool)
+    :param force: if True all files are converted even if they are up to date (bool)
+    :param path_to_status_directory: path to the status directory shared by several workers, replaces the manifest
+                                     (string)
+    :param claim: if True each file is claimed in the status directory before it is converted (bool)
+    :param claim_timeout: age in seconds after which the claim of a crashed worker is broken, if None claims are never
+                          broken (float)
+    :param input_directory: directory the paths of the status and claim files are taken relative to, if None absolute
+                            paths are used (string)
+    """
+    # check if claims are requested without status directory
+    if claim and not path_to_status_directory:
+        raise ValueError('Claiming files needs a status directory!')
+    # check if status directory exists, if not create it
+    if path_to_status_directory:
+        os.makedirs(path_to_status_directory, exist_ok=True)
+    # read manifest and the options as they are stored in the manifest
+    manifest = read_conversion_manifest(path_to_manifest) if path_to_manifest and not path_to_status_directory else {}
+    manifest_options = get_manifest_options({**conversion_options, 'max_memory': max_memory})
+    # initialize dict for fingerprints of the input files
+    fingerprints = {}
+
+    def get_entry(ims_file):
+        # read the entry of the file from the status directory or from the manifest
+        if path_to_status_directory:
+            return read_conversion_status(path_to_status_directory, ims_file, input_directory)
+        return manifest.get(os.path.abspath(ims_file))
+
+    def record_entry(ims_file, entry):
+        # check if a status directory is used
+        if path_to_status_directory:
+            # write the status of the file
+            write_conversion_status(path_to_status_directory, ims_file, entry, input_directory)
+        # check if a manifest is used
+        elif path_to_manifest:
+            # record the conversion in the manifest and write it
+            manifest[os.path.abspath(ims_file)] = entry
+            write_conversion_manifest(path_to_manifest, manifest)
+
+    def is_skipped(ims_file):
+        # get entry of the file
+        entry = get_entry(ims_file)
+        # check if the conversion is up to date
+        if is_conversion_up_to_date(entry, fingerprints[ims_file], manifest_options):
+            # print status message
+            print(f'Skip "{ims_file}", output is up to date!')
+            return True
+        # check if the last conversion of the file with the same options failed
+        if entry is not None and entry.get('state') == 'failed' and entry['fingerprint'] == fingerprints[ims_file] \
+                and entry['options'] == manifest_options:
+            # print status message
+            print(f'Skip "{ims_file}", conversion failed on {entry["worker"]}: {entry["error"]}')
+            return True
+        return False
+
+    # check if a manifest or a status directory is used
+    if path_to_manifest or path_to_status_directory:
+        # initialize empty list for jobs that are not up to date
+        pending_jobs = []
+        # iterate conversion jobs
+        for ims_file, output_file_path in conversion_jobs:
+            # get fingerprint of the input file
+            fingerprints[ims_file] = get_file_fingerprint(ims_file, use_hash)
+            # check if the conversion can be skipped
+            if force or not is_skipped(ims_file):
+                pending_jobs.append((ims_file, output_file_path))
+        conversion_jobs = pending_jobs
+
+    # start tracking throughput and remaining time of the batch
+    progress = start_progress(len(conversion_jobs), sum(os.path.getsize(f) for f, _ in conversion_jobs))
+    # initialize set of the files this worker holds claims on
+    held_claims = set()
+
+    def release_claim(ims_file):
+        # stop refreshing the claim and release it
+        held_claims.discard(ims_file)
+        release_conversion_claim(path_to_status_directory, ims_file, input_directory)
+
+    def claim_job(ims_file):
+        # claim the file, fails if another worker holds the claim
+        if not claim_conversion(path_to_status_directory, ims_file, claim_timeout, input_directory):
+            return False
+        held_claims.add(ims_file)
+        # check if another worker finished the file after the jobs were filtered
+        if not force and is_skipped(ims_file):
+            release_claim(ims_file)
+            return False
+        # record that the file is converted by this worker
+        record_entry(ims_file, {'state': 'running', 'fingerprint': fingerprints[ims_file], 'options': manifest_options})
+        return True
+
+    def on_finished(ims_file, output_files):
+        # print status message with throughput and estimated remaining time
+        print(update_progress(progress, os.path.getsize(ims_file), f'Finished conversion of "{ims_file}"'))
+        # record the conversion
+        record_entry(ims_file, {'state': 'done', 'fingerprint': fingerprints.get(ims_file),
+                                'options': manifest_options, 'outputs': [os.path.abspath(f) for f in output_files]})
+        # release the claim on the file
+        if claim:
+            release_claim(ims_file)
+
+    def on_failed(ims_file, error):
+        # check if a status directory is used and the conversion failed by itself and was not interrupted
+        if path_to_status_directory and isinstance(error, Exception):
+            # record the failed conversion, so other workers do not repeat it
+            record_entry(ims_file, {'state': 'failed', 'fingerprint': fingerprints[ims_file],
+                                    'options': manifest_options, 'error': repr(error)})
+        # release the claim on the file
+        if claim:
+            release_claim(ims_file)
+
+    # refresh the held claims while converting, so long conversions are not taken for crashed workers
+    stop_heartbeat = start_claim_heartbeat(path_to_status_directory, held_claims, claim_timeout / 4, input_directory) \
+        if claim and claim_timeout is not None else None
+    try:
+        # check if the files should be converted in parallel
+        if n_jobs > 1:
+            # convert files in a process pool with size-aware scheduling
+            convert_ims_files_in_parallel(conversion_jobs, n_jobs, max_memory, on_finished,
+                                          claim_job if claim else None, on_failed, **conversion_options)
+        # check if the next image can be read while the current one is written, claimed files are converted one by one
+        elif not claim and conversion_options.get('read_ahead', 1) > 0 and is_in_memory_conversion(conversion_options) \
+                and len(conversion_jobs) > 1:
+            # convert files one after another with a reader thread that runs one file ahead
+            convert_ims_files_read_ahead(conversion_jobs, max_memory, on_finished, on_failed, **conversion_options)
+        else:
+            # iterate conversion jobs
+            for ims_file, output_file_path in conversion_jobs:
+                # skip the file if it can not be claimed
+                if claim and not claim_job(ims_file):
+                    continue
+                try:
+                    # convert ims file to ome tiff file
+                    output_files = convert_ims_file(ims_file, output_file_path, max_memory=max_memory,
+                                                    **conversion_options)
+                except BaseException as error:
+                    # report failed conversion
+                    on_failed(ims_file, error)
+                    raise
+                on_finished(ims_file, output_files)
+    finally:
+        # stop refreshing claims
+        if stop_heartbeat is not None:
+            stop_heartbeat.set()
+        # remove the subdirectories for incomplete files of the output directories once they are empty, workers that
+        # share a status directory keep them, another worker may be about to write into them
+        if not path_to_status_directory:
+            for path_to_output_directory in {os.path.dirname(os.path.abspath(f)) for _, f in conversion_jobs}:
+                remove_partial_directory(path_to_output_directory)
+
+
 def main():
     # Create the parser object
-    parser = argparse.ArgumentParser(description='Convert Imaris ims files to OME TIFF files')
+    parser = argparse.ArgumentParser(description='Convert Imaris ims files to OME TIFF files or OME-Zarr stores')
 
     # Add arguments for the input path and output directory
     parser.add_argument('-i', '--input', required=True,
                         help='Path to input Imaris ims file or directory')
     parser.add_argument('-o', '--output', required=True,
                         help='Path for storing the generated OME TIFF files')
+    parser.add_argument('-s', '--stream', action='store_true',
+                        help='Stream the conversion slab by slab to keep the memory usage bounded by one slab')
+    parser.add_argument('--slab_size', type=int, default=16,
+                        help='Number of Z planes that are read and written at once in streaming mode (default: 16)')
+    parser.add_argument('--strategy', choices=['auto', 'memory', 'stream', 'tiled'], default=None,
+                        help='Conversion strategy of OME TIFF files: read the whole image, stream it slab by slab or '
+                             'stream regions of interest along Y and X into separate files '
+                             '(<name>_y00000_x00000.ome.tif); "auto" selects the first one that fits into --max_memory '
+                             'for each file (default: memory, or stream with --stream)')
+    parser.add_argument('--plan', action='store_true',
+                        help='Only print the strategy, peak memory, output size and runtime that are estimated for '
+                             'each file and write them to conversion_plan.json in the output directory')
+    parser.add_argument('--read_ahead', type=int, default=1,
+                        help='Number of slabs that are read ahead while the current slab is written in streaming mode; '
+                             'in memory mode the next file is read while the current one is written, as long as both '
+                             'fit into --max_memory. 0 reads and writes one after another (default: 1)')
+    parser.add_argument('-b', '--backend', choices=['h5py', 'threaded'], default='h5py',
+                        help='Reader backend, "threaded" decodes the compressed chunks in a thread pool '
+                             '(default: h5py)')
+    parser.add_argument('-t', '--threads', type=int, default=None,
+                        help='Number of threads of the threaded reader backend (default: number of CPUs)')
+    parser.add_argument('-c', '--compression', choices=['none', 'zlib', 'zstd', 'lzw', 'auto'], default='none',
+                        help='Codec of the OME TIFF files, "auto" selects codec and level with the best '
+                             'throughput/size trade-off on a sample of each file (default: none)')
+    parser.add_argument('--compression_level', type=int, default=None,
+                        help='Compression level of the zlib, gzip and zstd codecs (default: codec default)')
+    parser.add_argument('--tile', type=int, nargs=2, default=None, metavar=('Y', 'X'),
+                        help='Write tiled OME TIFF files with the passed tile shape')
+    parser.add_argument('--predictor', action='store_true',
+                        help='Apply the horizontal differencing predictor before compression')
+    parser.add_argument('--write_threads', type=int, default=None,
+                        help='Number of threads that encode tiles, strips or OME-Zarr chunks in parallel (default: '
+                             'tifffile default, number of CPUs for OME-Zarr)')
+    parser.add_argument('--write_bandwidth', type=float, default=200,
+                        help='Write bandwidth of the output filesystem in MB/s, used by the "auto" compression '
+                             '(default: 200)')
+    parser.add_argument('--output_format', choices=['ome_tiff', 'ome_zarr'], default='ome_tiff',
+                        help='Write OME TIFF files or OME-Zarr (NGFF v0.4) stores with the resolution levels of the '
+                             'ims file (default: ome_tiff)')
+    parser.add_argument('--zarr_chunks', type=int, nargs=3, default=list(DEFAULT_ZARR_OPTIONS['chunks']),
+                        metavar=('Z', 'Y', 'X'),
+                        help='Chunk shape of the OME-Zarr arrays, each channel is chunked separately (default: 32 256 '
+                             '256)')
+    parser.add_argument('--zarr_compressor', choices=['zlib', 'gzip', 'zstd', 'none'], default='zlib',
+                        help='Compressor of the OME-Zarr chunks, --compression_level and --write_threads apply as well '
+                             '(default: zlib)')
+    parser.add_argument('-p', '--pyramid', action='store_true',
+                        help='Write multi-resolution OME TIFF files with the resolution levels of the ims file as '
+                             'SubIFDs')
+    parser.add_argument('--pyramid_levels', type=int, default=None,
+                        help='Maximal number of resolution levels of the pyramid (default: all levels)')
+    parser.add_argument('--time_points', choices=['first', 'all', 'split'], default='first',
+                        help='Convert only the first time point, stream all time points into a TZCYX hyperstack or '
+                             'write one file per time point (default: first)')
+    parser.add_argument('--z_range', type=float, nargs=2, default=None, metavar=('START', 'STOP'),
+                        help='Convert only the passed Z range of the image (region of interest)')
+    parser.add_argument('--y_range', type=float, nargs=2, default=None, metavar=('START', 'STOP'),
+                        help='Convert only the passed Y range of the image (region of interest)')
+    parser.add_argument('--x_range', type=float, nargs=2, default=None, metavar=('START', 'STOP'),
+                        help='Convert only the passed X range of the image (region of interest)')
+    parser.add_argument('--roi_unit', choices=['voxel', 'micron'], default='voxel',
+                        help='Unit of the region of interest ranges, microns refer to the metrical coordinates of '
+                             'the ims file (default: voxel)')
+    parser.add_argument('--channels', nargs='+', default=None, metavar='NAME',
+                        help='Convert only the channels with the passed names (default: all channels)')
+    parser.add_argument('-u', '--unify', action='store_true',
+                        help='Convert only the channels and labels of interest defined in ome_tiff_unify_channels and '
+                             'give them their unified names')
+    parser.add_argument('--to_uint8', action='store_true',
+                        help='Rescale each channel to 8 bit between intensity percentiles that are estimated on a '
+                             'coarse resolution level, label channels of --unify are kept')
+    parser.add_argument('--percentiles', type=float, nargs=2, default=[0.1, 99.9], metavar=('LOW', 'HIGH'),
+                        help='Percentiles that are mapped to 0 and 255 by --to_uint8 (default: 0.1 99.9)')
+    parser.add_argument('--percentile_level', type=int, default=None,
+                        help='Resolution level the percentiles are computed on (default: coarsest level with at least '
+                             '2^20 voxels)')
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help='Search the input directory recursively for ims files')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of ims files that are converted in parallel (default: 1)')
+    parser.add_argument('--max_memory', type=float, default=None,
+                        help='Memory budget in GB for parallel conversions and for reading ahead (default: physical '
+                             'memory)')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Convert all files, even if the manifest shows that their output is up to date')
+    parser.add_argument('--manifest_hash', action='store_true',
+                        help='Detect changed input files by their SHA-256 hash in addition to size and modification '
+                             'time')
+    parser.add_argument('--shard', default=None, metavar='I/N',
+                        help='Convert only the I-th of N disjoint shards of the input files (I counts from 0), e.g. '
+                             'the index of an array job; the files are sorted by relative path and dealt out '
+                             'round-robin')
+    parser.add_argument('--claim', action='store_true',
+                        help='Claim each file with a lock file in the status directory right before converting it, so '
+                             'several workers can share the same input files without converting a file twice')
+    parser.add_argument('--claim_timeout', type=float, default=None,
+                        help='Age in hours after which the claim of a crashed worker is broken, running workers '
+                             'refresh their claims four times per timeout (default: never)')
+    parser.add_argument('--status_dir', default=None,
+                        help='Status directory shared by several workers, used instead of the manifest with --shard '
+                             'and --claim (default: <output>/conversion_status)')
+    # add arguments for profiling the processing stages
+    add_instrumentation_arguments(parser)
 
     # Parse the arguments
     args = parser.parse_args()
+    # enable the instrumentation if requested
+    configure_instrumentation_from_arguments(args)
 
     # check if output directory exists, if not create it
     if not os.path.exists(args.output):
@@ -150,20 +2509,97 @@ def main():
     if os.path.isfile(args.input):
         # if it belongs to a file create a file list with this single entry
         ims_file_list = [args.input]
+        # set input directory for relative output paths
+        input_directory = os.path.dirname(os.path.abspath(args.input))
     else:
         # read all ims files from the passed directory
-        ims_file_list = [os.path.join(args.input, f) for f in os.listdir(args.input) if f.endswith('.ims')]
+        ims_file_list = find_ims_files(args.input, args.recursive)
+        # set input directory for relative output paths
+        input_directory = os.path.abspath(args.input)
 
+    # get file ending of the output files
+    file_ending = 'ome.zarr' if args.output_format == 'ome_zarr' else 'ome.tif'
+    # initialize empty list for conversion jobs
+    conversion_jobs = []
     # iterate ims file list
     for ims_file in ims_file_list:
-        # read image from ims file
-        data_array, metadata_dict = read_image_from_ims_file(ims_file)
-        # generate output path to the new ome tiff file
-        output_file_path = os.path.join(args.output, f"{ims_file.split(sep='/')[-1][:-3]}ome.tif")
-        # write data to ome tiff file
-        save_ome_tiff_file(data_array, metadata_dict, output_file_path)
+        # get directory of the output file, subdirectories of the input directory are mirrored
+        output_directory = os.path.join(args.output, os.path.relpath(os.path.dirname(os.path.abspath(ims_file)),
+                                                                     input_directory))
+        # check if output directory exists, if not create it
+        if not os.path.exists(output_directory):
+            os.makedirs(output_directory)
+        # generate output path to the new ome tiff file or ome zarr store
+        output_file_path = os.path.normpath(os.path.join(output_directory,
+                                                         f"{ims_file.split(sep='/')[-1][:-3]}{file_ending}"))
+        # add conversion job
+        conversion_jobs.append((ims_file, output_file_path))
+
+    # check if only a shard of the files should be converted
+    if args.shard:
+        # select the jobs of the shard
+        conversion_jobs = select_shard_jobs(conversion_jobs, *parse_shard(args.shard), input_directory)
+        # print status message
+        print(f'Shard {args.shard} holds {len(conversion_jobs)} of {len(ims_file_list)} files!')
+    # get shared status directory if several workers convert the files
+    if args.status_dir is None and (args.shard or args.claim):
+        args.status_dir = os.path.join(args.output, 'conversion_status')
+
+    # check if the channels and labels of interest should be selected
+    if args.unify:
+        # use the mappings of ome_tiff_unify_channels as channel selection
+        args.channels = {'channels': channels_of_interest, 'labels': labels_of_interest}
+
+    # get memory budget in bytes
+    max_memory = None if args.max_memory is None else int(args.max_memory * 1024 ** 3)
+    # collect options that are passed to each conversion
+    conversion_options = {'stream': args.stream,
+                          'strategy': args.strategy,
+                          'slab_size': args.slab_size,
+                          'read_ahead': args.read_ahead,
+                          'backend': args.backend,
+                          'n_threads': args.threads,
+                          'tiff_options': {'compression': args.compression,
+                                           'compression_level': args.compression_level,
+                                           'tile': args.tile,
+                                           'predictor': args.predictor,
+                                           'n_write_threads': args.write_threads},
+                          'write_bandwidth': args.write_bandwidth,
+                          'pyramid': args.pyramid,
+                          'n_levels': args.pyramid_levels,
+                          'time_points': args.time_points,
+                          'roi': {'Z': args.z_range, 'Y': args.y_range, 'X': args.x_range},
+                          'roi_unit': args.roi_unit,
+                          'channel_selection': args.channels,
+                          'rescale': tuple(args.percentiles) if args.to_uint8 else None,
+                          'rescale_level': args.percentile_level,
+                          'output_format': args.output_format,
+                          'zarr_options': {'chunks': args.zarr_chunks,
+                                           'compressor': args.zarr_compressor,
+                                           'compression_level': args.compression_level,
+                                           'n_write_threads': args.write_threads}}
+
+    # check if the conversion should only be planned
+    if args.plan:
+        # plan the conversion of each file
+        plans = [plan_conversion(ims_file, conversion_options, max_memory, args.write_bandwidth)
+                 for ims_file, _ in conversion_jobs]
+        # print plans and write them to the output directory
+        print_conversion_plan(plans)
+        with open(os.path.join(args.output, 'conversion_plan.json'), 'w') as f:
+            json.dump(plans, f, indent=4)
+        return
+
+    # convert files, files that are up to date according to the manifest in the output directory are skipped
+    convert_ims_files(conversion_jobs, conversion_options, args.jobs, max_memory,
+                      os.path.join(args.output, 'conversion_manifest.json'), args.manifest_hash, args.force,
+                      args.status_dir, args.claim, None if args.claim_timeout is None else args.claim_timeout * 3600,
+                      input_directory)
+
+    # print time, bytes and memory of the processing stages if requested
+    if args.profile:
+        print_stage_summary()
 
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,283 @@
+import os
+import sys
+import json
+import time
+import datetime
+import resource
+import threading
+from contextlib import contextmanager
+
+
+# configuration of the instrumentation of this process, set with configure_instrumentation
+_configuration = {'enabled': False, 'path_to_log': None}
+# records of the finished stages of this process
+_stage_records = []
+# lock for the records and the log file, stages can finish in several threads
+_lock = threading.Lock()
+# stack of the running stages of each thread, used for computing the time spent in a stage without its nested stages
+_running_stages = threading.local()
+
+
+def configure_instrumentation(enabled=False, path_to_log=None):
+    """
+    Enables or disables the instrumentation of this process. If a log path is passed, every finished stage and every
+    progress update is appended as a single JSON line to this file, the stages are recorded for the summary table
+    as well. Several processes can append to the same log file.
+
+    :param enabled: if True the stages are recorded (bool)
+    :param path_to_log: path to the JSON lines log file, passing a path enables the instrumentation (string)
+    """
+    _configuration['enabled'] = enabled or path_to_log is not None
+    _configuration['path_to_log'] = path_to_log
+
+
+def get_instrumentation_configuration():
+    """
+    Returns the configuration of the instrumentation, it can be passed to worker processes.
+
+    :return: keyword arguments of configure_instrumentation (dict)
+    """
+    return dict(_configuration)
+
+
+def is_instrumentation_enabled():
+    """
+    Checks if the instrumentation of this process is enabled.
+
+    :return: True if the stages are recorded (bool)
+    """
+    return _configuration['enabled']
+
+
+def get_peak_rss():
+    """
+    Returns the peak resident set size of this process so far.
+
+    :return: peak RSS in MB (float)
+    """
+    # ru_maxrss is given in bytes on macOS and in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / 1024 ** 2 if sys.platform == 'darwin' else peak_rss / 1024
+
+
+def log_event(event, **fields):
+    """
+    Appends an event as a single JSON line to the log file, if a log file is configured.
+
+    :param event: type of the event, e.g. 'stage' or 'progress' (string)
+    :param fields: fields of the event
+    """
+    # check if a log file is configured
+    if _configuration['path_to_log'] is None:
+        return
+    # create JSON line with time stamp and process id
+    line = json.dumps({'event': event, 'time': datetime.datetime.now().isoformat(), 'pid': os.getpid(), **fields},
+                      default=str)
+    # append line, a single write in append mode keeps lines of several processes intact
+    with _lock, open(_configuration['path_to_log'], 'a') as f:
+        f.write(line + '\n')
+
+
+@contextmanager
+def profile_stage(stage, **fields):
+    """
+    Context manager that measures a processing stage. Wall time, CPU time and the peak RSS of the process are recorded
+    when the stage ends, the stage can add the number of bytes it read and wrote to the yielded record. Time spent in
+    stages nested into this one is subtracted from its self time, so e.g. the slab reads inside an OME TIFF write do
+    not count as TIFF encoding. Only stages of the same thread are nested, work that is handed to other threads must
+    be covered by a stage for the wait on it, e.g. wait_read for the reader thread of iterate_slabs_read_ahead. CPU
+    time is measured for the whole process and thus includes other threads. If the instrumentation is disabled,
+    nothing is measured.
+
+    :param stage: name of the stage, e.g. 'read_ims' or 'write_ome_tiff' (string)
+    :param fields: additional fields of the record, e.g. file=path (dict)
+    :return: record of the stage, 'bytes_read' and 'bytes_written' can be increased by the stage (dict)
+    """
+    # initialize record of the stage
+    record = {'stage': stage, 'bytes_read': 0, 'bytes_written': 0, **fields}
+    # check if the instrumentation is enabled
+    if not _configuration['enabled']:
+        yield record
+        return
+
+    # get stack of the running stages of this thread and push the stage
+    stack = _running_stages.__dict__.setdefault('stack', [])
+    stack.append(record)
+    # start timers
+    record['nested_wall_s'] = 0.0
+    start_time = time.perf_counter()
+    start_cpu_time = time.process_time()
+    try:
+        yield record
+    finally:
+        # stop timers
+        record['wall_s'] = time.perf_counter() - start_time
+        record['cpu_s'] = time.process_time() - start_cpu_time
+        record['self_wall_s'] = record['wall_s'] - record.pop('nested_wall_s')
+        record['peak_rss_mb'] = get_peak_rss()
+        # pop the stage and add its time to the parent stage
+        stack.pop()
+        if stack:
+            stack[-1]['nested_wall_s'] += record['wall_s']
+        # store record and write it to the log
+        with _lock:
+            _stage_records.append(record)
+        log_event('stage', **record)
+
+
+def get_stage_records():
+    """
+    Returns the records of all finished stages of this process.
+
+    :return: list of stage records (list of dicts)
+    """
+    with _lock:
+        return list(_stage_records)
+
+
+def merge_stage_records(records):
+    """
+    Adds the records of stages that ran in another process (e.g. a worker of a process pool) to the records of this
+    process, so they appear in the summary table.
+
+    :param records: list of stage records (list of dicts)
+    """
+    with _lock:
+        _stage_records.extend(records)
+
+
+def run_instrumented(configuration, function, *args, **kwargs):
+    """
+    Runs a function with the passed instrumentation configuration and returns its result together with the records of
+    the stages it ran. It is submitted to process pools instead of the function itself, so the stages of the workers
+    are recorded and can be merged into the summary of the main process.
+
+    :param configuration: configuration returned by get_instrumentation_configuration (dict)
+    :param function: function that is called (callable)
+    :param args: positional arguments of the function
+    :param kwargs: keyword arguments of the function
+    :return: result of the function, list of stage records (tuple)
+    """
+    # configure the instrumentation of the worker
+    configure_instrumentation(**configuration)
+    # remember records that were recorded by earlier tasks of the same worker
+    n_records = len(_stage_records)
+    # run function
+    result = function(*args, **kwargs)
+    # return result and the records of this call
+    return result, _stage_records[n_records:]
+
+
+def summarize_stages(records=None):
+    """
+    Aggregates stage records by stage name. Throughput is computed from the larger of the bytes read and written and
+    the self time of the stage.
+
+    :param records: list of stage records, if None the records of this process are used (list of dicts)
+    :return: summary for each stage name (dict)
+    """
+    # use records of this process if no records are passed
+    records = get_stage_records() if records is None else records
+    # initialize summary
+    summary = {}
+    # iterate records
+    for record in records:
+        # get or create summary of the stage
+        stage_summary = summary.setdefault(record['stage'], {'count': 0, 'wall_s': 0.0, 'self_wall_s': 0.0,
+                                                             'cpu_s': 0.0, 'bytes_read': 0, 'bytes_written': 0,
+                                                             'peak_rss_mb': 0.0})
+        # add record to the summary
+        stage_summary['count'] += 1
+        for key in ('wall_s', 'self_wall_s', 'cpu_s', 'bytes_read', 'bytes_written'):
+            stage_summary[key] += record[key]
+        stage_summary['peak_rss_mb'] = max(stage_summary['peak_rss_mb'], record['peak_rss_mb'])
+    # add throughput of each stage
+    for stage_summary in summary.values():
+        n_bytes = max(stage_summary['bytes_read'], stage_summary['bytes_written'])
+        stage_summary['mb_s'] = n_bytes / 1024 ** 2 / stage_summary['self_wall_s'] \
+            if stage_summary['self_wall_s'] else 0.0
+    # return summary
+    return summary
+
+
+def print_stage_summary(records=None):
+    """
+    Prints a table with the summed times, bytes, throughput and peak RSS of each stage and writes the summary to the
+    log file.
+
+    :param records: list of stage records, if None the records of this process are used (list of dicts)
+    """
+    # summarize stages
+    summary = summarize_stages(records)
+    # check if stages were recorded
+    if not summary:
+        return
+    # print table
+    print(f'{"stage":<24}{"count":>7}{"wall [s]":>11}{"self [s]":>11}{"cpu [s]":>11}{"read [MB]":>12}'
+          f'{"written [MB]":>14}{"MB/s":>9}{"peak RSS [MB]":>15}')
+    for stage, s in summary.items():
+        print(f'{stage:<24}{s["count"]:>7}{s["wall_s"]:>11.2f}{s["self_wall_s"]:>11.2f}{s["cpu_s"]:>11.2f}'
+              f'{s["bytes_read"] / 1024 ** 2:>12.1f}{s["bytes_written"] / 1024 ** 2:>14.1f}{s["mb_s"]:>9.1f}'
+              f'{s["peak_rss_mb"]:>15.0f}')
+    # write summary to the log
+    log_event('summary', stages=summary)
+
+
+def start_progress(n_total, total_bytes):
+    """
+    Starts tracking the progress of a batch of work items, e.g. the files of a conversion.
+
+    :param n_total: number of work items (int)
+    :param total_bytes: total size of the work items in bytes (int)
+    :return: progress state that is passed to update_progress (dict)
+    """
+    return {'n_total': n_total, 'total_bytes': total_bytes, 'n_done': 0, 'bytes_done': 0,
+            'start_time': time.perf_counter()}
+
+
+def update_progress(progress, n_bytes, item=''):
+    """
+    Marks a work item as done and returns a status message with the throughput of the batch so far and the estimated
+    time until the batch is finished. The estimate assumes a constant throughput in bytes per second. The progress is
+    written to the log file as well.
+
+    :param progress: progress state returned by start_progress (dict)
+    :param n_bytes: size of the finished work item in bytes (int)
+    :param item: name of the finished work item, e.g. the file path (string)
+    :return: status message (string)
+    """
+    # update progress
+    progress['n_done'] += 1
+    progress['bytes_done'] += n_bytes
+    elapsed_time = time.perf_counter() - progress['start_time']
+    # compute throughput and remaining time
+    mb_s = progress['bytes_done'] / 1024 ** 2 / elapsed_time if elapsed_time else 0.0
+    remaining_bytes = progress['total_bytes'] - progress['bytes_done']
+    eta_s = remaining_bytes / progress['bytes_done'] * elapsed_time if progress['bytes_done'] else 0.0
+    # write progress to the log
+    log_event('progress', item=item, n_done=progress['n_done'], n_total=progress['n_total'], mb_s=mb_s,
+              elapsed_s=elapsed_time, eta_s=eta_s)
+    # return status message
+    return (f'[{progress["n_done"]}/{progress["n_total"]}] {item} ({mb_s:.1f} MB/s, '
+            f'ETA {datetime.timedelta(seconds=round(eta_s))})')
+
+
+def add_instrumentation_arguments(parser):
+    """
+    Adds the --profile and --log_json arguments to an argument parser.
+
+    :param parser: argument parser of a script (argparse.ArgumentParser)
+    """
+    parser.add_argument('--profile', action='store_true',
+                        help='Print wall time, CPU time, bytes, throughput and peak memory of each processing stage')
+    parser.add_argument('--log_json', default=None,
+                        help='Append a JSON line for each processing stage and progress update to this file')
+
+
+def configure_instrumentation_from_arguments(args):
+    """
+    Configures the instrumentation from the arguments added by add_instrumentation_arguments.
+
+    :param args: parsed arguments (argparse.Namespace)
+    """
+    configure_instrumentation(args.profile, args.log_json)
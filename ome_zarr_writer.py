@@ -0,0 +1,212 @@
+import os
+import json
+import zlib
+import itertools
+import numpy as np
+
+# imagecodecs is optional, it provides the zstd codec
+try:
+    import imagecodecs
+except ImportError:
+    imagecodecs = None
+
+
+# default compression level of each codec, chosen for throughput like the NIfTI writer
+DEFAULT_ZARR_COMPRESSION_LEVELS = {'zlib': 1, 'gzip': 1, 'zstd': 3}
+
+
+def get_zarr_compressor(compressor='zlib', compression_level=None):
+    """
+    Returns the compressor configuration of a zarr v2 array as it is stored in the .zarray file. The ids and parameters
+    are the ones of the numcodecs codecs, so the arrays can be read by zarr and all OME-Zarr viewers.
+
+    :param compressor: 'zlib', 'gzip', 'zstd' or 'none' (string)
+    :param compression_level: compression level of the codec, if None the default level is used (int)
+    :return: compressor configuration or None for uncompressed chunks (dict)
+    """
+    # check if the chunks are stored uncompressed
+    if compressor in (None, 'none'):
+        return None
+    # check if the codec is unknown
+    if compressor not in DEFAULT_ZARR_COMPRESSION_LEVELS:
+        raise ValueError(f'Unknown zarr compressor "{compressor}", use "zlib", "gzip", "zstd" or "none"!')
+    # check if the optional zstd codec is available
+    if compressor == 'zstd' and imagecodecs is None:
+        raise ValueError('The zstd compressor needs the imagecodecs package!')
+    # return codec id and level
+    return {'id': compressor,
+            'level': DEFAULT_ZARR_COMPRESSION_LEVELS[compressor] if compression_level is None else compression_level}
+
+
+def encode_zarr_chunk(chunk, compressor=None):
+    """
+    Encodes a single C-contiguous chunk with the passed compressor. zlib and zstd release the GIL, so chunks can be
+    encoded in parallel threads.
+
+    :param chunk: C-contiguous chunk with the full chunk shape of the array (numpy.ndarray)
+    :param compressor: compressor configuration, see get_zarr_compressor (dict)
+    :return: encoded chunk (bytes)
+    """
+    # return raw bytes of uncompressed chunks
+    if compressor is None:
+        return chunk.tobytes()
+    # check if it is the zlib codec
+    if compressor['id'] == 'zlib':
+        return zlib.compress(chunk, compressor['level'])
+    # check if it is the gzip codec, wbits 31 writes a gzip header and trailer
+    if compressor['id'] == 'gzip':
+        compressor_object = zlib.compressobj(compressor['level'], zlib.DEFLATED, 31)
+        return compressor_object.compress(chunk) + compressor_object.flush()
+    # encode with the zstd codec
+    return imagecodecs.zstd_encode(chunk, level=compressor['level'])
+
+
+def write_json_file(path_to_file, content):
+    """
+    Writes the passed content as JSON file, as used for the .zarray, .zgroup and .zattrs files of a zarr store.
+
+    :param path_to_file: path of the JSON file (string)
+    :param content: JSON compatible content (dict)
+    """
+    # write content with indentation, so the metadata of the store is human readable
+    with open(path_to_file, 'w') as f:
+        json.dump(content, f, indent=4)
+
+
+def create_zarr_array(path_to_array, shape, chunks, dtype, compressor=None):
+    """
+    Creates an empty zarr v2 array in the passed directory by writing its .zarray file. The chunks are stored in nested
+    directories ('/' as dimension separator) as expected by OME-Zarr. Chunks that are larger than the array are
+    clipped to its shape, so small resolution levels are not padded to the full chunk shape.
+
+    :param path_to_array: path of the array directory (string)
+    :param shape: shape of the array (tuple)
+    :param chunks: chunk shape of the array (tuple)
+    :param dtype: data type of the array (numpy.dtype)
+    :param compressor: compressor configuration, see get_zarr_compressor (dict)
+    :return: metadata of the array as written to .zarray (dict)
+    """
+    # combine the metadata of the array
+    zarray = {'zarr_format': 2,
+              'shape': [int(s) for s in shape],
+              'chunks': [int(min(c, s)) for c, s in zip(chunks, shape)],
+              'dtype': np.dtype(dtype).str,
+              'compressor': compressor,
+              'fill_value': 0,
+              'order': 'C',
+              'filters': None,
+              'dimension_separator': '/'}
+    # check if array directory exists, if not create it
+    os.makedirs(path_to_array, exist_ok=True)
+    # write metadata of the array
+    write_json_file(os.path.join(path_to_array, '.zarray'), zarray)
+    # return metadata
+    return zarray
+
+
+def write_zarr_chunk(path_to_array, zarray, chunk_index, data):
+    """
+    Writes the data of a single chunk of a zarr v2 array. Chunks at the border of the array are padded with the fill
+    value to the full chunk shape, as the zarr format requires.
+
+    :param path_to_array: path of the array directory (string)
+    :param zarray: metadata of the array, see create_zarr_array (dict)
+    :param chunk_index: index of the chunk in each dimension (tuple)
+    :param data: data of the chunk, may be a view into a larger array (numpy.ndarray)
+    :return: number of bytes written to the file (int)
+    """
+    # copy the data into a contiguous chunk, border chunks are padded with the fill value
+    chunk = np.full(zarray['chunks'], zarray['fill_value'], dtype=zarray['dtype'])
+    chunk[tuple(slice(0, s) for s in data.shape)] = data
+    # encode chunk
+    encoded_chunk = encode_zarr_chunk(chunk, zarray['compressor'])
+    # get path of the chunk file in the nested directory structure
+    path_to_chunk = os.path.join(path_to_array, *[str(i) for i in chunk_index])
+    os.makedirs(os.path.dirname(path_to_chunk), exist_ok=True)
+    # write the encoded chunk
+    with open(path_to_chunk, 'wb') as f:
+        f.write(encoded_chunk)
+    # return number of written bytes
+    return len(encoded_chunk)
+
+
+def submit_zarr_slab(path_to_array, zarray, slab, z_start, executor):
+    """
+    Submits the chunk writes of a ZCYX slab into a CZYX zarr array to the passed executor. The slab must start at a
+    chunk border in Z and hold whole chunks in Z, except at the end of the array. The slab must not be changed before
+    all returned futures are done.
+
+    :param path_to_array: path of the array directory (string)
+    :param zarray: metadata of the array, see create_zarr_array (dict)
+    :param slab: ZCYX slab with all channels and the full Y and X size of the array (numpy.ndarray)
+    :param z_start: Z plane of the array at which the slab starts (int)
+    :param executor: thread pool the chunks are encoded and written in (ThreadPoolExecutor)
+    :return: list of futures of the chunk writes (list)
+    """
+    # get chunk shape of the channel, Z, Y and X dimensions
+    _, chunk_z, chunk_y, chunk_x = zarray['chunks']
+    # initialize empty list for futures
+    futures = []
+    # iterate chunks of the slab, the channel dimension has chunk size 1
+    for c, z, y, x in itertools.product(range(slab.shape[1]), range(0, slab.shape[0], chunk_z),
+                                        range(0, slab.shape[2], chunk_y), range(0, slab.shape[3], chunk_x)):
+        # get data of the chunk as CZYX view into the slab
+        data = slab[z:z + chunk_z, c, y:y + chunk_y, x:x + chunk_x][np.newaxis]
+        # submit encoding and writing of the chunk
+        futures.append(executor.submit(write_zarr_chunk, path_to_array, zarray,
+                                       (c, (z_start + z) // chunk_z, y // chunk_y, x // chunk_x), data))
+    # return futures
+    return futures
+
+
+def get_ome_zarr_attributes(metadata_dict, level_sizes, name=None):
+    """
+    Translates the metadata dictionary of the converter into the attributes of an OME-Zarr (NGFF v0.4) image group with
+    one CZYX array per resolution level. The voxel size of each level is derived from the full resolution voxel size,
+    as all Imaris resolution levels cover the same metrical extent. The translation moves the center of the first voxel
+    of each level to its metrical position, so the levels and the origin of the ims file line up.
+
+    :param metadata_dict: dictionary with the metadata of the image (dict)
+    :param level_sizes: list of image size dictionaries of the written resolution levels (list)
+    :param name: name of the image (string)
+    :return: attributes of the image group as written to .zattrs (dict)
+    """
+    # initialize empty list for the datasets of the resolution levels
+    datasets = []
+    # iterate resolution levels
+    for level, level_size in enumerate(level_sizes):
+        # get voxel size of the level in order (Z,Y,X)
+        scale = [metadata_dict['voxel_size'][d] * level_sizes[0][d] / level_size[d] for d in 'ZYX']
+        # get metrical position of the center of the first voxel
+        translation = [metadata_dict['origin'][d] + s / 2 for d, s in zip('ZYX', scale)]
+        # add dataset of the level, the channel dimension is not scaled
+        datasets.append({'path': str(level),
+                         'coordinateTransformations': [{'type': 'scale', 'scale': [1.0] + scale},
+                                                       {'type': 'translation', 'translation': [0.0] + translation}]})
+
+    # combine multiscales, channel and converter metadata
+    return {'multiscales': [{'version': '0.4',
+                             'name': name or metadata_dict['original_file'],
+                             'axes': [{'name': 'c', 'type': 'channel'}] +
+                                     [{'name': d, 'type': 'space', 'unit': 'micrometer'} for d in 'zyx'],
+                             'datasets': datasets,
+                             'type': 'Imaris resolution levels'}],
+            'omero': {'channels': [{'label': n, 'color': 'FFFFFF', 'active': True}
+                                   for n in metadata_dict['channel_names']],
+                      'rdefs': {'model': 'greyscale'}},
+            'ims_metadata': json.loads(json.dumps(metadata_dict, default=str))}
+
+
+def write_ome_zarr_group(path_to_zarr, attributes):
+    """
+    Writes the .zgroup and .zattrs files of an OME-Zarr image group. They should be written after all arrays are
+    complete, so a store without them is recognizable as incomplete.
+
+    :param path_to_zarr: path of the OME-Zarr store (string)
+    :param attributes: attributes of the image group, see get_ome_zarr_attributes (dict)
+    """
+    # check if store directory exists, if not create it
+    os.makedirs(path_to_zarr, exist_ok=True)
+    # write group and attributes
+    write_json_file(os.path.join(path_to_zarr, '.zgroup'), {'zarr_format': 2})
+    write_json_file(os.path.join(path_to_zarr, '.zattrs'), attributes)
@@ -0,0 +1,279 @@
+import numpy as np
+
+
+# relative deviation up to which a spacing is considered to match the target spacing
+DEFAULT_SPACING_TOLERANCE = 0.05
+
+
+def get_resampling_factors(voxel_size, target_spacing, tolerance=DEFAULT_SPACING_TOLERANCE):
+    """
+    Returns the integer downsampling factors that bring the passed voxel size closest to the target spacing. Blocks of
+    whole voxels are combined, so a target spacing that is not an integer multiple of the voxel size is rounded to the
+    nearest multiple, and a target spacing finer than the voxel size keeps the voxel size (factor 1).
+
+    :param voxel_size: voxel size in the order (Z,Y,X) (list)
+    :param target_spacing: target spacing in the order (Z,Y,X) (list)
+    :param tolerance: relative deviation of the resulting spacing from the target that is accepted silently (float)
+    :return: factors in the order (Z,Y,X) (tuple of int), resulting spacing in the order (Z,Y,X) (list), True if the
+             resulting spacing matches the target within the tolerance (bool)
+    """
+    # round the ratio of target spacing and voxel size to whole voxels, at least one
+    factors = tuple(max(1, int(round(t / v))) for v, t in zip(voxel_size, target_spacing))
+    # get spacing of the resampled image
+    spacing = [v * n for v, n in zip(voxel_size, factors)]
+    # return factors, spacing and whether the spacing matches the target
+    return factors, spacing, is_matching_spacing(spacing, target_spacing, tolerance)
+
+
+def is_matching_spacing(spacing, target_spacing, tolerance=DEFAULT_SPACING_TOLERANCE):
+    """
+    Checks if a spacing matches the target spacing in every dimension within the relative tolerance.
+
+    :param spacing: spacing in the order (Z,Y,X) (list)
+    :param target_spacing: target spacing in the order (Z,Y,X) (list)
+    :param tolerance: accepted relative deviation from the target spacing (float)
+    :return: True if the spacing matches (bool)
+    """
+    return all(abs(s - t) <= tolerance * t for s, t in zip(spacing, target_spacing))
+
+
+def get_resampled_shape(shape, factors):
+    """
+    Returns the shape of an image after downsampling it by the passed factors. A partial block at the end of a
+    dimension becomes a voxel of its own, so no voxels of the image are dropped.
+
+    :param shape: shape of the image in the order (Z,Y,X) (tuple)
+    :param factors: factors in the order (Z,Y,X) (tuple of int)
+    :return: resampled shape in the order (Z,Y,X) (tuple)
+    """
+    return tuple(-(-s // n) for s, n in zip(shape, factors))
+
+
+def get_resampled_origin(origin, voxel_size, shape, factors):
+    """
+    Returns the metrical origin, the lower corner of the first voxel, of an image after downsampling it by the passed
+    factors. The first resampled voxel is centered on the first block, so its corner lies half a resampled voxel below
+    the block center. This is the original origin, unless a dimension is shorter than its factor and the only block is
+    partial.
+
+    :param origin: origin of the image in the order (Z,Y,X) (list)
+    :param voxel_size: voxel size of the image in the order (Z,Y,X) (list)
+    :param shape: shape of the image in the order (Z,Y,X) (tuple)
+    :param factors: factors in the order (Z,Y,X) (tuple of int)
+    :return: origin of the resampled image in the order (Z,Y,X) (list)
+    """
+    # get the center of the first block from its number of voxels and subtract half a resampled voxel
+    return [o + min(n, s) * v / 2 - n * v / 2 for o, v, s, n in zip(origin, voxel_size, shape, factors)]
+
+
+def get_block_starts(size, factor):
+    """
+    Returns the indices at which the blocks of a dimension start, as used by numpy.add.reduceat.
+
+    :param size: size of the dimension (int)
+    :param factor: number of voxels combined into a block (int)
+    :return: start indices of the blocks (numpy.ndarray)
+    """
+    return np.arange(0, size, factor)
+
+
+def sum_blocks(data, factors, axes, dtype=None):
+    """
+    Sums the voxels of every block of the passed array with numpy.add.reduceat, one dimension after the other. Each
+    pass shrinks the array by its factor, so the later passes are cheap. By default the sums are accumulated in 64 bit,
+    so large blocks of 16 bit intensities are summed exactly.
+
+    :param data: array that is summed (numpy.ndarray)
+    :param factors: factors of the summed dimensions (tuple of int)
+    :param axes: axes of the summed dimensions in data (tuple of int)
+    :param dtype: data type of the sums, if None int64 for integer and boolean data and float64 otherwise (numpy.dtype)
+    :return: block sums (numpy.ndarray)
+    """
+    # accumulate in 64 bit if no data type is passed
+    if dtype is None:
+        dtype = np.int64 if np.issubdtype(data.dtype, np.integer) or data.dtype == bool else np.float64
+    # iterate dimensions that are downsampled
+    for axis, factor in zip(axes, factors):
+        if factor > 1:
+            # sum the blocks of this dimension
+            data = np.add.reduceat(data, get_block_starts(data.shape[axis], factor), axis=axis, dtype=dtype)
+    # return sums in the requested data type
+    return data.astype(dtype, copy=False)
+
+
+def get_block_counts(shape, factors):
+    """
+    Returns the number of voxels of every block, which only differs from the product of the factors for the partial
+    blocks at the end of a dimension.
+
+    :param shape: shape of the image in the order (Z,Y,X) (tuple)
+    :param factors: factors in the order (Z,Y,X) (tuple of int)
+    :return: number of voxels per block, broadcastable to the resampled (Z,Y,X) shape (numpy.ndarray)
+    """
+    # get number of voxels of the blocks in each dimension
+    counts = [np.diff(np.append(get_block_starts(s, n), s)) for s, n in zip(shape, factors)]
+    # combine the counts of the three dimensions by broadcasting
+    return counts[0][:, None, None] * counts[1][None, :, None] * counts[2][None, None, :]
+
+
+def downsample_block_mean(slab, factors, out):
+    """
+    Downsamples a (Z,Y,X) slab of an intensity channel by averaging the voxels of each block. Integer results are
+    rounded to the nearest value.
+
+    :param slab: 3D (Z,Y,X) slab (numpy.ndarray)
+    :param factors: factors in the order (Z,Y,X) (tuple of int)
+    :param out: array of the resampled slab shape the result is written to (numpy.ndarray)
+    """
+    # sum voxels of the blocks and divide by the number of voxels of each block
+    means = sum_blocks(slab, factors, (0, 1, 2)) / get_block_counts(slab.shape, factors)
+    # round means of integer images
+    if np.issubdtype(out.dtype, np.integer):
+        np.rint(means, out=means)
+    # write result in the data type of the output
+    out[...] = means
+
+
+def downsample_block_majority(slab, factors, out, max_counted_labels=16):
+    """
+    Downsamples a (Z,Y,X) slab of a label channel by assigning each block its most frequent label, ties are resolved in
+    favour of the lower label. Masks with few labels are counted label by label, for many labels, e.g. probability
+    maps, the voxels of each block are sorted and the longest run of equal values is taken.
+
+    :param slab: 3D (Z,Y,X) slab of integer or boolean labels (numpy.ndarray)
+    :param factors: factors in the order (Z,Y,X) (tuple of int)
+    :param out: array of the resampled slab shape the result is written to (numpy.ndarray)
+    :param max_counted_labels: highest number of labels that are counted label by label (int)
+    """
+    # get labels of the slab in ascending order
+    labels = np.unique(slab)
+    # check if the labels are too many to be counted one after the other
+    if len(labels) > max_counted_labels:
+        out[...] = get_block_modes(slab, factors)
+        return
+    # initialize the highest count found so far for each block
+    best_counts = np.full(out.shape, -1, dtype=np.int32)
+    # iterate labels
+    for label in labels:
+        # count the voxels of the label in each block
+        counts = sum_blocks(slab == label, factors, (0, 1, 2), dtype=np.int32)
+        # assign the label to the blocks in which it is more frequent than all lower labels
+        is_more_frequent = counts > best_counts
+        out[is_more_frequent] = label
+        best_counts[is_more_frequent] = counts[is_more_frequent]
+
+
+def get_block_modes(slab, factors):
+    """
+    Returns the most frequent value of each block of a (Z,Y,X) slab of integer labels, ties are resolved in favour of
+    the lower value. The slab is padded to whole blocks with -1, so labels must not be negative, the voxels of each
+    block are sorted and the value that ends the longest run of equal values is taken, padding values never count.
+
+    :param slab: 3D (Z,Y,X) slab of integer or boolean labels (numpy.ndarray)
+    :param factors: factors in the order (Z,Y,X) (tuple of int)
+    :return: most frequent value of each block in the resampled slab shape (numpy.ndarray)
+    """
+    # get resampled shape
+    resampled_shape = get_resampled_shape(slab.shape, factors)
+    # pad the slab to whole blocks with -1 in a signed data type that holds all labels
+    dtype = np.int32 if slab.dtype.itemsize < 4 else np.int64
+    padded = np.full([s * n for s, n in zip(resampled_shape, factors)], -1, dtype=dtype)
+    padded[:slab.shape[0], :slab.shape[1], :slab.shape[2]] = slab
+    # arrange the voxels of each block along the last axis and sort them
+    blocks = padded.reshape(resampled_shape[0], factors[0], resampled_shape[1], factors[1], resampled_shape[2],
+                            factors[2]).transpose(0, 2, 4, 1, 3, 5).reshape(resampled_shape + (-1,))
+    blocks.sort(axis=-1)
+    # get the position at which the run of equal values of each voxel starts
+    positions = np.arange(blocks.shape[-1], dtype=np.int32)
+    is_run_start = np.ones(blocks.shape, dtype=bool)
+    is_run_start[..., 1:] = blocks[..., 1:] != blocks[..., :-1]
+    run_starts = np.maximum.accumulate(np.where(is_run_start, positions, 0), axis=-1)
+    # get the length of each run up to the voxel, runs of padding values have length zero
+    run_lengths = np.where(blocks >= 0, positions - run_starts + 1, 0)
+    # return the value at which the first longest run ends
+    return np.take_along_axis(blocks, run_lengths.argmax(axis=-1)[..., np.newaxis], axis=-1)[..., 0]
+
+
+def downsample_block_nearest(slab, factors, out):
+    """
+    Downsamples a (Z,Y,X) slab of a label channel by taking the voxel at the center of each block.
+
+    :param slab: 3D (Z,Y,X) slab (numpy.ndarray)
+    :param factors: factors in the order (Z,Y,X) (tuple of int)
+    :param out: array of the resampled slab shape the result is written to (numpy.ndarray)
+    """
+    # get index of the center voxel of each block, clipped to the partial blocks at the end of a dimension
+    indices = [np.minimum(get_block_starts(s, n) + n // 2, s - 1) for s, n in zip(slab.shape, factors)]
+    # pick the center voxels
+    out[...] = slab[np.ix_(*indices)]
+
+
+# kernels that are available for intensity and label channels
+RESAMPLING_KERNELS = {'mean': downsample_block_mean,
+                      'majority': downsample_block_majority,
+                      'nearest': downsample_block_nearest}
+
+
+def resample_slab(slab, factors, out, label_channels=(), label_kernel='majority'):
+    """
+    Downsamples a ZCYX slab channel by channel, intensity channels by block mean and label channels with the label
+    kernel. The slab must hold whole blocks in Z, except at the end of the image.
+
+    :param slab: 4D (Z,C,Y,X) slab (numpy.ndarray)
+    :param factors: factors in the order (Z,Y,X) (tuple of int)
+    :param out: 4D (Z,C,Y,X) array of the resampled slab shape the result is written to (numpy.ndarray)
+    :param label_channels: indices of the label channels (list of int)
+    :param label_kernel: 'majority' or 'nearest' (string)
+    """
+    # iterate channels
+    for c in range(slab.shape[1]):
+        # select the kernel of the channel
+        kernel = RESAMPLING_KERNELS[label_kernel if c in label_channels else 'mean']
+        # downsample channel
+        kernel(slab[:, c], factors, out[:, c])
+
+
+def get_resampling_slab_size(slab_size, factor):
+    """
+    Returns the number of Z planes of a resampling slab, the smallest multiple of the Z factor that holds at least
+    slab_size planes, so no block is split between two slabs.
+
+    :param slab_size: requested number of Z planes of a slab (int)
+    :param factor: factor in Z (int)
+    :return: number of Z planes of a slab (int)
+    """
+    return factor * max(1, -(-slab_size // factor))
+
+
+def resample_image(image_data_array, factors, label_channels=(), label_kernel='majority', slab_size=16):
+    """
+    Downsamples a ZCYX image by the passed factors, slab by slab, so the temporary arrays of the kernels stay small
+    and memory mapped images are only read once.
+
+    :param image_data_array: 4D (Z,C,Y,X) image (numpy.ndarray)
+    :param factors: factors in the order (Z,Y,X) (tuple of int)
+    :param label_channels: indices of the label channels, they are resampled with the label kernel (list of int)
+    :param label_kernel: 'majority' or 'nearest' (string)
+    :param slab_size: number of Z planes that are resampled at once, rounded up to a multiple of the Z factor (int)
+    :return: resampled 4D (Z,C,Y,X) image (numpy.ndarray)
+    """
+    # return image unchanged if it is not downsampled
+    if all(n == 1 for n in factors):
+        return image_data_array
+    # get resampled shape
+    n_z, n_c, n_y, n_x = image_data_array.shape
+    resampled_z, resampled_y, resampled_x = get_resampled_shape((n_z, n_y, n_x), factors)
+    # preallocate the resampled image
+    resampled_image = np.empty((resampled_z, n_c, resampled_y, resampled_x), dtype=image_data_array.dtype)
+    # get number of Z planes of a slab
+    slab_size = get_resampling_slab_size(slab_size, factors[0])
+    # iterate slabs
+    for z_start in range(0, n_z, slab_size):
+        # get slab and its planes of the resampled image
+        slab = image_data_array[z_start:z_start + slab_size]
+        resampled_z_start = z_start // factors[0]
+        # resample slab
+        resample_slab(slab, factors, resampled_image[resampled_z_start:resampled_z_start + -(-len(slab) // factors[0])],
+                      label_channels, label_kernel)
+    # return resampled image
+    return resampled_image
@@ -0,0 +1,98 @@
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+# make the modules of the parent directory importable
+path_to_repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(path_to_repository)
+from benchmark.synthetic_ims import write_synthetic_ims_file
+from batch_coordination import select_shard_jobs, get_status_path, claim_conversion, release_conversion_claim, \
+    write_conversion_status, read_conversion_status
+
+
+def test_claimed_files_are_converted_exactly_once(tmp_path):
+    # write small synthetic ims files
+    input_directory = tmp_path / 'input'
+    input_directory.mkdir()
+    for i in range(8):
+        write_synthetic_ims_file(str(input_directory / f'image_{i}.ims'), image_size=(4, 32, 32),
+                                 chunk_shape=(4, 32, 32), n_levels=1, seed=i)
+    # start several workers on the same input files and status directory
+    command = [sys.executable, os.path.join(path_to_repository, 'ims_to_ome_tiff_converter.py'), '-i',
+               str(input_directory), '-o', str(tmp_path / 'output'), '--claim', '--claim_timeout', '1',
+               '--status_dir', str(tmp_path / 'status')]
+    workers = [subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+               for _ in range(4)]
+    outputs = [worker.communicate(timeout=300)[0] for worker in workers]
+    assert all(worker.returncode == 0 for worker in workers), outputs
+    # every file is converted by exactly one worker
+    finished = [line for output in outputs for line in output.splitlines() if 'Finished conversion of' in line]
+    for i in range(8):
+        assert sum(f'image_{i}.ims' in line for line in finished) == 1
+    # all claims are released and every file is done
+    status_files = os.listdir(tmp_path / 'status')
+    assert not [f for f in status_files if f.endswith('.claim')]
+    assert len(status_files) == 8
+    for f in status_files:
+        with open(tmp_path / 'status' / f) as status_file:
+            assert json.load(status_file)['state'] == 'done'
+
+
+def test_stale_claims_are_broken(tmp_path):
+    # claim a file and check that a fresh claim can not be taken
+    path_to_input_file = str(tmp_path / 'image.ims')
+    assert claim_conversion(str(tmp_path), path_to_input_file, claim_timeout=60)
+    assert not claim_conversion(str(tmp_path), path_to_input_file, claim_timeout=60)
+    # age the claim, as if its worker crashed, and check that it is broken
+    path_to_claim_file = get_status_path(str(tmp_path), path_to_input_file, '.claim')
+    os.utime(path_to_claim_file, (time.time() - 120, time.time() - 120))
+    assert claim_conversion(str(tmp_path), path_to_input_file, claim_timeout=60)
+    assert time.time() - os.path.getmtime(path_to_claim_file) < 60
+    # without timeout claims are never broken
+    os.utime(path_to_claim_file, (time.time() - 120, time.time() - 120))
+    assert not claim_conversion(str(tmp_path), path_to_input_file)
+
+
+def test_claims_of_other_workers_are_not_released(tmp_path):
+    # write a claim of another worker, as after the own claim was broken and the file claimed again
+    path_to_input_file = str(tmp_path / 'image.ims')
+    path_to_claim_file = get_status_path(str(tmp_path), path_to_input_file, '.claim')
+    with open(path_to_claim_file, 'w') as f:
+        json.dump({'worker': 'other-node:1', 'time': ''}, f)
+    # the claim of the other worker is kept
+    assert not release_conversion_claim(str(tmp_path), path_to_input_file)
+    assert os.path.exists(path_to_claim_file)
+    # an own claim is released
+    os.remove(path_to_claim_file)
+    assert claim_conversion(str(tmp_path), path_to_input_file)
+    assert release_conversion_claim(str(tmp_path), path_to_input_file)
+    assert not os.path.exists(path_to_claim_file)
+
+
+def test_status_files_do_not_depend_on_the_mount_point(tmp_path):
+    # the same file seen below two mount points of the shared filesystem
+    path_on_node_a = '/mnt/share/data/sample/image.ims'
+    path_on_node_b = '/cluster/storage/data/sample/image.ims'
+    assert get_status_path(str(tmp_path), path_on_node_a, '.claim', '/mnt/share/data') == \
+        get_status_path(str(tmp_path), path_on_node_b, '.claim', '/cluster/storage/data')
+    # the status written on one node is read on the other and holds the relative path
+    write_conversion_status(str(tmp_path), path_on_node_a, {'state': 'done'}, '/mnt/share/data')
+    status = read_conversion_status(str(tmp_path), path_on_node_b, '/cluster/storage/data')
+    assert status['state'] == 'done' and status['input'] == 'sample/image.ims'
+
+
+def test_shards_are_disjoint_balanced_and_complete():
+    # create jobs in nested directories
+    jobs = [(f'/mnt/share/data/dir_{i % 3}/image_{i}.ims', f'/output/image_{i}.ome.tif') for i in range(23)]
+    shards = [select_shard_jobs(jobs, i, 4, '/mnt/share/data') for i in range(4)]
+    # every job is in exactly one shard and the shards differ in size by at most one job
+    assert sorted(job for shard in shards for job in shard) == sorted(jobs)
+    assert max(len(shard) for shard in shards) - min(len(shard) for shard in shards) <= 1
+    # the shards do not depend on the order of the jobs or on the mount point
+    shuffled_jobs = [(f'/cluster/storage/data{job[0][len("/mnt/share/data"):]}', job[1])
+                     for job in random.Random(0).sample(jobs, len(jobs))]
+    for i, shard in enumerate(shards):
+        assert [job[1] for job in select_shard_jobs(shuffled_jobs, i, 4, '/cluster/storage/data')] == \
+            [job[1] for job in shard]
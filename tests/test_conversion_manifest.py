@@ -0,0 +1,18 @@
+import os
+import sys
+# make the modules of the parent directory importable
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ims_to_ome_tiff_converter import get_manifest_options
+
+
+def test_slab_size_and_read_ahead_are_compared_only_with_a_strategy():
+    # options of a conversion without strategy and of a tiled conversion
+    options = {'backend': 'threaded', 'n_threads': 8, 'slab_size': 16, 'read_ahead': 1, 'rescale': None}
+    tiled_options = {**options, 'strategy': 'tiled', 'max_memory': 2 ** 30}
+    # without strategy the slab size and read-ahead only change the speed
+    assert get_manifest_options(options) == {'rescale': None}
+    assert get_manifest_options({**options, 'slab_size': 64, 'read_ahead': 0}) == get_manifest_options(options)
+    # with a strategy they change the tile layout and are recorded
+    assert get_manifest_options(tiled_options) == {'slab_size': 16, 'read_ahead': 1, 'rescale': None,
+                                                   'strategy': 'tiled', 'max_memory': 2 ** 30}
+    assert get_manifest_options({**tiled_options, 'slab_size': 64}) != get_manifest_options(tiled_options)
@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import pytest
+# make the modules of the parent directory importable
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ims_to_ome_tiff_converter
+from benchmark.synthetic_ims import write_synthetic_ims_file
+from instrumentation import configure_instrumentation, get_stage_records, profile_stage
+from ims_to_ome_tiff_converter import iterate_slabs_read_ahead, stream_ims_to_ome_tiff_file
+
+# time every slab read takes in the tests
+READ_DELAY = 0.05
+
+
+@pytest.fixture
+def instrumentation():
+    # enable the instrumentation for the test
+    configure_instrumentation(enabled=True)
+    yield
+    configure_instrumentation()
+
+
+@pytest.mark.parametrize('n_slots', [1, 2])
+def test_slab_reads_are_not_self_time_of_the_consumer(instrumentation, n_slots):
+    def read_slab(slot, z_start, z_stop):
+        # simulate a slow read
+        with profile_stage('read_ims'):
+            time.sleep(READ_DELAY)
+
+    # consume slabs without doing any work of its own
+    n_records = len(get_stage_records())
+    with profile_stage('write_ome_tiff'):
+        for _ in iterate_slabs_read_ahead(read_slab, [(z, z + 1) for z in range(8)], [[] for _ in range(n_slots)]):
+            pass
+    records = get_stage_records()[n_records:]
+    write_record = [r for r in records if r['stage'] == 'write_ome_tiff'][0]
+    # the consumer spends its time waiting for the reads, so almost nothing is left as its self time
+    assert write_record['wall_s'] >= 8 * READ_DELAY
+    assert write_record['self_wall_s'] < 2 * READ_DELAY
+
+
+def test_streamed_write_self_time_excludes_read_ahead(instrumentation, tmp_path, monkeypatch):
+    # write a small synthetic ims file
+    path_to_ims_file = str(tmp_path / 'synthetic.ims')
+    write_synthetic_ims_file(path_to_ims_file, image_size=(16, 64, 64), chunk_shape=(8, 64, 64), n_levels=1)
+    # slow down the slab reads of the converter
+    read_ims_slab_into_buffer = ims_to_ome_tiff_converter.read_ims_slab_into_buffer
+
+    def slow_read_ims_slab_into_buffer(*args, **kwargs):
+        time.sleep(READ_DELAY)
+        read_ims_slab_into_buffer(*args, **kwargs)
+
+    monkeypatch.setattr(ims_to_ome_tiff_converter, 'read_ims_slab_into_buffer', slow_read_ims_slab_into_buffer)
+    # stream the file with one slab read ahead
+    n_records = len(get_stage_records())
+    stream_ims_to_ome_tiff_file(path_to_ims_file, str(tmp_path / 'streamed.ome.tif'), slab_size=2, read_ahead=1)
+    records = get_stage_records()[n_records:]
+    write_record = [r for r in records if r['stage'] == 'write_ome_tiff'][0]
+    # the waits for the reader thread are nested stages of the write, so they are not counted as encoding
+    assert sum(r['wall_s'] for r in records if r['stage'] == 'wait_read') >= 4 * READ_DELAY
+    assert write_record['self_wall_s'] < 2 * READ_DELAY
+    # the reads themselves are still recorded by the reader thread
+    assert sum(r['bytes_read'] for r in records if r['stage'] == 'read_ims') == 16 * 3 * 64 * 64 * 2
@@ -0,0 +1,48 @@
+import gzip
+import os
+import sys
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+import nibabel as nib
+import numpy as np
+import pytest
+# make the modules of the parent directory and of utils importable
+path_to_repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.extend([path_to_repository, os.path.join(path_to_repository, 'utils')])
+from ome_tiff_to_nifti import write_nifti_file, run_nifti_writes, write_nnUNet_training_nifti_files
+
+
+@pytest.mark.parametrize('n_threads', [1, 4])
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.float32])
+def test_compressed_file_matches_nibabel(tmp_path, n_threads, dtype):
+    # create a channel of a ZCYX image in XYZ order, as the nnUNet exporter does
+    image = (np.random.default_rng(0).random((9, 2, 33, 47)) * 200).astype(dtype)
+    nii_image = nib.Nifti1Image(image[:, 1].transpose((2, 1, 0)), np.diag([0.5, 0.5, 2.0, 1.0]))
+    # write the image with nibabel and with small blocks, so blocks end within slices
+    nib.save(nii_image, str(tmp_path / 'reference.nii'))
+    with ThreadPoolExecutor(n_threads) as executor:
+        write_nifti_file(nii_image, str(tmp_path / 'image.nii.gz'), {'n_threads': n_threads, 'block_size': 1000},
+                         executor if n_threads > 1 else None)
+    # the decompressed file is byte for byte the file nibabel writes
+    with open(tmp_path / 'reference.nii', 'rb') as f, gzip.open(tmp_path / 'image.nii.gz') as g:
+        assert g.read() == f.read()
+
+
+def test_concurrent_writes_do_not_serialize_whole_volumes(tmp_path):
+    # create an image with two 32 MiB channels
+    image = np.random.default_rng(0).integers(0, 4000, (32, 2, 512, 1024), dtype=np.uint16)
+    writes = [(write_nnUNet_training_nifti_files, (str(tmp_path), image[:, c], [2.0, 0.5, 0.5], 0, c, 'BM'))
+              for c in range(2)]
+    # measure the memory numpy and the writers allocate while both channels are written
+    tracemalloc.start()
+    try:
+        run_nifti_writes(writes, {'n_threads': 4, 'block_size': 2 ** 20})
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    # only a window of blocks is held, less than a single serialized channel
+    assert peak_memory < image[:, 0].nbytes
+    # the files hold the channels
+    for c in range(2):
+        assert np.array_equal(nib.load(str(tmp_path / f'BM_000_{c:04d}.nii.gz')).get_fdata(),
+                              image[:, c].transpose((2, 1, 0)))
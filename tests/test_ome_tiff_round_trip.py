@@ -0,0 +1,52 @@
+import os
+import sys
+import h5py
+import numpy as np
+import pytest
+import tifffile
+# make the modules of the parent directory importable
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmark.synthetic_ims import write_synthetic_ims_file
+from ims_to_ome_tiff_converter import read_ims_attribute, read_image_from_ims_file, stream_ims_to_ome_tiff_file, \
+    stream_ims_to_pyramidal_ome_tiff_file
+
+
+@pytest.fixture(scope='module')
+def path_to_ims_file(tmp_path_factory):
+    # write a small synthetic ims file with three resolution levels
+    path_to_ims_file = str(tmp_path_factory.mktemp('ims') / 'synthetic.ims')
+    write_synthetic_ims_file(path_to_ims_file, image_size=(24, 200, 230), chunk_shape=(8, 64, 64), n_levels=3)
+    return path_to_ims_file
+
+
+@pytest.mark.parametrize('compression', ['zlib', 'zstd'])
+@pytest.mark.parametrize('tile', [None, (64, 64)])
+@pytest.mark.parametrize('read_ahead', [0, 1])
+def test_streamed_compressed_multithreaded_write(path_to_ims_file, tmp_path, compression, tile, read_ahead):
+    # stream small slabs, so the slab buffers are reused while tifffile encodes in several threads
+    path_to_ome_file = str(tmp_path / 'streamed.ome.tif')
+    stream_ims_to_ome_tiff_file(path_to_ims_file, path_to_ome_file, slab_size=2,
+                                tiff_options={'compression': compression, 'tile': tile, 'n_write_threads': 8},
+                                read_ahead=read_ahead)
+    # compare the pixels with the image read in memory
+    image_data_array, _ = read_image_from_ims_file(path_to_ims_file)
+    assert np.array_equal(tifffile.imread(path_to_ome_file), image_data_array)
+
+
+@pytest.mark.parametrize('tile', [None, (64, 64)])
+def test_pyramidal_compressed_multithreaded_write(path_to_ims_file, tmp_path, tile):
+    # stream all resolution levels with several encoding threads
+    path_to_ome_file = str(tmp_path / 'pyramid.ome.tif')
+    stream_ims_to_pyramidal_ome_tiff_file(path_to_ims_file, path_to_ome_file, slab_size=2,
+                                          tiff_options={'compression': 'zlib', 'tile': tile, 'n_write_threads': 8})
+    with h5py.File(path_to_ims_file, 'r') as f, tifffile.TiffFile(path_to_ome_file) as tif:
+        # iterate resolution levels of the pyramid
+        for level, series in enumerate(tif.series[0].levels):
+            level_array = series.asarray()
+            n_z, n_c, n_y, n_x = level_array.shape
+            # read the valid region of all channels of the level from the ims file
+            groups = [f['DataSet'][f'ResolutionLevel {level}']['TimePoint 0'][f'Channel {c}'] for c in range(n_c)]
+            level_planes = int(read_ims_attribute(groups[0].attrs, 'ImageSizeZ'))
+            expected = np.stack([group['Data'][:level_planes, :n_y, :n_x] for group in groups], axis=1)
+            # levels with fewer Z planes repeat each plane for the full resolution planes it covers
+            assert np.array_equal(level_array, expected[np.arange(n_z) * level_planes // n_z])
@@ -0,0 +1,71 @@
+import os
+import sys
+import numpy as np
+import pytest
+# make the modules of the parent directory importable
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmark.synthetic_ims import write_synthetic_ims_file
+from ims_to_ome_tiff_converter import read_resampled_image_from_ims_file
+from resampling import downsample_block_mean, downsample_block_majority, get_block_modes, get_resampled_origin
+
+
+def test_block_mean_of_partial_edge_blocks():
+    # a 1x3x5 slab, downsampled by 2 in Y and X, ends with partial blocks in both dimensions
+    slab = np.array([[[0, 2, 4, 6, 9],
+                      [2, 4, 6, 8, 1],
+                      [5, 5, 7, 1, 3]]], dtype=np.uint8)
+    out = np.empty((1, 2, 3), dtype=np.uint8)
+    downsample_block_mean(slab, (1, 2, 2), out)
+    # partial blocks are divided by their own number of voxels and integer means are rounded
+    assert np.array_equal(out, [[[2, 6, 5],
+                                 [5, 4, 3]]])
+
+
+def test_block_mean_is_exact_for_large_blocks():
+    # blocks of 4096 voxels along Z whose means lie just below and above a half, their sums exceed 2 ** 24
+    slab = np.full((4096, 2, 1), 62815, dtype=np.uint16)
+    slab[:2047, 0] += 1
+    slab[:2049, 1] += 1
+    out = np.empty((1, 2, 1), dtype=np.uint16)
+    downsample_block_mean(slab, (4096, 1, 1), out)
+    # the sums are exact, so the means are rounded to the correct side
+    assert np.array_equal(out, [[[62815], [62816]]])
+
+
+@pytest.mark.parametrize('max_counted_labels', [16, 0])
+def test_block_majority_ties_and_partial_edge_blocks(max_counted_labels):
+    # blocks of 2x2 voxels in Y and X, the last column is a partial block of two voxels
+    slab = np.array([[[3, 1, 2, 2, 5],
+                      [1, 3, 0, 0, 4],
+                      [7, 7, 6, 0, 0],
+                      [7, 1, 6, 6, 0]]], dtype=np.uint8)
+    out = np.empty((1, 2, 3), dtype=np.uint8)
+    # both the counting and, with max_counted_labels 0, the sorting path resolve ties in favour of the lower label
+    downsample_block_majority(slab, (1, 2, 2), out, max_counted_labels)
+    assert np.array_equal(out, [[[1, 0, 4],
+                                 [7, 6, 0]]])
+
+
+def test_block_modes_ignore_padding():
+    # a 1x1x3 slab, downsampled by 2 in every dimension, has 1 voxel of its last block and 7 voxels of -1 padding
+    slab = np.array([[[2, 2, 0]]], dtype=np.uint16)
+    # the padding never counts, even if it is the most frequent value of a block
+    assert np.array_equal(get_block_modes(slab, (2, 2, 2)), [[[2, 0]]])
+    # labels up to the largest value of the data type are kept
+    slab = np.array([[[65535, 65535, 1, 65535]]], dtype=np.uint16)
+    assert np.array_equal(get_block_modes(slab, (1, 1, 4)), [[[65535]]])
+
+
+def test_resampled_origin_is_centered_on_the_first_block(tmp_path):
+    # the first block of a dimension that holds at least one whole block starts at the origin
+    assert get_resampled_origin([10.0, 20.0, 30.0], [2.0, 0.5, 0.5], (8, 64, 64), (1, 2, 4)) == [10.0, 20.0, 30.0]
+    # a single partial block is centered on the voxels it holds
+    assert get_resampled_origin([10.0, 20.0, 30.0], [2.0, 0.5, 0.5], (8, 64, 1), (1, 2, 4)) == [10.0, 20.0, 29.25]
+    # write a synthetic ims file whose X dimension is shorter than its factor
+    path_to_ims_file = str(tmp_path / 'synthetic.ims')
+    write_synthetic_ims_file(path_to_ims_file, image_size=(4, 64, 1), chunk_shape=(4, 64, 1), n_levels=1)
+    image, metadata = read_resampled_image_from_ims_file(path_to_ims_file, (2.0, 1.0, 1.0))
+    # the resampled voxel of the single X block is centered on the original voxel
+    assert image.shape == (4, 3, 32, 1)
+    assert metadata['voxel_size'] == {'X': 1.0, 'Y': 1.0, 'Z': 2.0}
+    assert metadata['origin'] == {'X': -0.25, 'Y': 0.0, 'Z': 0.0}
@@ -0,0 +1,76 @@
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import h5py
+import numpy as np
+import pytest
+# make the modules of the parent directory importable
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmark.synthetic_ims import write_synthetic_ims_file
+from ims_chunk_reader import is_threaded_reading_supported, read_regions_threaded
+
+# regions (Z, Y, X) that cover whole chunks, parts of chunks and a single voxel of the 20x70x90 image
+REGIONS = [[(0, 20), (0, 70), (0, 90)],
+           [(3, 17), (5, 61), (7, 83)],
+           [(8, 9), (33, 34), (63, 64)]]
+
+
+def read_regions_with_both_readers(datasets, region):
+    """
+    Reads the same region of the passed datasets with the threaded reader and with h5py.
+
+    :param datasets: chunked HDF5 datasets (list)
+    :param region: list of (start, stop) tuples, one for each dimension (list)
+    :return: regions read by the threaded reader and by h5py (list, list)
+    """
+    # read all datasets at once with the threaded reader, the output arrays are not initialized on purpose
+    threaded = [np.empty([stop - start for start, stop in region], dtype=dataset.dtype) for dataset in datasets]
+    with ThreadPoolExecutor(4) as executor:
+        read_regions_threaded([(dataset, region, out) for dataset, out in zip(datasets, threaded)], executor)
+    # read the datasets with h5py
+    reference = [dataset[tuple(slice(start, stop) for start, stop in region)] for dataset in datasets]
+    return threaded, reference
+
+
+@pytest.mark.parametrize('region', REGIONS)
+@pytest.mark.parametrize('compression_level, shuffle', [(2, True), (2, False), (0, False)])
+@pytest.mark.parametrize('dtype', ['uint8', 'uint16', 'float32'])
+def test_threaded_reader_matches_h5py(tmp_path, region, compression_level, shuffle, dtype):
+    # write a synthetic ims file whose size is not a multiple of the chunk shape
+    path_to_ims_file = str(tmp_path / 'synthetic.ims')
+    write_synthetic_ims_file(path_to_ims_file, image_size=(20, 70, 90), dtype=dtype, chunk_shape=(8, 32, 32),
+                             compression_level=compression_level, n_levels=1, shuffle=shuffle)
+    with h5py.File(path_to_ims_file, 'r') as f:
+        datasets = [f[f'DataSet/ResolutionLevel 0/TimePoint 0/Channel {c}/Data'] for c in range(3)]
+        assert all(is_threaded_reading_supported(dataset) for dataset in datasets)
+        # the threaded reader returns exactly what h5py returns
+        threaded, reference = read_regions_with_both_readers(datasets, region)
+    for threaded_channel, reference_channel in zip(threaded, reference):
+        assert threaded_channel.dtype == reference_channel.dtype
+        assert np.array_equal(threaded_channel, reference_channel)
+
+
+@pytest.mark.parametrize('region', REGIONS)
+def test_unallocated_and_unfiltered_chunks_match_h5py(tmp_path, region):
+    # write a synthetic ims file and add a shuffled and compressed dataset where only some chunks are written
+    path_to_ims_file = str(tmp_path / 'synthetic.ims')
+    write_synthetic_ims_file(path_to_ims_file, image_size=(20, 70, 90), chunk_shape=(8, 32, 32), n_levels=1,
+                             shuffle=True)
+    with h5py.File(path_to_ims_file, 'a') as f:
+        channel_group = f['DataSet/ResolutionLevel 0/TimePoint 0/Channel 0']
+        sparse = channel_group.create_dataset('Sparse', shape=(24, 96, 96), dtype='uint16', chunks=(8, 32, 32),
+                                              compression='gzip', shuffle=True, fillvalue=7)
+        sparse[0:8, 32:64, 32:64] = channel_group['Data'][0:8, 32:64, 32:64]
+        # write a chunk whose deflate filter was skipped, as HDF5 does if compression does not pay off
+        plain_chunk = np.arange(8 * 32 * 32, dtype='uint16').reshape(8, 32, 32)
+        sparse.id.write_direct_chunk((8, 32, 64), plain_chunk.view(np.uint8).reshape(-1, 2).T.tobytes(),
+                                     filter_mask=0b10)
+    with h5py.File(path_to_ims_file, 'r') as f:
+        sparse = f['DataSet/ResolutionLevel 0/TimePoint 0/Channel 0/Sparse']
+        assert sparse.id.get_chunk_info_by_coord((16, 0, 0)).byte_offset is None
+        threaded, reference = read_regions_with_both_readers([sparse], region)
+    # unallocated chunks are returned as the fill value and skipped filters are not applied
+    assert np.array_equal(threaded[0], reference[0])
+    if region == REGIONS[0]:
+        assert (threaded[0][16:] == 7).all()
+        assert np.array_equal(threaded[0][8:16, 32:64, 64:90], plain_chunk[:, :, :26])
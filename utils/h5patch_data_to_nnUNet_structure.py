@@ -1,77 +1,275 @@
+import argparse
+import os
+import sys
 import h5py
 import numpy as np
 import nibabel as nib
-import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+# make the modules of the parent directory importable
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import profile_stage, run_instrumented, get_instrumentation_configuration, merge_stage_records, \
+    add_instrumentation_arguments, configure_instrumentation_from_arguments, print_stage_summary
+from ome_tiff_to_nifti import set_up_nnUNet_file_structure, write_nifti_file, get_nifti_file_ending
+
+
+def list_h5_patches(path_to_h5_file):
+    """
+    Lists all patches of a LabeledData h5 file, which holds a group per sample with a group per patch. The position of
+    a patch in the returned list is its image number in the nnUNet dataset.
+
+    :param path_to_h5_file: path to the h5 file with the patches (string)
+    :return: list of (image_nr, sample, patch) tuples (list)
+    """
+    with h5py.File(path_to_h5_file, 'r') as f:
+        # iterate samples and their patches in file order
+        patches = [(sample, patch) for sample in f.keys() for patch in f[sample].keys()]
+    # return patches with their image numbers
+    return [(image_nr, sample, patch) for image_nr, (sample, patch) in enumerate(patches)]
+
+
+def get_buffer(buffers, shape, dtype):
+    """
+    Returns a buffer of the passed shape and data type from a dictionary of buffers and allocates it only if no buffer
+    of this shape and type was used before, so the buffers are reused for all patches of the same size.
+
+    :param buffers: dictionary of buffers by shape and data type (dict)
+    :param shape: shape of the buffer (tuple)
+    :param dtype: data type of the buffer (numpy.dtype)
+    :return: buffer (numpy.ndarray)
+    """
+    # allocate buffer if it does not exist yet
+    if (shape, dtype) not in buffers:
+        buffers[(shape, dtype)] = np.empty(shape, dtype=dtype)
+    # return buffer
+    return buffers[(shape, dtype)]
+
+
+def read_unpadded_channel(dataset, padding, buffers):
+    """
+    Reads the channel of a patch without the padding of its first two axes into a reused buffer. Only the unpadded
+    hyperslab is read from the file.
+
+    :param dataset: channel dataset of the patch (h5py.Dataset)
+    :param padding: number of padded pixels at the start of the first two axes (int)
+    :param buffers: dictionary of reused buffers, see get_buffer (dict)
+    :return: unpadded channel (numpy.ndarray)
+    """
+    # get buffer of the unpadded shape
+    buffer = get_buffer(buffers, (dataset.shape[0] - padding, dataset.shape[1] - padding) + dataset.shape[2:],
+                        dataset.dtype)
+    # read the unpadded hyperslab into the buffer
+    dataset.read_direct(buffer, source_sel=np.s_[padding:, padding:])
+    # return buffer
+    return buffer
+
+
+def merge_label_channels(label_datasets, buffers):
+    """
+    Merges the label channels of a patch into a single label map. The pixels of the label channel 'label_..._n' are
+    set to n, where channels overlap the highest number wins. All channels are read into a single reused buffer and
+    merged in one max reduction.
+
+    :param label_datasets: dictionary of the label channel datasets by channel name (dict)
+    :param buffers: dictionary of reused buffers, see get_buffer (dict)
+    :return: merged label map (numpy.ndarray)
+    """
+    # read shape and data type of the label channels
+    first_dataset = next(iter(label_datasets.values()))
+    # get number of each label channel from the last character of its name
+    label_numbers = [int(channel[-1]) for channel in label_datasets]
+    # get data type that holds the label numbers, boolean masks would turn every number into True
+    dtype = np.result_type(first_dataset.dtype, np.uint8, np.min_scalar_type(max(label_numbers)))
+    # get buffer for all label channels
+    buffer = get_buffer(buffers, (len(label_datasets),) + first_dataset.shape, dtype)
+    # read label channels into the buffer
+    for i, dataset in enumerate(label_datasets.values()):
+        # check if the channel can be read directly into the buffer
+        if dataset.dtype == dtype:
+            dataset.read_direct(buffer[i])
+        else:
+            # read channel in its own data type and convert it into the buffer
+            channel = get_buffer(buffers, dataset.shape, dataset.dtype)
+            dataset.read_direct(channel)
+            buffer[i] = channel
+    label_numbers = np.array(label_numbers, dtype=dtype)
+    # set the pixels of each channel to its number
+    np.multiply(buffer, label_numbers.reshape((-1,) + (1,) * first_dataset.ndim), out=buffer)
+    # merge the channels in a single max reduction
+    return buffer.max(axis=0)
+
+
+def save_patch_nifti_file(data_array, path_to_nifti_file, nifti_options=None):
+    """
+    Saves a 2D patch as NIfTI file with a single slice and an identity affine.
+
+    :param data_array: 2D data of the patch (numpy.ndarray)
+    :param path_to_nifti_file: path of the written file (string)
+    :param nifti_options: compression of the NIfTI file, see ome_tiff_to_nifti.get_nifti_options (dict)
+    """
+    # add a third dimension with a single slice and create a nifti image object
+    nifti_image = nib.Nifti1Image(np.expand_dims(data_array, axis=2), np.eye(4))
+    # save the nifti file and measure it as a stage
+    with profile_stage('write_nifti', file=path_to_nifti_file) as stage:
+        stage['file_bytes'] = write_nifti_file(nifti_image, path_to_nifti_file, nifti_options)
+        stage['bytes_written'] = data_array.nbytes
 
-# define input path
-input_path = '//data/LabeledData.h5'
-# define output path
-output_path = '//data/Dataset001_BM'
-# use os.makedirs() to create the directory if it does not exist
-if not os.path.exists(output_path):
-    os.makedirs(output_path)
-# check if subdirectory imageTr exists
-if not os.path.exists(os.path.join(output_path,'imagesTr')):
-    os.makedirs(os.path.join(output_path,'imagesTr'))
-# check if subdirectory labelsTr exists
-if not os.path.exists(os.path.join(output_path,'labelsTr')):
-    os.makedirs(os.path.join(output_path,'labelsTr'))
-# input file
-f = h5py.File(input_path, 'r')
-# get list of samples
-list_of_samples = list(f.keys())
-# get number of samples
-n_samples = len(list_of_samples)
-
-# set image iterator
-im_it = 0
-# iterate samples
-for sample in f.keys():
-    # iterate patches
-    for patch in f[sample].keys():
-        # set input channel iterator to 0
-        in_ch = 0
-        # initialize list of label_channels
-        list_label_channels = []
-        # iterate channels
-        for channel in f[sample][patch].keys():
-            # check if it is an input channel
-            if channel[:10] == 'in_channel':
-                # convert data to numpy array
-                image = np.array(f[sample][patch][channel])
-                # remove padding from image
-                image = image[184:, 184:]
-                # add a third dimension with a single slice to the image
-                image = np.expand_dims(image, axis=2)
-                # create a nifti image object
-                nifti_image = nib.Nifti1Image(image, np.eye(4))
+
+def convert_h5_patches(path_to_h5_file, patches, path_to_images_tr, path_to_labels_tr, case_id='BM', padding=184,
+                       nifti_options=None):
+    """
+    Converts a batch of patches of a LabeledData h5 file into the nnUNet file structure. The input channels
+    ('in_channel...') are saved without their padding as separate images, the label channels are merged into a single
+    label map. The h5 file is opened once per batch and the buffers are reused for all patches of the batch.
+
+    :param path_to_h5_file: path to the h5 file with the patches (string)
+    :param patches: list of (image_nr, sample, patch) tuples, see list_h5_patches (list)
+    :param path_to_images_tr: path to the imagesTr directory of the dataset (string)
+    :param path_to_labels_tr: path to the labelsTr directory of the dataset (string)
+    :param case_id: prefix of the file names (string)
+    :param padding: number of padded pixels at the start of the first two axes of the input channels (int)
+    :param nifti_options: compression of the NIfTI files, see ome_tiff_to_nifti.get_nifti_options (dict)
+    :return: number of converted patches (int)
+    """
+    # read file ending of the nifti files
+    file_ending = get_nifti_file_ending(nifti_options)
+    # initialize dictionary of reused buffers
+    buffers = {}
+    with h5py.File(path_to_h5_file, 'r') as f:
+        # iterate patches
+        for image_nr, sample, patch in patches:
+            # get group of the patch
+            patch_group = f[sample][patch]
+            # get input and label channels in file order
+            input_channels = [channel for channel in patch_group.keys() if channel[:10] == 'in_channel']
+            label_datasets = {channel: patch_group[channel] for channel in patch_group.keys()
+                              if channel[:10] != 'in_channel'}
+            # check if the patch has a label channel
+            if not label_datasets:
+                raise ValueError(f'Patch "{sample}/{patch}" has no label channel!')
+
+            # iterate input channels
+            for in_ch, channel in enumerate(input_channels):
+                # read unpadded channel and measure it as a stage
+                with profile_stage('read_h5_patch', file=f'{sample}/{patch}/{channel}') as stage:
+                    image = read_unpadded_channel(patch_group[channel], padding, buffers)
+                    stage['bytes_read'] = image.nbytes
                 # save channel as nifti
-                nib.save(nifti_image, os.path.join(output_path, 'imagesTr', f'BM_{im_it:04d}_{in_ch:04d}.nii.gz'))
-                # increment input channel counter
-                in_ch += 1
-            else:
-                # fetch number from label channel
-                n = int(channel[-1])
-                # convert channel data to numpy array and multiply it with fetched number
-                label = np.array(f[sample][patch][channel])*n
-                # append label array to label channel list
-                list_label_channels.append(label)
-        # combine label arrays
-        # get first label channel
-        labels = next(iter(list_label_channels))
-        # iterate other label channels
-        for label_channel in list_label_channels:
-            # update labels
-            labels[labels < label_channel] = label_channel[labels < label_channel]
-
-        # add a third dimension with a single slice to the image
-        labels = np.expand_dims(labels, axis=2)
-        # create a nifti image object
-        nifti_labels = nib.Nifti1Image(labels, np.eye(4))
-        # save channel as nifti
-        nib.save(nifti_labels, os.path.join(output_path, 'labelsTr', f'BM_{im_it:04d}.nii.gz'))
-
-        # increment image counter
-        im_it += 1
-
-print('...finished processing!')
+                save_patch_nifti_file(image, os.path.join(path_to_images_tr,
+                                                          f'{case_id}_{image_nr:04d}_{in_ch:04d}{file_ending}'),
+                                      nifti_options)
+
+            # read and merge the label channels and measure it as a stage
+            with profile_stage('merge_labels', file=f'{sample}/{patch}') as stage:
+                labels = merge_label_channels(label_datasets, buffers)
+                stage['bytes_read'] = labels.nbytes * len(label_datasets)
+            # save labels as nifti
+            save_patch_nifti_file(labels, os.path.join(path_to_labels_tr, f'{case_id}_{image_nr:04d}{file_ending}'),
+                                  nifti_options)
+    # return number of converted patches
+    return len(patches)
+
+
+def h5patch_data_to_nnUNet(path_to_h5_file, path_to_nnUNet_dataset, dataset_id, case_id='BM', padding=184, n_jobs=1,
+                           batch_size=64, nifti_options=None):
+    """
+    Converts all patches of a LabeledData h5 file into the nnUNet file structure. The patches are split into batches
+    that are converted in a process pool, see convert_h5_patches.
+
+    :param path_to_h5_file: path to the h5 file with the patches (string)
+    :param path_to_nnUNet_dataset: directory for storing the nnUNet structured dataset (string)
+    :param dataset_id: dataset name of structure "DatasetXXX_NAME" (string)
+    :param case_id: prefix of the file names (string)
+    :param padding: number of padded pixels at the start of the first two axes of the input channels (int)
+    :param n_jobs: number of worker processes (int)
+    :param batch_size: number of patches that a worker converts at once (int)
+    :param nifti_options: compression of the NIfTI files, see ome_tiff_to_nifti.get_nifti_options (dict)
+    :return: number of converted patches (int)
+    """
+    # set up the folder structure for nnUNet
+    _, path_to_images_tr, path_to_labels_tr = set_up_nnUNet_file_structure(path_to_nnUNet_dataset, dataset_id)
+    # list all patches and split them into batches
+    patches = list_h5_patches(path_to_h5_file)
+    batches = [patches[i:i + batch_size] for i in range(0, len(patches), batch_size)]
+
+    # initialize counter for converted patches
+    n_converted = 0
+    # check if the patches should be converted in the main process
+    if n_jobs <= 1:
+        # iterate batches
+        for batch in batches:
+            n_converted += convert_h5_patches(path_to_h5_file, batch, path_to_images_tr, path_to_labels_tr, case_id,
+                                              padding, nifti_options)
+            # print status message
+            print(f'[{n_converted}/{len(patches)}] Converted patches into nnUNet file structure!')
+        # return number of converted patches
+        return n_converted
+
+    # create process pool
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        # submit batches, the stages measured in the workers are returned together with the result
+        futures = [executor.submit(run_instrumented, get_instrumentation_configuration(), convert_h5_patches,
+                                   path_to_h5_file, batch, path_to_images_tr, path_to_labels_tr, case_id, padding,
+                                   nifti_options)
+                   for batch in batches]
+        # iterate finished batches
+        for future in as_completed(futures):
+            # raise possible errors and add the stages of the worker to the records of the main process
+            n_batch, stage_records = future.result()
+            merge_stage_records(stage_records)
+            n_converted += n_batch
+            # print status message
+            print(f'[{n_converted}/{len(patches)}] Converted patches into nnUNet file structure!')
+    # return number of converted patches
+    return n_converted
+
+
+def main():
+    """
+    Main function for converting the patches of a LabeledData h5 file into the nnUNet file structure.
+    """
+    # create the parser object
+    parser = argparse.ArgumentParser(description='Converts the patches of a LabeledData h5 file into a nnUNet '
+                                                 'structured dataset.')
+
+    # add arguments for the input file and output directory
+    parser.add_argument('-i', '--input', required=True,
+                        help='Path to the h5 file with the patches')
+    parser.add_argument('-o', '--output', required=True,
+                        help='Directory for storing the nnUNet structured Dataset')
+    parser.add_argument('-d', '--dataset_id', default='Dataset001_BM',
+                        help='Dataset name, should be of structure "DatasetXXX_NAME" where XXX refers to a 3 digit '
+                             'id-number and NAME can be freely chosen (default: Dataset001_BM).')
+    parser.add_argument('-a', '--dataset_abbreviation', default='BM',
+                        help='short identifier as prefix to the single file names (default: BM)')
+    parser.add_argument('-p', '--padding', type=int, default=184,
+                        help='Number of padded pixels at the start of both axes of the input channels (default: 184)')
+    # add arguments for the parallelization and compression
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of worker processes (default: 1)')
+    parser.add_argument('--batch_size', type=int, default=64,
+                        help='Number of patches a worker converts at once (default: 64)')
+    parser.add_argument('--compression_level', type=int, default=1, choices=range(10), metavar='[0-9]',
+                        help='gzip level of the .nii.gz files (default: 1)')
+    parser.add_argument('--uncompressed', action='store_true',
+                        help='Write uncompressed .nii files')
+    # add arguments for profiling the processing stages
+    add_instrumentation_arguments(parser)
+    # parse the arguments
+    args = parser.parse_args()
+    # enable the instrumentation if requested
+    configure_instrumentation_from_arguments(args)
+
+    # convert patches
+    h5patch_data_to_nnUNet(args.input, args.output, args.dataset_id, args.dataset_abbreviation, args.padding,
+                           args.jobs, args.batch_size,
+                           {'compress': not args.uncompressed, 'compression_level': args.compression_level})
+
+    # print status message
+    print('...finished processing!')
+    # print time, bytes and memory of the processing stages if requested
+    if args.profile:
+        print_stage_summary()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,15 @@
-import h5py
+import argparse
 import json
+import math
+import os
+import sys
+import h5py
 import numpy as np
-
-
-# define path to ims file that should be analysed
-filename = '/home/sharedFolder/data/BMquant_dataset/young/diaphysis/FoxP3_Femur_3_Dia.ims'
-# define output path to the json file that should hold the tree structure information
-json_output_path = '../../data/info/ims_tree_structure_Femur_3_Dia.json'
+# make the modules of the parent directory importable
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ims_chunk_reader import is_threaded_reading_supported
+from instrumentation import profile_stage, add_instrumentation_arguments, configure_instrumentation_from_arguments, \
+    print_stage_summary
 
 
 def print_tree(name, obj):
@@ -18,34 +21,285 @@ def print_tree(name, obj):
     :return:
     """
     # check if object is an instance of some final classes or if one more layer should be analysed
-    if isinstance(obj, (h5py.Dataset, np.ndarray, np.uint64, np.float32)):
+    if isinstance(obj, (h5py.Dataset, np.ndarray, np.generic)):
         # return information the final layer instance
         return {"type": str(type(obj)), "shape": obj.shape, "dtype": str(obj.dtype)}
+    # read attribute items if the current object holds attributes
+    children = {key: print_tree(key, val) for key, val in obj.attrs.items()} if hasattr(obj, 'attrs') else {}
+    # read child items and update the child object dictionary if the current object is a group
+    if isinstance(obj, h5py.Group):
+        children.update({key: print_tree(key, val) for key, val in obj.items()})
+    # return the final dictionary of child items
+    return children
+
+
+def get_dataset_filter_pipeline(dataset):
+    """
+    Returns the HDF5 filters of a dataset with their names and options in the order they are applied when writing.
+
+    :param dataset: HDF5 dataset (h5py.Dataset)
+    :return: list of {'id': int, 'name': str, 'options': list} dicts (list)
+    """
+    # read dataset creation property list
+    plist = dataset.id.get_create_plist()
+    # initialize empty list of filters
+    filters = []
+    # iterate filters of the pipeline
+    for i in range(plist.get_nfilters()):
+        filter_id, _, options, name = plist.get_filter(i)
+        filters.append({'id': filter_id, 'name': name.decode(errors='replace'), 'options': list(options)})
+    # return filters
+    return filters
+
+
+def read_chunk_byte_offsets(dataset):
+    """
+    Reads the byte offset in the file of every allocated chunk of a dataset, ordered by the position of the chunk in
+    the dataset (C order of the chunk grid). Only the chunk index is read, no chunk data.
+
+    :param dataset: chunked HDF5 dataset (h5py.Dataset)
+    :return: list of (byte_offset, stored_size) tuples (list)
+    """
+    # initialize empty list of chunk infos
+    chunk_infos = []
+    # check if the chunk index can be iterated in a single call, it is much faster than querying chunk by chunk
+    if hasattr(dataset.id, 'chunk_iter'):
+        dataset.id.chunk_iter(chunk_infos.append)
     else:
-        # check if the current objects holds attribute items
-        try:
-            # read child items
-            children = {**{key: print_tree(key, val) for key, val in obj.attrs.items()}}
-        except:
-            # initialize an empty dictionary for child items
-            children = {}
-        # check if the current object holds items
-        try:
-            # read child items and update the child object dictionary
-            children.update({key: print_tree(key, val) for key, val in obj.items()})
-        finally:
-            # update the child objects and return the final dictionary of child items
-            return {**children}
-
-
-# open the ims file
-with h5py.File(filename, 'r') as f:
-    # get the tree structure of the file
-    tree = print_tree(filename, f)
-
-    # write the tree to a JSON file
-    with open(json_output_path, 'w') as file:
-        json.dump(tree, file, indent=4)
-
-# print status message
-print(f'Finished IMS file tree analysis!')
+        chunk_infos = [dataset.id.get_chunk_info(i) for i in range(dataset.id.get_num_chunks())]
+    # return byte offsets and sizes in the order of the chunk positions
+    return [(info.byte_offset, info.size) for info in sorted(chunk_infos, key=lambda info: info.chunk_offset)]
+
+
+def get_dataset_storage_layout(dataset):
+    """
+    Returns the storage layout of a dataset: chunk shape, filters with compression and level, logical and stored
+    bytes, allocated and unallocated chunks and whether the chunks are stored in the order they are read. For the
+    Data datasets of an Imaris file the number of bytes of the valid, unpadded image is returned as well.
+
+    :param dataset: HDF5 dataset (h5py.Dataset)
+    :return: storage layout (dict)
+    """
+    # read logical and stored bytes
+    logical_bytes = int(dataset.size) * dataset.dtype.itemsize
+    stored_bytes = int(dataset.id.get_storage_size())
+    # initialize layout
+    layout = {'shape': list(dataset.shape),
+              'dtype': str(dataset.dtype),
+              'chunks': list(dataset.chunks) if dataset.chunks else None,
+              'filters': get_dataset_filter_pipeline(dataset),
+              'compression': dataset.compression,
+              'compression_level': dataset.compression_opts if dataset.compression == 'gzip' else None,
+              'shuffle': dataset.shuffle,
+              'logical_bytes': logical_bytes,
+              'stored_bytes': stored_bytes,
+              'compression_ratio': logical_bytes / stored_bytes if stored_bytes else None,
+              'n_chunks': None,
+              'n_allocated_chunks': None,
+              'n_unallocated_chunks': None,
+              'chunk_order': None,
+              'byte_range': None}
+
+    # read valid image size of Imaris data from the attributes of the channel group
+    parent_attributes = dataset.parent.attrs
+    if all(f'ImageSize{d}' in parent_attributes for d in 'XYZ'):
+        image_size = [int(parent_attributes[f'ImageSize{d}'].tobytes().decode()) for d in 'ZYX']
+        layout['valid_bytes'] = int(np.prod(image_size)) * dataset.dtype.itemsize
+
+    # check if the dataset is chunked
+    if dataset.chunks and dataset.size:
+        # count chunks of the chunk grid and the allocated chunks
+        layout['n_chunks'] = int(np.prod([math.ceil(s / c) for s, c in zip(dataset.shape, dataset.chunks)]))
+        chunk_byte_offsets = read_chunk_byte_offsets(dataset)
+        layout['n_allocated_chunks'] = len(chunk_byte_offsets)
+        layout['n_unallocated_chunks'] = layout['n_chunks'] - len(chunk_byte_offsets)
+        # check if the chunks follow each other in the file in the order of their positions
+        if chunk_byte_offsets:
+            n_forward = sum(b[0] > a[0] for a, b in zip(chunk_byte_offsets, chunk_byte_offsets[1:]))
+            layout['chunk_order'] = 'sequential' if n_forward >= 0.9 * (len(chunk_byte_offsets) - 1) else 'scattered'
+            layout['byte_range'] = [min(offset for offset, _ in chunk_byte_offsets),
+                                    max(offset + size for offset, size in chunk_byte_offsets)]
+    # check if the contiguous dataset is allocated
+    elif dataset.id.get_offset() is not None:
+        layout['byte_range'] = [dataset.id.get_offset(), dataset.id.get_offset() + stored_bytes]
+
+    # return layout
+    return layout
+
+
+def suggest_read_plan(f, datasets, slab_memory=512 * 2 ** 20, max_memory=None):
+    """
+    Suggests the converter settings for reading the full resolution of an Imaris file from the storage layout of the
+    channel datasets of resolution level 0 and time point 0. The slab size is a multiple of the chunk depth, so every
+    chunk is decoded exactly once, and as large as fits into the slab memory. Channels that are stored one after
+    another in the file are read channel by channel (in-memory mode), channels whose chunks are interleaved are read
+    slab by slab across all channels (streaming mode).
+
+    :param f: opened Imaris ims file (h5py.File)
+    :param datasets: storage layouts by dataset path, see get_dataset_storage_layout (dict)
+    :param slab_memory: memory of a slab of all channels in bytes (int)
+    :param max_memory: memory that is available for reading the whole image in bytes, if None only the channel layout
+                       decides (int)
+    :return: suggested settings (dict) or None if the file holds no Imaris image data
+    """
+    # get paths and layouts of the channel datasets of the full resolution
+    paths = [path for path in datasets if path.startswith('DataSet/ResolutionLevel 0/TimePoint 0/') and
+             path.endswith('/Data')]
+    layouts = [datasets[path] for path in paths]
+    if not layouts:
+        return None
+
+    # read size of a Z plane of all channels
+    shape = layouts[0]['shape']
+    plane_bytes = sum(int(np.prod(layout['shape'][1:])) * np.dtype(layout['dtype']).itemsize for layout in layouts)
+    # use the chunk depth as step of the slab size
+    chunk_depth = layouts[0]['chunks'][0] if layouts[0]['chunks'] else 1
+    slab_size = min(max(1, slab_memory // (plane_bytes * chunk_depth)) * chunk_depth,
+                    math.ceil(shape[0] / chunk_depth) * chunk_depth)
+
+    # check if the byte ranges of the channels overlap, i.e. if their chunks are interleaved in the file
+    byte_ranges = sorted(layout['byte_range'] for layout in layouts if layout['byte_range'])
+    interleaved = any(b[0] < a[1] for a, b in zip(byte_ranges, byte_ranges[1:]))
+    # check if the whole image fits into the memory
+    image_bytes = sum(layout.get('valid_bytes', layout['logical_bytes']) for layout in layouts)
+    fits_memory = max_memory is None or image_bytes <= max_memory
+    # check if the compressed chunks can be decoded in parallel threads
+    threaded = all(layout['compression'] for layout in layouts) and \
+        all(is_threaded_reading_supported(f[path]) for path in paths)
+
+    # select read order
+    if interleaved or not fits_memory:
+        read_order = 'slab_major'
+        reason = ('the chunks of the channels are interleaved in the file' if interleaved else
+                  'the image does not fit into the memory') + ', so all channels are read slab by slab'
+    else:
+        read_order = 'channel_major'
+        reason = 'the channels are stored one after another and the image fits into the memory, so every channel ' \
+                 'is read in one sequential pass'
+    # return suggestion
+    return {'slab_size': int(slab_size),
+            'read_order': read_order,
+            'stream': read_order == 'slab_major',
+            'backend': 'threaded' if threaded else 'h5py',
+            'image_bytes': int(image_bytes),
+            'reason': reason}
+
+
+def profile_ims_storage_layout(path_to_ims_file, slab_memory=512 * 2 ** 20, max_memory=None):
+    """
+    Profiles the storage layout of all datasets of an Imaris ims file and suggests the slab size and read order for
+    converting it. Only the metadata and the chunk index are read, no chunk data.
+
+    :param path_to_ims_file: path to the ims file (string)
+    :param slab_memory: memory of a slab of all channels in bytes, see suggest_read_plan (int)
+    :param max_memory: memory that is available for reading the whole image in bytes (int)
+    :return: {'file': path, 'file_bytes': int, 'datasets': {path: layout}, 'suggestion': dict} (dict)
+    """
+    # measure reading the metadata and chunk index as a stage
+    with profile_stage('read_layout', file=path_to_ims_file) as stage, h5py.File(path_to_ims_file, 'r') as f:
+        # count the size of the file
+        stage['file_bytes'] = os.path.getsize(path_to_ims_file)
+        # collect paths of all datasets
+        dataset_paths = []
+        f.visititems(lambda name, obj: dataset_paths.append(name) if isinstance(obj, h5py.Dataset) else None)
+        # read storage layout of every dataset
+        datasets = {path: get_dataset_storage_layout(f[path]) for path in dataset_paths}
+        # suggest how to read the full resolution
+        suggestion = suggest_read_plan(f, datasets, slab_memory, max_memory)
+    # return profile
+    return {'file': path_to_ims_file,
+            'file_bytes': os.path.getsize(path_to_ims_file),
+            'datasets': datasets,
+            'suggestion': suggestion}
+
+
+def print_storage_layout(profile, show_all=False):
+    """
+    Prints a table with the storage layout of the Data datasets (or of all datasets) and the suggested read plan.
+
+    :param profile: storage layout profile, see profile_ims_storage_layout (dict)
+    :param show_all: if True all datasets are printed, not only the image data (bool)
+    """
+    # print table header
+    print(f'{"dataset":<50}{"chunks":>16}{"filter":>12}{"logical [MB]":>14}{"stored [MB]":>13}{"ratio":>7}'
+          f'{"chunks (alloc/total)":>22}{"order":>12}')
+    # iterate datasets
+    for path, layout in profile['datasets'].items():
+        # skip datasets that hold no image data
+        if not show_all and not path.endswith('/Data'):
+            continue
+        # format chunk shape, filter and chunk counts
+        chunks = 'x'.join(str(c) for c in layout['chunks']) if layout['chunks'] else 'contiguous'
+        compression = f'{layout["compression"]}' + (f' {layout["compression_level"]}'
+                                                    if layout['compression_level'] is not None else '')
+        chunk_counts = f'{layout["n_allocated_chunks"]}/{layout["n_chunks"]}' if layout['n_chunks'] else '-'
+        ratio = f'{layout["compression_ratio"]:.2f}' if layout['compression_ratio'] else '-'
+        print(f'{path:<50}{chunks:>16}{compression:>12}{layout["logical_bytes"] / 1024 ** 2:>14.1f}'
+              f'{layout["stored_bytes"] / 1024 ** 2:>13.1f}{ratio:>7}{chunk_counts:>22}'
+              f'{str(layout["chunk_order"]):>12}')
+
+    # print suggestion
+    suggestion = profile['suggestion']
+    if suggestion is not None:
+        print(f'Suggested read plan: --slab_size {suggestion["slab_size"]} --backend {suggestion["backend"]}'
+              f'{" --stream" if suggestion["stream"] else ""} ({suggestion["read_order"]}, {suggestion["reason"]})')
+
+
+def main():
+    """
+    Main function for profiling the storage layout of an ims file and, if requested, writing its tree structure.
+    """
+    # create the parser object
+    parser = argparse.ArgumentParser(description='Profiles the storage layout (chunks, filters, stored and logical '
+                                                 'bytes) of an Imaris ims file and suggests how to read it.')
+
+    # add arguments for the input file and the outputs
+    parser.add_argument('-i', '--input', required=True,
+                        help='Path to the ims file that should be analysed')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Path to a JSON file for storing the storage layout profile')
+    parser.add_argument('--tree', default=None,
+                        help='Path to a JSON file for storing the tree structure of the file')
+    parser.add_argument('--slab_memory', type=float, default=512,
+                        help='Memory of a slab of all channels in MB, used for the suggested slab size (default: 512)')
+    parser.add_argument('--max_memory', type=float, default=None,
+                        help='Memory in GB that is available for reading the whole image (default: unlimited)')
+    parser.add_argument('-a', '--all', action='store_true',
+                        help='Print all datasets, not only the image data')
+    # add arguments for profiling the processing stages
+    add_instrumentation_arguments(parser)
+    # parse the arguments
+    args = parser.parse_args()
+    # enable the instrumentation if requested
+    configure_instrumentation_from_arguments(args)
+
+    # profile the storage layout
+    profile = profile_ims_storage_layout(args.input, int(args.slab_memory * 2 ** 20),
+                                         int(args.max_memory * 2 ** 30) if args.max_memory else None)
+    # print table and suggestion
+    print_storage_layout(profile, args.all)
+    # write the profile to a JSON file
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(profile, file, indent=4)
+
+    # check if the tree structure should be written
+    if args.tree:
+        # open the ims file and measure reading the tree as a stage
+        with h5py.File(args.input, 'r') as f, profile_stage('read_tree', file=args.input):
+            # get the tree structure of the file
+            tree = print_tree(args.input, f)
+        # write the tree to a JSON file
+        with open(args.tree, 'w') as file:
+            json.dump(tree, file, indent=4)
+
+    # print status message
+    print(f'Finished IMS file tree analysis!')
+
+    # print time and memory of the processing stages if requested
+    if args.profile:
+        print_stage_summary()
+
+
+if __name__ == "__main__":
+    main()
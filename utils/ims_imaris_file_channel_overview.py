@@ -1,67 +1,71 @@
+import argparse
 import h5py
 import json
 import os
-
-# define input path
-input_path = '/home/sharedFolder/data/BMquant_dataset/aged/diaphysis'
-
-# define output path
-output_path = '../../data/info/'
-
-# define name of info json file
-json_file_name = 'channel_info_aged_diaphysis.json'
-
-
-# create directory if it does not exist
-if not os.path.exists(output_path):
-    os.makedirs(output_path)
-
-# get a list of all the files in the directory
-file_list = os.listdir(input_path)
-
-# filter the list to only include .ims files
-ims_files = [f for f in file_list if f.endswith('.ims')]
-
-# initialize dict for channels in each image
-image_info_list = []
-
-# iterate images
-for n_image, image_file in enumerate(ims_files):
-    # open ims file
-    with h5py.File(os.path.join(input_path, image_file), 'r') as f:
+import sys
+# make the modules of the parent directory importable
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import profile_stage, add_instrumentation_arguments, configure_instrumentation_from_arguments, \
+    print_stage_summary
+
+
+def read_ims_channel_names(path_to_ims_file):
+    """
+    Opens an Imaris ims file and returns the names of its channels in the order of the channel ids
+    :param path_to_ims_file: path to an ims file (string)
+    :return: channel names (list)
+    """
+    # open ims file and measure reading the channel names as a stage
+    with h5py.File(path_to_ims_file, 'r') as f, profile_stage('read_metadata', file=path_to_ims_file):
         # generate list of available channels
         image_channel_ids = [int(ch_id.split(sep=' ')[-1]) for ch_id in f['DataSetInfo'] if ch_id.startswith('Channel')]
         # sort image channel ids
         image_channel_ids.sort()
         # generate list of channel names
-        image_channel_names = [f['DataSetInfo'][f'Channel {i}'].attrs['Name'].tobytes().decode('ascii', 'ignore') for i in image_channel_ids]
+        image_channel_names = [f['DataSetInfo'][f'Channel {i}'].attrs['Name'].tobytes().decode('ascii', 'ignore')
+                               for i in image_channel_ids]
+    # return the channel names
+    return image_channel_names
+
+
+def read_ims_channel_overview(path_to_directory):
+    """
+    Iterates ims files of the passed directory and returns a dictionary containing the channel names of all files as
+    well as the counts in how many images a certain channel is available
+    :param path_to_directory: path to a directory that holds ims files (string)
+    :return: (dict) dictionary with information about the channels of the single images and channel counts. It is
+             structured in the following way: {'image_info_list': [info_dict_image0, info_dict_image1, ...],
+                                               'channel_counts': {channel_name0: count,
+                                                                  channel_name2: count, ...}}
+    """
+    # get a list of all the files in the directory
+    file_list = os.listdir(path_to_directory)
+
+    # filter the list to only include .ims files
+    ims_files = [f for f in file_list if f.endswith('.ims')]
+
+    # initialize dict for channels in each image
+    image_info_list = []
 
-    # append entry to image channel list
-    image_info_list.append({'image_id': n_image,
-                            'file_name': image_file,
-                            'n_channels': len(image_channel_names),
-                            'channel_names': image_channel_names})
+    # iterate images
+    for n_image, image_file in enumerate(ims_files):
+        # read channel names
+        image_channel_names = read_ims_channel_names(os.path.join(path_to_directory, image_file))
+
+        # append entry to image channel list
+        image_info_list.append({'image_id': n_image,
+                                'file_name': image_file,
+                                'n_channels': len(image_channel_names),
+                                'channel_names': image_channel_names})
 
     # initialize a dictionary for counting the images where a single channel is present
     count_dict = {}
     # iterate image info list
     for img_info in image_info_list:
-        # read channel names from image info dict
-        channels = img_info['channel_names']
-        # iterate channels
-        for ch in channels:
-            # initialize channel counter
-            count_dict[ch] = 0
-    # iterate images
-    for img_info in image_info_list:
-        # read image channels from info dict
-        channels = img_info['channel_names']
-        # iterate channels of counter dict
-        for ch in count_dict.keys():
-            # check if channel is present in current image
-            if ch in channels:
-                # if so, increment counter
-                count_dict[ch] += 1
+        # iterate channels of the image, each channel is counted once per image
+        for ch in dict.fromkeys(img_info['channel_names']):
+            # increment counter
+            count_dict[ch] = count_dict.get(ch, 0) + 1
     # sort counting dict by most frequent channels
     count_dict = {k: v for k, v in sorted(count_dict.items(), key=lambda item: item[1], reverse=True)}
 
@@ -69,11 +73,49 @@ for n_image, image_file in enumerate(ims_files):
     info_dict = {'image_info_list': image_info_list,
                  'channel_counts': count_dict}
 
-    # write info_dict to a JSON file
-    with open(os.path.join(output_path, json_file_name), 'w') as f:
-        json.dump(info_dict, f, indent=4)
+    # return info_dict
+    return info_dict
+
+
+def main():
+    """
+    Main function for the channel overview of Imaris ims files. It reads the channel names of all ims files in a given
+    directory, counts in how many images each channel is available and saves both in a JSON file at a given output
+    path.
+    """
+
+    # Create the parser object
+    parser = argparse.ArgumentParser(description='Read the channel names of all Imaris ims files in a given directory '
+                                                 'and count the images that hold each channel.')
 
+    # Add arguments for the input directory and output file
+    parser.add_argument('-i', '--input', required=True,
+                        help='Path to a directory with ims files')
+    parser.add_argument('-o', '--output', required=True,
+                        help='Path for storing a JSON file with the channel name information')
+    # add arguments for profiling the processing stages
+    add_instrumentation_arguments(parser)
 
+    # Parse the arguments
+    args = parser.parse_args()
+    # enable the instrumentation if requested
+    configure_instrumentation_from_arguments(args)
+
+    # create output directory if it does not exist
+    if os.path.dirname(args.output) and not os.path.exists(os.path.dirname(args.output)):
+        os.makedirs(os.path.dirname(args.output))
+
+    # read channel names of all ims files and count the channel occurrences
+    info_dict = read_ims_channel_overview(args.input)
+
+    # write info_dict to a JSON file
+    with open(args.output, 'w') as f:
+        json.dump(info_dict, f, indent=4)
 
+    # print time and memory of the processing stages if requested
+    if args.profile:
+        print_stage_summary()
 
 
+if __name__ == "__main__":
+    main()
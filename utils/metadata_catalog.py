@@ -0,0 +1,357 @@
+import argparse
+import os
+import sys
+import json
+import time
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import h5py
+import tifffile as tif
+
+# make the converter in the parent directory importable
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ims_to_ome_tiff_converter import read_metadata_from_ims_file, get_ims_channel_datasets
+from instrumentation import profile_stage, add_instrumentation_arguments, configure_instrumentation_from_arguments, \
+    print_stage_summary
+
+# file endings of the formats that are catalogued
+CATALOG_FILE_ENDINGS = ('.ims', '.ome.tif')
+
+# table definitions of the catalog
+CATALOG_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    format TEXT,
+    size INTEGER,
+    mtime REAL,
+    n_channels INTEGER,
+    size_x INTEGER,
+    size_y INTEGER,
+    size_z INTEGER,
+    voxel_size_x REAL,
+    voxel_size_y REAL,
+    voxel_size_z REAL,
+    dtype TEXT,
+    scanned_at REAL
+);
+CREATE TABLE IF NOT EXISTS channels (
+    path TEXT REFERENCES files(path) ON DELETE CASCADE,
+    channel_index INTEGER,
+    name TEXT,
+    PRIMARY KEY (path, channel_index)
+);
+CREATE INDEX IF NOT EXISTS channels_name ON channels(name);
+'''
+
+
+def open_catalog(path_to_catalog):
+    """
+    Opens the SQLite catalog at the passed path and creates the tables if they do not exist yet.
+
+    :param path_to_catalog: path to the SQLite catalog file (string)
+    :return: connection to the catalog (sqlite3.Connection)
+    """
+    # check if directory of the catalog exists, if not create it
+    if os.path.dirname(path_to_catalog) and not os.path.exists(os.path.dirname(path_to_catalog)):
+        os.makedirs(os.path.dirname(path_to_catalog))
+    # open catalog and create tables
+    connection = sqlite3.connect(path_to_catalog)
+    connection.execute('PRAGMA foreign_keys = ON')
+    connection.executescript(CATALOG_SCHEMA)
+    # return connection
+    return connection
+
+
+def read_ims_file_info(path_to_ims_file):
+    """
+    Reads channel names, image size, voxel size and data type of an Imaris ims file without reading pixel data.
+
+    :param path_to_ims_file: path to the ims file (string)
+    :return: file info (dict)
+    """
+    # open ims file
+    with h5py.File(path_to_ims_file, 'r') as f:
+        # read list of channels and metadata
+        channel_list, metadata_dict = read_metadata_from_ims_file(f, path_to_ims_file)
+        # read data type of the first channel
+        dtype = str(get_ims_channel_datasets(f, channel_list[:1])[0].dtype) if channel_list else None
+    # return file info
+    return {'format': 'ims',
+            'channel_names': metadata_dict['channel_names'],
+            'image_size': metadata_dict['image_size'],
+            'voxel_size': metadata_dict['voxel_size'],
+            'dtype': dtype}
+
+
+def read_ome_tiff_file_info(path_to_ome_tiff_file):
+    """
+    Reads channel names, image size, voxel size and data type of an OME TIFF file without reading pixel data. The
+    ImageJ metadata written by the converter is used, for OME-XML files (e.g. pyramids) the OME metadata is used.
+
+    :param path_to_ome_tiff_file: path to the OME TIFF file (string)
+    :return: file info (dict)
+    """
+    with tif.TiffFile(path_to_ome_tiff_file) as f:
+        # read shape, axes and data type of the image series
+        series = f.series[0]
+        shape = dict(zip(series.axes, series.shape))
+        dtype = str(series.dtype)
+        # read metadata
+        metadata = f.imagej_metadata
+        # check if ImageJ metadata with channel names is available
+        if metadata and 'channel_names' in metadata:
+            # restore list and dict from their string representation
+            channel_names = eval(metadata['channel_names'])
+            voxel_size = eval(metadata['voxel_size']) if 'voxel_size' in metadata else {}
+        else:
+            # read channel names and voxel size from the OME metadata
+            pixels = tif.xml2dict(f.ome_metadata)['OME']['Image'] if f.ome_metadata else {}
+            pixels = (pixels[0] if isinstance(pixels, list) else pixels).get('Pixels', {})
+            channels = pixels.get('Channel', [])
+            channels = channels if isinstance(channels, list) else [channels]
+            channel_names = [ch.get('Name', '') for ch in channels]
+            voxel_size = {d: pixels[f'PhysicalSize{d}'] for d in 'XYZ' if f'PhysicalSize{d}' in pixels}
+    # return file info
+    return {'format': 'ome.tif',
+            'channel_names': channel_names,
+            'image_size': {d: shape.get(d, 1) for d in 'XYZ'},
+            'voxel_size': voxel_size,
+            'dtype': dtype}
+
+
+def read_file_info(path_to_file):
+    """
+    Reads the catalog information of an ims or OME TIFF file.
+
+    :param path_to_file: path to the file (string)
+    :return: file info (dict)
+    """
+    # check file format
+    if path_to_file.endswith('.ims'):
+        return read_ims_file_info(path_to_file)
+    return read_ome_tiff_file_info(path_to_file)
+
+
+def find_catalog_files(path_to_directory, recursive=True):
+    """
+    Returns all ims and OME TIFF files of the passed directory.
+
+    :param path_to_directory: path to the directory (string)
+    :param recursive: if True subdirectories are searched as well (bool)
+    :return: list of absolute file paths (list)
+    """
+    # initialize empty list for files
+    file_list = []
+    # walk directory tree
+    for root, directories, files in os.walk(os.path.abspath(path_to_directory)):
+        # add catalogued files of the current directory
+        file_list.extend(os.path.join(root, f) for f in files if f.endswith(CATALOG_FILE_ENDINGS))
+        # stop after the first directory if not recursive
+        if not recursive:
+            break
+    # return sorted list of files
+    return sorted(file_list)
+
+
+def scan_file(path_to_file, catalogued_stat):
+    """
+    Checks a single file against its catalog entry and reads its information if it is new or changed. Runs in the
+    threads of the scanner, so the latency of opening files on network filesystems overlaps. Errors of unreadable or
+    truncated files are returned instead of raised, so a single broken file does not abort the scan.
+
+    :param path_to_file: path to the file (string)
+    :param catalogued_stat: (size, mtime) of the catalog entry, None if the file is not catalogued (tuple)
+    :return: (path, stat, info, error), info is None if the file did not change or could not be read, error is None if
+             the file was checked successfully (tuple)
+    """
+    try:
+        # read size and modification time
+        stat = os.stat(path_to_file)
+        stat = (stat.st_size, stat.st_mtime)
+        # check if the file did not change since it was catalogued
+        if catalogued_stat is not None and tuple(catalogued_stat) == stat:
+            return path_to_file, stat, None, None
+        # read file information
+        with profile_stage('read_metadata', file=path_to_file):
+            return path_to_file, stat, read_file_info(path_to_file), None
+    except Exception as error:
+        # return the error of the file
+        return path_to_file, None, None, error
+
+
+def scan_directories(connection, directories, n_threads=16, recursive=True):
+    """
+    Updates the catalog with all ims and OME TIFF files of the passed directories. Only files that are new or whose
+    size or modification time changed are opened, they are read in a thread pool. Catalog entries of files that no
+    longer exist in the scanned directories are removed. All database writes happen in the calling thread. Files that
+    can not be read are reported and skipped, their catalog entries are removed, so they are read again by the next
+    scan.
+
+    :param connection: connection to the catalog (sqlite3.Connection)
+    :param directories: list of directories that are scanned (list)
+    :param n_threads: number of threads that check and read files in parallel (int)
+    :param recursive: if True subdirectories are scanned as well (bool)
+    :return: number of files that were (re-)read (int), list of the files that could not be read (list)
+    """
+    # read catalogued size and modification time of all files
+    catalogued = {path: (size, mtime)
+                  for path, size, mtime in connection.execute('SELECT path, size, mtime FROM files')}
+    # initialize counter for read files and list of files that could not be read
+    n_read = 0
+    failed_files = []
+
+    # iterate directories
+    for directory in directories:
+        # find files of the directory
+        file_list = find_catalog_files(directory, recursive)
+        # check and read files in the thread pool
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            results = executor.map(lambda path: scan_file(path, catalogued.get(path)), file_list)
+            # iterate results in file order
+            for path_to_file, stat, info, error in results:
+                # check if the file could not be read
+                if error is not None:
+                    # print status message and remove the outdated catalog entry
+                    print(f'Failed to read "{path_to_file}": {error}')
+                    failed_files.append(path_to_file)
+                    connection.execute('DELETE FROM files WHERE path = ?', (path_to_file,))
+                    continue
+                # skip files that did not change
+                if info is None:
+                    continue
+                # read size and modification time of the file
+                size, mtime = stat
+                # replace catalog entry of the file
+                connection.execute('DELETE FROM files WHERE path = ?', (path_to_file,))
+                connection.execute('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                   (path_to_file, info['format'], size, mtime, len(info['channel_names']),
+                                    info['image_size']['X'], info['image_size']['Y'], info['image_size']['Z'],
+                                    info['voxel_size'].get('X'), info['voxel_size'].get('Y'),
+                                    info['voxel_size'].get('Z'), info['dtype'], time.time()))
+                connection.executemany('INSERT INTO channels VALUES (?, ?, ?)',
+                                       [(path_to_file, i, name) for i, name in enumerate(info['channel_names'])])
+                n_read += 1
+
+        # remove entries of files that no longer exist in the scanned directory
+        existing_files = set(file_list)
+        prefix = os.path.join(os.path.abspath(directory), '')
+        for path_to_file in catalogued:
+            if path_to_file.startswith(prefix) and path_to_file not in existing_files:
+                # check if the file lies in a subdirectory that was not scanned
+                if not recursive and os.path.dirname(path_to_file) != prefix.rstrip(os.sep):
+                    continue
+                connection.execute('DELETE FROM files WHERE path = ?', (path_to_file,))
+        # commit changes of the directory
+        connection.commit()
+
+    # return number of read files and the files that could not be read
+    return n_read, failed_files
+
+
+def query_files_with_channels(connection, channel_groups, file_format=None):
+    """
+    Returns all catalogued files that hold at least one channel of each passed channel group, e.g.
+    [['dapi'], ['endomucin', 'endoglin', 'collagen', 'cxcl12']] returns the files with dapi plus a vessel marker.
+
+    :param connection: connection to the catalog (sqlite3.Connection)
+    :param channel_groups: list of lists of alternative channel names (list)
+    :param file_format: if passed, only files of this format ('ims' or 'ome.tif') are returned (string)
+    :return: list of file paths (list)
+    """
+    # initialize query and parameters
+    query = 'SELECT path FROM files WHERE 1'
+    parameters = []
+    # add a condition for each channel group
+    for channel_group in channel_groups:
+        query += f' AND path IN (SELECT path FROM channels WHERE name IN ({", ".join("?" * len(channel_group))}))'
+        parameters.extend(channel_group)
+    # add condition for the file format
+    if file_format is not None:
+        query += ' AND format = ?'
+        parameters.append(file_format)
+    # return paths of the matching files
+    return [path for path, in connection.execute(query + ' ORDER BY path', parameters)]
+
+
+def get_channel_counts(connection, file_format=None):
+    """
+    Returns in how many catalogued files each channel name is present, sorted by the most frequent channels.
+
+    :param connection: connection to the catalog (sqlite3.Connection)
+    :param file_format: if passed, only files of this format ('ims' or 'ome.tif') are counted (string)
+    :return: channel counts (dict)
+    """
+    # count files per channel name
+    rows = connection.execute('SELECT name, COUNT(DISTINCT channels.path) AS n FROM channels JOIN files USING (path) '
+                              'WHERE ? IS NULL OR format = ? GROUP BY name ORDER BY n DESC, name',
+                              (file_format, file_format))
+    # return channel counts
+    return {name: n for name, n in rows}
+
+
+def main():
+    """
+    Main function of the metadata catalog. The 'scan' command updates the catalog with the ims and OME TIFF files of
+    the passed directories, 'query' lists the files holding one channel of each passed group (e.g. --has dapi
+    --has endomucin endoglin) and 'counts' lists in how many files each channel is present.
+    """
+    # create the parser object
+    parser = argparse.ArgumentParser(description='SQLite catalog of the metadata of ims and OME TIFF files.')
+    parser.add_argument('-c', '--catalog', required=True,
+                        help='Path to the SQLite catalog file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    # add arguments of the scan command
+    scan_parser = subparsers.add_parser('scan', help='Add new and changed files of the passed directories')
+    scan_parser.add_argument('-i', '--input', required=True, nargs='+',
+                             help='Directories that are scanned')
+    scan_parser.add_argument('-t', '--threads', type=int, default=16,
+                             help='Number of threads that read files in parallel (default: 16)')
+    scan_parser.add_argument('--non_recursive', action='store_true',
+                             help='Do not scan subdirectories')
+    # add arguments of the query command
+    query_parser = subparsers.add_parser('query', help='List files that hold one channel of each passed group')
+    query_parser.add_argument('--has', required=True, nargs='+', action='append', metavar='CHANNEL',
+                              help='Group of alternative channel names, can be passed several times')
+    query_parser.add_argument('--format', choices=['ims', 'ome.tif'], default=None,
+                              help='Only list files of this format')
+    # add arguments of the counts command
+    counts_parser = subparsers.add_parser('counts', help='Count in how many files each channel is present')
+    counts_parser.add_argument('--format', choices=['ims', 'ome.tif'], default=None,
+                               help='Only count files of this format')
+    # add arguments for profiling the processing stages
+    add_instrumentation_arguments(parser)
+    # parse the arguments
+    args = parser.parse_args()
+    # enable the instrumentation if requested
+    configure_instrumentation_from_arguments(args)
+
+    # open catalog
+    connection = open_catalog(args.catalog)
+    # check which command should be executed
+    if args.command == 'scan':
+        # update catalog
+        n_read, failed_files = scan_directories(connection, args.input, args.threads, not args.non_recursive)
+        # print status message
+        print(f'Read {n_read} new or changed files into the catalog {args.catalog}!')
+        # print number of files that could not be read
+        if failed_files:
+            print(f'Failed to read {len(failed_files)} files, they are read again by the next scan!')
+    elif args.command == 'query':
+        # print matching files
+        for path_to_file in query_files_with_channels(connection, [[n.lower() for n in g] for g in args.has],
+                                                      args.format):
+            print(path_to_file)
+    else:
+        # print channel counts
+        print(json.dumps(get_channel_counts(connection, args.format), indent=4))
+    # close catalog
+    connection.close()
+
+    # print time and memory of the processing stages if requested
+    if args.profile:
+        print_stage_summary()
+
+
+if __name__ == "__main__":
+    main()
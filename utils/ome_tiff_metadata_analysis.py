@@ -2,6 +2,11 @@ import argparse
 import tifffile as tif
 import json
 import os
+import sys
+# make the modules of the parent directory importable
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import profile_stage, add_instrumentation_arguments, configure_instrumentation_from_arguments, \
+    print_stage_summary
 
 
 def read_ome_tiff_metadata_file(path_to_image):
@@ -10,7 +15,7 @@ def read_ome_tiff_metadata_file(path_to_image):
     :param path_to_image: path to an OME TIFF file (string)
     :return:  metadata (dict)
     """
-    with tif.TiffFile(path_to_image) as f:
+    with tif.TiffFile(path_to_image) as f, profile_stage('read_metadata', file=path_to_image):
         # read metadata
         metadata = f.imagej_metadata
         # restore list from string of channel_names
@@ -96,9 +101,13 @@ def main():
                         help='Path to input OME TIFF file or directory')
     parser.add_argument('-o', '--output', required=True,
                         help='Path for storing a JSON file with the channel name information')
+    # add arguments for profiling the processing stages
+    add_instrumentation_arguments(parser)
 
     # Parse the arguments
     args = parser.parse_args()
+    # enable the instrumentation if requested
+    configure_instrumentation_from_arguments(args)
 
     # check if output directory exists, if not create it
     if not os.path.exists(os.path.dirname(args.output)):
@@ -116,6 +125,10 @@ def main():
     with open(os.path.join(args.output), 'w') as f:
         json.dump(image_info, f, indent=4)
 
+    # print time and memory of the processing stages if requested
+    if args.profile:
+        print_stage_summary()
+
 
 if __name__ == "__main__":
     main()
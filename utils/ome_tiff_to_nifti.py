@@ -1,7 +1,17 @@
 import argparse
 import os
 import json
-from ome_tiff_unify_channels import read_ome_tiff_image_and_metadata, channels_of_interest
+import sys
+import io
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+# make the modules of the parent directory importable
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import profile_stage, add_instrumentation_arguments, configure_instrumentation_from_arguments, \
+    print_stage_summary
+from ome_tiff_unify_channels import read_ome_tiff_metadata, read_ome_tiff_channels, channels_of_interest
+from resampling import get_resampling_factors, resample_image
 import nibabel as nib
 import numpy as np
 
@@ -27,30 +37,257 @@ def set_up_nnUNet_file_structure(path_to_nnUNet_dataset, dataset_id):
     return path_to_nnUNet_dataset, path_to_images_tr, path_to_labels_tr
 
 
-def write_nnUNet_training_nifti_files(path_output_directory, data_array, resolution, image_nr, channel_nr, case_id):
+# default options of the NIfTI output, level 1 is the gzip level nibabel uses
+DEFAULT_NIFTI_OPTIONS = {'compression_level': 1, 'n_threads': 1, 'block_size': 4 * 2 ** 20, 'compress': True}
+# maximal number of NIfTI files that are written at once, each holds a window of blocks that are compressed
+MAX_NIFTI_WRITERS = 2
+
+
+def get_nifti_options(nifti_options=None):
+    """
+    Completes the passed NIfTI options with the default options.
+
+    :param nifti_options: dictionary with the keys 'compress' (False for uncompressed .nii files), 'compression_level'
+                          (gzip level 0-9), 'n_threads' (number of threads for writing files and compressing blocks)
+                          and 'block_size' (size of the independently compressed blocks in bytes) (dict)
+    :return: complete NIfTI options (dict)
+    """
+    return {**DEFAULT_NIFTI_OPTIONS, **(nifti_options or {})}
+
+
+def get_nifti_file_ending(nifti_options=None):
+    """
+    Returns the file ending of the NIfTI files, '.nii.gz' for compressed and '.nii' for uncompressed files.
+
+    :param nifti_options: NIfTI options, see get_nifti_options (dict)
+    :return: file ending (string)
+    """
+    return '.nii.gz' if get_nifti_options(nifti_options)['compress'] else '.nii'
+
+
+def compress_gzip_member(block, compression_level):
+    """
+    Compresses a block of bytes into a complete gzip member with header and trailer.
+
+    :param block: bytes that are compressed (bytes or memoryview)
+    :param compression_level: gzip level 0-9 (int)
+    :return: gzip member (bytes)
+    """
+    # wbits of 31 writes the gzip header and trailer
+    compressor = zlib.compressobj(compression_level, zlib.DEFLATED, 31)
+    return compressor.compress(block) + compressor.flush()
+
+
+def iterate_nifti_blocks(nii_image, block_size):
+    """
+    Generator that serializes a single file NIfTI image into blocks of bytes, the header first and then the image data
+    in Fortran order, one slice of the last axis after the other. Only the current block and a single slice are held
+    in memory, never the serialized image.
+
+    :param nii_image: NIfTI image with unscaled data in the data type of its header (nibabel.Nifti1Image)
+    :param block_size: size of the blocks in bytes, only the last block is smaller (int)
+    :return: iterator of blocks (bytes)
+    """
+    # harmonize header with image data and affine
+    nii_image.update_header()
+    header = nii_image.header.copy()
+    # place the image data right after the header and its extensions and store it unscaled, like nibabel.save
+    header.set_data_offset(header.single_vox_offset + header.extensions.get_sizeondisk())
+    header.set_slope_inter(1, 0)
+    # write header into the first block
+    header_file = io.BytesIO()
+    header.write_to(header_file)
+    block = bytearray(header_file.getvalue())
+    # pad the header with zeros up to the offset of the image data
+    block.extend(bytes(max(0, int(header.get_data_offset()) - len(block))))
+    # get image data in the data type of the header
+    data = np.asanyarray(nii_image.dataobj)
+    dtype = header.get_data_dtype()
+    # iterate slices of the last axis, which follow each other in Fortran order
+    for index in range(data.shape[-1]):
+        # append the slice in Fortran order, slices of transposed C-contiguous arrays are not copied before
+        block.extend(np.asfortranarray(data[..., index].astype(dtype, copy=False)).tobytes(order='F'))
+        # yield all complete blocks
+        while len(block) >= block_size:
+            yield bytes(block[:block_size])
+            del block[:block_size]
+    # yield the last block
+    if block:
+        yield bytes(block)
+
+
+def write_nifti_file(nii_image, path_to_nifti_file, nifti_options=None, executor=None):
+    """
+    Writes a NIfTI image to an uncompressed .nii or a gzip compressed .nii.gz file. The image is serialized block by
+    block and each block is compressed independently into a gzip member, in parallel if an executor is passed. At most
+    2 * n_threads / MAX_NIFTI_WRITERS blocks are compressed at once, so the memory of a write is bounded by a few blocks
+    and does not grow with the image. A sequence of gzip members is a valid gzip file, so the file is read by nibabel,
+    ITK and gunzip like any other .nii.gz file.
+
+    :param nii_image: NIfTI image (nibabel.Nifti1Image)
+    :param path_to_nifti_file: path of the written file, its ending selects the compression (string)
+    :param nifti_options: NIfTI options, see get_nifti_options (dict)
+    :param executor: thread pool the blocks are compressed in, zlib releases the GIL while compressing
+                     (concurrent.futures.ThreadPoolExecutor)
+    :return: size of the written file in bytes (int)
+    """
+    # complete options
+    nifti_options = get_nifti_options(nifti_options)
+    # check if the file should be written uncompressed
+    if not path_to_nifti_file.endswith('.gz'):
+        nib.save(nii_image, path_to_nifti_file)
+        return os.path.getsize(path_to_nifti_file)
+
+    # get maximal number of blocks that are compressed at once by this write
+    max_pending_blocks = max(2, 2 * nifti_options['n_threads'] // MAX_NIFTI_WRITERS)
+    # initialize queue for the blocks that are compressed, in file order
+    pending_members = deque()
+    level = nifti_options['compression_level']
+    with open(path_to_nifti_file, 'wb') as f:
+        # iterate serialized blocks of the image
+        for block in iterate_nifti_blocks(nii_image, nifti_options['block_size']):
+            # compress block into a gzip member
+            if executor is None:
+                f.write(compress_gzip_member(block, level))
+                continue
+            pending_members.append(executor.submit(compress_gzip_member, block, level))
+            # write the oldest member once the window of blocks in flight is full
+            if len(pending_members) >= max_pending_blocks:
+                f.write(pending_members.popleft().result())
+        # write remaining members
+        while pending_members:
+            f.write(pending_members.popleft().result())
+    # return file size
+    return os.path.getsize(path_to_nifti_file)
+
+
+def write_nnUNet_training_nifti_files(path_output_directory, data_array, resolution, image_nr, channel_nr, case_id,
+                                      nifti_options=None, executor=None):
     # define nifti file name
-    path_to_nifti_file = os.path.join(path_output_directory, f'{case_id}_{image_nr:03d}_{channel_nr:04d}.nii.gz')
+    file_ending = get_nifti_file_ending(nifti_options)
+    path_to_nifti_file = os.path.join(path_output_directory, f'{case_id}_{image_nr:03d}_{channel_nr:04d}{file_ending}')
     # transpose data array to have XYZ order
     data_array = data_array.transpose((2, 1, 0))
     # Create a NIfTI image header with the appropriate dimensions and spacing information
     affine = np.array([[resolution[2], 0, 0, 0], [0, resolution[1], 0, 0], [0, 0, resolution[0], 0], [0, 0, 0, 1]])
     # create nifti image object
     nii_image = nib.Nifti1Image(data_array, affine=affine)
-    # save the nifti file
-    nib.save(nii_image, path_to_nifti_file)
+    # save the nifti file and measure it as a stage, it covers the gzip compression
+    with profile_stage('write_nifti', file=path_to_nifti_file) as stage:
+        stage['file_bytes'] = write_nifti_file(nii_image, path_to_nifti_file, nifti_options, executor)
+        stage['bytes_written'] = data_array.nbytes
 
 
-def write_nnUNet_label_nifti_files(path_output_directory, data_array, resolution, image_nr, case_id):
+def write_nnUNet_label_nifti_files(path_output_directory, data_array, resolution, image_nr, case_id,
+                                   nifti_options=None, executor=None):
     # define nifti file name
-    path_to_nifti_file = os.path.join(path_output_directory, f'{case_id}_{image_nr:03d}.nii.gz')
+    file_ending = get_nifti_file_ending(nifti_options)
+    path_to_nifti_file = os.path.join(path_output_directory, f'{case_id}_{image_nr:03d}{file_ending}')
     # transpose data array to have XYZ order and convert it to uint8
     data_array = data_array.transpose((2, 1, 0)).astype(np.uint8)
     # Create a NIfTI image header with the appropriate dimensions and spacing information
     affine = np.array([[resolution[2], 0, 0, 0], [0, resolution[1], 0, 0], [0, 0, resolution[0], 0], [0, 0, 0, 1]])
     # create nifti image object
     nii_image = nib.Nifti1Image(data_array, affine=affine)
-    # save the nifti file
-    nib.save(nii_image, path_to_nifti_file)
+    # save the nifti file and measure it as a stage, it covers the gzip compression
+    with profile_stage('write_nifti', file=path_to_nifti_file) as stage:
+        stage['file_bytes'] = write_nifti_file(nii_image, path_to_nifti_file, nifti_options, executor)
+        stage['bytes_written'] = data_array.nbytes
+
+
+def run_nifti_writes(writes, nifti_options=None):
+    """
+    Runs the passed NIfTI writes. With more than one thread up to MAX_NIFTI_WRITERS files are written concurrently
+    and their blocks are compressed in a shared thread pool, otherwise the files are written one after the other.
+
+    :param writes: list of writer functions and their positional arguments (list of tuples)
+    :param nifti_options: NIfTI options, see get_nifti_options (dict)
+    """
+    # complete options
+    nifti_options = get_nifti_options(nifti_options)
+    # check if the files should be written one after the other
+    if nifti_options['n_threads'] <= 1 or len(writes) == 0:
+        for writer, args in writes:
+            writer(*args, nifti_options)
+        return
+
+    # write files concurrently, the blocks are compressed in a separate pool so writers never wait on their own pool
+    with ThreadPoolExecutor(nifti_options['n_threads']) as compression_executor, \
+            ThreadPoolExecutor(min(len(writes), MAX_NIFTI_WRITERS)) as write_executor:
+        futures = [write_executor.submit(writer, *args, nifti_options, compression_executor) for writer, args in writes]
+        # wait for all files and raise errors of the writes
+        for future in futures:
+            future.result()
+
+
+def select_export_channels(channel_names, global_channel_ids, global_label_id):
+    """
+    Returns the names of the channels of an image that are exported into the nnUNet file structure, the label channel
+    first. An image is only exported if the label channel and all global channels are present. Only the channel names
+    are needed, so a file can be checked before its pixel data is read.
+
+    :param channel_names: list of the channel names of the image (list)
+    :param global_channel_ids: dictionary with the prefixed name and the id number of each global channel
+                               {'dapi': {'name': 'channel_dapi', 'id_nr': 0}, ...} (dict)
+    :param global_label_id: name of the label channel (string)
+    :return: names of the exported channels or None if the image is not exported (list)
+    """
+    # create list with channel names
+    global_channel_names = [n['name'] for n in global_channel_ids.values()]
+    # check if label channel is available
+    if not (global_label_id in channel_names and set(global_channel_names).issubset(channel_names)):
+        return None
+    # return label channel and the available global channels
+    return [global_label_id] + [n for n in global_channel_names if n in channel_names]
+
+
+def export_image_to_nnUNet(image_data_array, channel_names, resolution, path_to_images_tr, path_to_labels_tr,
+                           image_nr, dataset_abbreviation, global_channel_ids, global_label_id, nifti_options=None):
+    """
+    Writes the label channel and the global channels of a single ZCYX image into the nnUNet file structure. The image
+    is only exported if the label channel and all global channels are present.
+    :param image_data_array: 4D image data array of structure (Z,C,Y,X) (numpy.ndarray)
+    :param channel_names: list of the channel names of the image (list)
+    :param resolution: voxel size in the order (Z,Y,X) (list)
+    :param path_to_images_tr: path to the imagesTr directory of the dataset (string)
+    :param path_to_labels_tr: path to the labelsTr directory of the dataset (string)
+    :param image_nr: number of the image in the dataset (int)
+    :param dataset_abbreviation: short identifier as prefix to the single file names (string)
+    :param global_channel_ids: dictionary with the prefixed name and the id number of each global channel
+                               {'dapi': {'name': 'channel_dapi', 'id_nr': 0}, ...} (dict)
+    :param global_label_id: name of the label channel (string)
+    :param nifti_options: compression and threading of the NIfTI files, see get_nifti_options (dict)
+    :return: True if the image was exported (bool)
+    """
+    # check if label channel is available
+    if select_export_channels(channel_names, global_channel_ids, global_label_id) is None:
+        return False
+    # get channel number of label channel in current image data array
+    ch_nr_local = channel_names.index(global_label_id)
+    # read label data
+    label_data_array = image_data_array[:, ch_nr_local, :, :]
+    # convert labeled data array to boolen data array
+    label_data_array = label_data_array.astype(bool)
+    # add label to the files that are written
+    writes = [(write_nnUNet_label_nifti_files,
+               (path_to_labels_tr, label_data_array, resolution, image_nr, dataset_abbreviation))]
+
+    # iterate global channel ids
+    for v in global_channel_ids.values():
+        # check if channel is present in the current file
+        if v['name'] in channel_names:
+            # get channel number at current image
+            ch_nr_local = channel_names.index(v['name'])
+            # read channel data
+            channel_data_array = image_data_array[:, ch_nr_local, :, :]
+            # add channel to the files that are written
+            writes.append((write_nnUNet_training_nifti_files,
+                           (path_to_images_tr, channel_data_array, resolution, image_nr, v['id_nr'],
+                            dataset_abbreviation)))
+    # save label and channels in nnUNet consistent structure
+    run_nifti_writes(writes, nifti_options)
+    # return that the image was exported
+    return True
 
 
 def ome_tiff_to_nnUNet(path_to_ome_tiff_input_files,
@@ -58,7 +295,10 @@ def ome_tiff_to_nnUNet(path_to_ome_tiff_input_files,
                        dataset_id,
                        dataset_abbreviation,
                        global_channel_ids,
-                       global_label_id):
+                       global_label_id,
+                       nifti_options=None,
+                       target_spacing=None,
+                       label_kernel='majority'):
     # set up the folder structure for nnUNet
     path_to_nnUNet_dataset, path_to_images_tr, path_to_labels_tr = set_up_nnUNet_file_structure(path_to_nnUNet_dataset,
                                                                                                 dataset_id)
@@ -75,7 +315,7 @@ def ome_tiff_to_nnUNet(path_to_ome_tiff_input_files,
             global_label_id: 1,
         },
         "numTraining": int(len(ome_tiff_files)),
-        "file_ending": ".nii.gz"
+        "file_ending": get_nifti_file_ending(nifti_options)
     }
 
     # update global channels dictionary with a channel_id number and a prefixed channel name
@@ -83,45 +323,38 @@ def ome_tiff_to_nnUNet(path_to_ome_tiff_input_files,
         # add id number and prefixed name to global channels dictionary
         global_channel_ids[k] = {'name': f'channel_{k}',
                                  'id_nr': i}
-    # create list with channel names
-    global_channel_names = [n['name'] for n in global_channel_ids.values()]
-
     # iterate ome tiff files
     for i, f in enumerate(ome_tiff_files):
-        # read data and meta data from ome tiff file
-        image_data_array, metadata_dict = read_ome_tiff_image_and_metadata(f)
+        # read meta data from ome tiff file without reading pixel data
+        metadata_dict = read_ome_tiff_metadata(f)
         # read channel names from metadata
         channel_names = metadata_dict['channel_names']
+        # get names of the exported channels
+        export_channel_names = select_export_channels(channel_names, global_channel_ids, global_label_id)
+        # skip file if the label channel is not available
+        if export_channel_names is None:
+            continue
+        # read only the pages of the exported channels
+        image_data_array = read_ome_tiff_channels(f, [channel_names.index(n) for n in export_channel_names])
         # read voxel size from metadata
         voxel_size = eval(metadata_dict['voxel_size'])
         # convert voxel size from dict to list of order (Z,Y,X)
         resolution = [voxel_size['Z'], voxel_size['Y'], voxel_size['X']]
+        # downsample image to the target spacing, the label channel is the first exported channel
+        if target_spacing is not None:
+            # get factors that bring the voxel size to the target spacing
+            factors, resolution, is_matching = get_resampling_factors(resolution, target_spacing)
+            # print status message if the target spacing can not be met by whole voxels
+            if not is_matching:
+                print(f'Spacing {list(target_spacing)} is not reached by whole voxels, resampled to {resolution}!')
+            # resample image slab by slab, the affine of the NIfTI files follows the new resolution
+            with profile_stage('resample', file=f):
+                image_data_array = resample_image(image_data_array, factors, [0], label_kernel)
 
-
-        # check if label channel is available
-        if global_label_id in channel_names and set(global_channel_names).issubset(channel_names):
-            # get channel number of label channel in current image data array
-            ch_nr_local = channel_names.index(global_label_id)
-            # read label data
-            label_data_array = image_data_array[:, ch_nr_local, :, :]
-            # convert labeled data array to boolen data array
-            label_data_array = label_data_array.astype(bool)
-            # save channel in nnUNet consistent structure
-            write_nnUNet_label_nifti_files(path_to_labels_tr, label_data_array,
-                                           resolution, i, dataset_abbreviation)
-
-            # iterate global channel ids
-            for v in global_channel_ids.values():
-                # check if channel is present in the current file
-                if v['name'] in channel_names:
-                    # get channel number at current image
-                    ch_nr_local = channel_names.index(v['name'])
-                    # read channel data
-                    channel_data_array = image_data_array[:, ch_nr_local, :, :]
-                    # save channel in nnUNet consistent structure
-                    write_nnUNet_training_nifti_files(path_to_images_tr, channel_data_array,
-                                                      resolution, i, v['id_nr'], dataset_abbreviation)
-
+        # export label and channels if the label channel is available
+        if export_image_to_nnUNet(image_data_array, export_channel_names, resolution, path_to_images_tr,
+                                  path_to_labels_tr, i, dataset_abbreviation, global_channel_ids, global_label_id,
+                                  nifti_options):
             # print status message
             print(f'[{i + 1}/{len(ome_tiff_files)}] Converted "{f}" into nnUNet file structure!')
 
@@ -154,8 +387,27 @@ def main():
                         help='short identifier as prefix to the single file names')
     parser.add_argument('-l', '--label', required=True,
                         help='string that identifies label channel in source data')
+    # add arguments for the compression of the NIfTI files
+    parser.add_argument('--compression_level', type=int, default=DEFAULT_NIFTI_OPTIONS['compression_level'],
+                        choices=range(10), metavar='[0-9]',
+                        help='gzip level of the .nii.gz files (default: 1)')
+    parser.add_argument('-t', '--threads', type=int, default=DEFAULT_NIFTI_OPTIONS['n_threads'],
+                        help='Number of threads for writing the files of an image concurrently and compressing them '
+                             'block by block into multi-member gzip files (default: 1)')
+    parser.add_argument('--uncompressed', action='store_true',
+                        help='Write uncompressed .nii files, e.g. for fast local scratch disks')
+    # add arguments for resampling to the spacing of the nnUNet model
+    parser.add_argument('--target_spacing', type=float, nargs=3, default=None, metavar=('Z', 'Y', 'X'),
+                        help='Spacing of the exported images, they are downsampled by whole voxels '
+                             '(default: full resolution)')
+    parser.add_argument('--label_resampling', default='majority', choices=['majority', 'nearest'],
+                        help='Kernel the labels are downsampled with, intensities are averaged (default: majority)')
+    # add arguments for profiling the processing stages
+    add_instrumentation_arguments(parser)
     # parse the arguments
     args = parser.parse_args()
+    # enable the instrumentation if requested
+    configure_instrumentation_from_arguments(args)
 
     # define channels of interest
     ch_of_interest = {
@@ -172,10 +424,17 @@ def main():
                        args.dataset_id,
                        args.dataset_abbreviation,
                        ch_of_interest,
-                       args.label)
+                       args.label,
+                       {'compress': not args.uncompressed, 'compression_level': args.compression_level,
+                        'n_threads': args.threads},
+                       args.target_spacing,
+                       args.label_resampling)
 
     # print status message
     print(f'Finished nnUNet conversion of dataset: {args.dataset_id}!')
+    # print time, bytes and memory of the processing stages if requested
+    if args.profile:
+        print_stage_summary()
 
 
 if __name__ == "__main__":
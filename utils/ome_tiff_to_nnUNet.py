@@ -2,7 +2,12 @@ import argparse
 import os
 import tifffile as tif
 import json
-from ome_tiff_unify_channels import read_ome_tiff_image_and_metadata, channels_of_interest
+import sys
+# make the modules of the parent directory importable
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import profile_stage, add_instrumentation_arguments, configure_instrumentation_from_arguments, \
+    print_stage_summary
+from ome_tiff_unify_channels import read_ome_tiff_metadata, read_ome_tiff_channels, channels_of_interest
 
 
 def set_up_nnUNet_file_structure(path_to_nnUNet_dataset, dataset_id):
@@ -31,8 +36,10 @@ def write_nnUNet_training_tif_files(path_output_directory, data_array, resolutio
     path_to_tiff_file = os.path.join(path_output_directory, f'{case_id}_{image_nr:03d}_{channel_nr:04d}.tif')
     # define path to json file
     path_to_json_file = path_to_tiff_file[:-4] + '.json'
-    # save data array in tiff file
-    tif.imwrite(path_to_tiff_file, data_array)
+    # save data array in tiff file and measure it as a stage
+    with profile_stage('write_tif', file=path_to_tiff_file) as stage:
+        tif.imwrite(path_to_tiff_file, data_array)
+        stage['bytes_written'] = data_array.nbytes
     # create dict for spacing
     spacing = {'spacing': (resolution[0], resolution[1], resolution[2])}
     # create json file with channel resolution values
@@ -45,8 +52,10 @@ def write_nnUNet_label_tif_files(path_output_directory, data_array, resolution,
     path_to_tiff_file = os.path.join(path_output_directory, f'{case_id}_{image_nr:03d}.tif')
     # define path to json file
     path_to_json_file = path_to_tiff_file[:-4] + '.json'
-    # save data array in tiff file
-    tif.imwrite(path_to_tiff_file, data_array)
+    # save data array in tiff file and measure it as a stage
+    with profile_stage('write_tif', file=path_to_tiff_file) as stage:
+        tif.imwrite(path_to_tiff_file, data_array)
+        stage['bytes_written'] = data_array.nbytes
     # create dict for spacing
     spacing = {'spacing': (resolution[0], resolution[1], resolution[2])}
     # create json file with channel resolution values
@@ -54,6 +63,71 @@ def write_nnUNet_label_tif_files(path_output_directory, data_array, resolution,
         json.dump(spacing, f)
 
 
+def select_export_channels(channel_names, global_channel_ids, global_label_id):
+    """
+    Returns the names of the channels of an image that are exported into the nnUNet file structure, the label channel
+    first. An image is only exported if the label channel is present. Only the channel names are needed, so a file
+    can be checked before its pixel data is read.
+
+    :param channel_names: list of the channel names of the image (list)
+    :param global_channel_ids: dictionary with the prefixed name and the id number of each global channel
+                               {'dapi': {'name': 'channel_dapi', 'id_nr': 0}, ...} (dict)
+    :param global_label_id: name of the label channel (string)
+    :return: names of the exported channels or None if the image is not exported (list)
+    """
+    # create list with channel names
+    global_channel_names = [n['name'] for n in global_channel_ids.values()]
+    # check if label channel is available
+    if not (global_label_id in channel_names):
+        return None
+    # return label channel and the available global channels
+    return [global_label_id] + [n for n in global_channel_names if n in channel_names]
+
+
+def export_image_to_nnUNet(image_data_array, channel_names, resolution, path_to_images_tr, path_to_labels_tr,
+                           image_nr, dataset_abbreviation, global_channel_ids, global_label_id):
+    """
+    Writes the label channel and the global channels of a single ZCYX image into the nnUNet file structure. The image
+    is only exported if the label channel is present.
+    :param image_data_array: 4D image data array of structure (Z,C,Y,X) (numpy.ndarray)
+    :param channel_names: list of the channel names of the image (list)
+    :param resolution: voxel size in the order (Z,Y,X) (list)
+    :param path_to_images_tr: path to the imagesTr directory of the dataset (string)
+    :param path_to_labels_tr: path to the labelsTr directory of the dataset (string)
+    :param image_nr: number of the image in the dataset (int)
+    :param dataset_abbreviation: short identifier as prefix to the single file names (string)
+    :param global_channel_ids: dictionary with the prefixed name and the id number of each global channel
+                               {'dapi': {'name': 'channel_dapi', 'id_nr': 0}, ...} (dict)
+    :param global_label_id: name of the label channel (string)
+    :return: True if the image was exported (bool)
+    """
+    # check if label channel is available
+    if select_export_channels(channel_names, global_channel_ids, global_label_id) is None:
+        return False
+    # get channel number of label channel in current image data array
+    ch_nr_local = channel_names.index(global_label_id)
+    # read label data
+    label_data_array = image_data_array[:, ch_nr_local, :, :]
+    # convert labeled data array to boolen data array
+    label_data_array = label_data_array.astype(bool)
+    # save channel in nnUNet consistent structure
+    write_nnUNet_label_tif_files(path_to_labels_tr, label_data_array, resolution, image_nr, dataset_abbreviation)
+
+    # iterate global channel ids
+    for v in global_channel_ids.values():
+        # check if channel is present in the current file
+        if v['name'] in channel_names:
+            # get channel number at current image
+            ch_nr_local = channel_names.index(v['name'])
+            # read channel data
+            channel_data_array = image_data_array[:, ch_nr_local, :, :]
+            # save channel in nnUNet consistent structure
+            write_nnUNet_training_tif_files(path_to_images_tr, channel_data_array, resolution, image_nr, v['id_nr'],
+                                           dataset_abbreviation)
+    # return that the image was exported
+    return True
+
+
 def ome_tiff_to_nnUNet(path_to_ome_tiff_input_files,
                        path_to_nnUNet_dataset,
                        dataset_id,
@@ -87,39 +161,25 @@ def ome_tiff_to_nnUNet(path_to_ome_tiff_input_files,
 
     # iterate ome tiff files
     for i, f in enumerate(ome_tiff_files):
-        # read data and meta data from ome tiff file
-        image_data_array, metadata_dict = read_ome_tiff_image_and_metadata(f)
+        # read meta data from ome tiff file without reading pixel data
+        metadata_dict = read_ome_tiff_metadata(f)
         # read channel names from metadata
         channel_names = metadata_dict['channel_names']
+        # get names of the exported channels
+        export_channel_names = select_export_channels(channel_names, global_channel_ids, global_label_id)
+        # skip file if the label channel is not available
+        if export_channel_names is None:
+            continue
+        # read only the pages of the exported channels
+        image_data_array = read_ome_tiff_channels(f, [channel_names.index(n) for n in export_channel_names])
         # read voxel size from metadata
         voxel_size = eval(metadata_dict['voxel_size'])
         # convert voxel size from dict to list of order (Z,Y,X)
         resolution = [voxel_size['Z'], voxel_size['Y'], voxel_size['X']]
 
-        # check if label channel is available
-        if global_label_id in channel_names:
-            # get channel number of label channel in current image data array
-            ch_nr_local = channel_names.index(global_label_id)
-            # read label data
-            label_data_array = image_data_array[:, ch_nr_local, :, :]
-            # convert labeled data array to boolen data array
-            label_data_array = label_data_array.astype(bool)
-            # save channel in nnUNet consistent structure
-            write_nnUNet_label_tif_files(path_to_labels_tr, label_data_array,
-                                         resolution, i, dataset_abbreviation)
-
-            # iterate global channel ids
-            for v in global_channel_ids.values():
-                # check if channel is present in the current file
-                if v['name'] in channel_names:
-                    # get channel number at current image
-                    ch_nr_local = channel_names.index(v['name'])
-                    # read channel data
-                    channel_data_array = image_data_array[:, ch_nr_local, :, :]
-                    # save channel in nnUNet consistent structure
-                    write_nnUNet_training_tif_files(path_to_images_tr, channel_data_array,
-                                                    resolution, i, v['id_nr'], dataset_abbreviation)
-
+        # export label and channels if the label channel is available
+        if export_image_to_nnUNet(image_data_array, export_channel_names, resolution, path_to_images_tr,
+                                  path_to_labels_tr, i, dataset_abbreviation, global_channel_ids, global_label_id):
             # print status message
             print(f'[{i + 1}/{len(ome_tiff_files)}] Converted "{f}" into nnUNet file structure!')
 
@@ -152,8 +212,12 @@ def main():
                         help='short identifier as prefix to the single file names')
     parser.add_argument('-l', '--label', required=True,
                         help='string that identifies label channel in source data')
+    # add arguments for profiling the processing stages
+    add_instrumentation_arguments(parser)
     # parse the arguments
     args = parser.parse_args()
+    # enable the instrumentation if requested
+    configure_instrumentation_from_arguments(args)
 
     # call function for converting data from OME TIFF into nnUNet specific file structure
     ome_tiff_to_nnUNet(args.input,
@@ -165,6 +229,9 @@ def main():
 
     # print status message
     print(f'Finished nnUNet conversion of dataset: {args.dataset_id}!')
+    # print time, bytes and memory of the processing stages if requested
+    if args.profile:
+        print_stage_summary()
 
 
 if __name__ == "__main__":
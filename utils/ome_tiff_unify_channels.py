@@ -33,32 +33,31 @@ labels_of_interest = {
 }
 
 import tifffile as tif
+import numpy as np
 import argparse
 import os
+import sys
+# make the modules of the parent directory importable
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import profile_stage, add_instrumentation_arguments, configure_instrumentation_from_arguments, \
+    print_stage_summary
 
 
-def unify_channels(image_data_array, metadata_dict, channels_dict=channels_of_interest,
-                   labels_dict=labels_of_interest):
+def select_unified_channels(metadata_channel_names, channels_dict=channels_of_interest,
+                            labels_dict=labels_of_interest):
     """
-    This function unifies the channels of the passed image data array and returns the reduced image data array together
-    with the updated metadata dictionary. For reducing the channels it looks the passed dictionaries of channels and
-    labels. The keys of these two dictionaries give the name of the desired channel or label while the corresponding
-    value lists names that might be used in the original file for naming this type of channel. In short, this function
-    unifies the available data channels as well as the names of the channels in the metadata dict
-    :param image_data_array: 4D image data array of structure (Z,C,Y,X)
-    :param metadata_dict: dictionary that holds the metadata (in particular the channel names) (dict)
+    Resolves the passed dictionaries of channels and labels against a list of channel names and returns the indices
+    of the channels that are kept together with their unified names. The keys of the two dictionaries give the name
+    of the desired channel or label while the corresponding value lists names that might be used in the original file
+    for naming this type of channel, the first matching name is picked. No pixel data is needed for this, so the
+    selection can be made before any image data is read.
+    :param metadata_channel_names: list of channel names of the image (list)
     :param channels_dict: dictionary that holds the desired channels of the returned image data.
                           {'unified_channel_name': [list of possible channel names used at the passed file(s)], ... }
     :param labels_dict: dictionary that holds the desired labels of the returned image data.
                         {'unified_label_name': [list of possible channel names used at the passed file(s)], ... }
-    :return: image_data_dict (Z,C,Y,X) (numpy.ndarray), metadata_dict
+    :return: channel_indices (list of int), channel_names (list of unified channel names)
     """
-    # read list of channel_names from metadata
-    metadata_channel_names = metadata_dict['channel_names']
-    # convert channel names to list if it is not already of type list
-    if type(metadata_channel_names) is not list:
-        metadata_channel_names = eval(metadata_channel_names)
-
     # initialize empty dict for name and index of available channels
     available_channels_dict = {}
     # iterate passed channels of interest
@@ -74,8 +73,8 @@ def unify_channels(image_data_array, metadata_dict, channels_dict=channels_of_in
 
     # check if arteries label is desired even if collagen channel is not available at the passed image
     if 'arteries' in labels_dict and set(channels_dict['collagen']).isdisjoint(metadata_channel_names):
-        # remove arteries label from labels dict
-        del labels_dict['arteries']
+        # remove arteries label from a copy of the labels dict
+        labels_dict = {k: v for k, v in labels_dict.items() if k != 'arteries'}
     # initialize empty dict for name and index of available labels
     available_labels_dict = {}
     # iterate passed labels of interest
@@ -99,6 +98,35 @@ def unify_channels(image_data_array, metadata_dict, channels_dict=channels_of_in
     # read channel names from available channels dict
     channel_names.extend(['label_' + s for s in available_labels_dict.keys()])
 
+    # return indices and unified names of the selected channels
+    return channel_indices, channel_names
+
+
+def unify_channels(image_data_array, metadata_dict, channels_dict=channels_of_interest,
+                   labels_dict=labels_of_interest):
+    """
+    This function unifies the channels of the passed image data array and returns the reduced image data array together
+    with the updated metadata dictionary. For reducing the channels it looks the passed dictionaries of channels and
+    labels. The keys of these two dictionaries give the name of the desired channel or label while the corresponding
+    value lists names that might be used in the original file for naming this type of channel. In short, this function
+    unifies the available data channels as well as the names of the channels in the metadata dict
+    :param image_data_array: 4D image data array of structure (Z,C,Y,X)
+    :param metadata_dict: dictionary that holds the metadata (in particular the channel names) (dict)
+    :param channels_dict: dictionary that holds the desired channels of the returned image data.
+                          {'unified_channel_name': [list of possible channel names used at the passed file(s)], ... }
+    :param labels_dict: dictionary that holds the desired labels of the returned image data.
+                        {'unified_label_name': [list of possible channel names used at the passed file(s)], ... }
+    :return: image_data_dict (Z,C,Y,X) (numpy.ndarray), metadata_dict
+    """
+    # read list of channel_names from metadata
+    metadata_channel_names = metadata_dict['channel_names']
+    # convert channel names to list if it is not already of type list
+    if type(metadata_channel_names) is not list:
+        metadata_channel_names = eval(metadata_channel_names)
+
+    # get indices and unified names of the channels and labels of interest
+    channel_indices, channel_names = select_unified_channels(metadata_channel_names, channels_dict, labels_dict)
+
     # reduce image channels by masking with channel indices
     image_data_array = image_data_array[:, channel_indices, :, :]
 
@@ -110,25 +138,231 @@ def unify_channels(image_data_array, metadata_dict, channels_dict=channels_of_in
     return image_data_array, metadata_dict
 
 
-def read_ome_tiff_image_and_metadata(path_to_ome_tiff_file):
+def read_ome_tiff_metadata(path_to_ome_tiff_file):
     """
-    Opens an OME TIFF file and returns a numpy array of the image data together with a metadata containing dictionary
+    Reads the ImageJ metadata of an OME TIFF file without reading any pixel data, so the channels of a file can be
+    checked before its image data is decoded.
     :param path_to_ome_tiff_file: path to an OME TIFF file (string)
-    :return: image data (numpy.ndarray), metadata (dict)
+    :return: metadata (dict)
     """
     with tif.TiffFile(path_to_ome_tiff_file) as f:
-        # read image data array
-        image_data_array = f.asarray()
         # read metadata
         metadata = f.imagej_metadata
-        # if channel_names are present in the metadata convert them to a list
-        if 'channel_names' in metadata:
-            metadata['channel_names'] = eval(metadata['channel_names'])
+    # if channel_names are present in the metadata convert them to a list
+    if 'channel_names' in metadata:
+        metadata['channel_names'] = eval(metadata['channel_names'])
+    # return the metadata
+    return metadata
+
+
+def read_ome_tiff_channels(path_to_ome_tiff_file, channel_indices=None):
+    """
+    Reads the image data of the selected channels of an OME TIFF file. Uncompressed files are memory mapped and only
+    the pages of the selected channels are copied, for compressed files only the pages of the selected channels are
+    decoded. The pages of an ImageJ hyperstack are stored in TZCYX order, so the page of plane p and channel c is found
+    at index p * channels + c.
+    :param path_to_ome_tiff_file: path to an OME TIFF file (string)
+    :param channel_indices: indices of the channels that are read in the returned order, if None all channels are read
+                            (list of int)
+    :return: image data of structure (Z,C,Y,X) with the selected channels (numpy.ndarray)
+    """
+    with tif.TiffFile(path_to_ome_tiff_file) as f, profile_stage('read_ome_tiff', file=path_to_ome_tiff_file) as stage:
+        # get image series of the hyperstack
+        series = f.series[0]
+        # check if all channels should be read or if the image has no channel axis
+        if channel_indices is None or 'C' not in series.axes:
+            # read image data array
+            image_data_array = series.asarray()
+        else:
+            # get position of the channel axis and the shape of the returned array
+            channel_axis = series.axes.index('C')
+            shape = list(series.shape)
+            shape[channel_axis] = len(channel_indices)
+            # check if the data is uncompressed and stored contiguously
+            if series.dataoffset is not None:
+                # memory map the data in the byte order of the file and copy the selected channels
+                image = np.memmap(path_to_ome_tiff_file, dtype=series.dtype.newbyteorder(f.byteorder), mode='r',
+                                  offset=series.dataoffset, shape=series.shape)
+                image_data_array = np.take(image, channel_indices, axis=channel_axis).astype(series.dtype, copy=False)
+            # check if no channel is selected
+            elif not channel_indices:
+                image_data_array = np.empty(shape, dtype=series.dtype)
+            else:
+                # get number of planes of each channel and the page indices of the selected channels
+                n_planes = int(np.prod(series.shape[:channel_axis]))
+                page_indices = [p * series.shape[channel_axis] + c for p in range(n_planes) for c in channel_indices]
+                # decode only the pages of the selected channels
+                image_data_array = f.asarray(key=page_indices).reshape(shape)
+        # count the uncompressed image bytes
+        stage['bytes_read'] = image_data_array.nbytes
+
+    # return the image data
+    return image_data_array
+
+
+def read_ome_tiff_image_and_metadata(path_to_ome_tiff_file, channel_indices=None):
+    """
+    Opens an OME TIFF file and returns a numpy array of the image data together with a metadata containing dictionary
+    :param path_to_ome_tiff_file: path to an OME TIFF file (string)
+    :param channel_indices: indices of the channels that are read, if None all channels are read (list of int)
+    :return: image data (numpy.ndarray), metadata (dict)
+    """
+    # read metadata
+    metadata = read_ome_tiff_metadata(path_to_ome_tiff_file)
+    # read image data array of the selected channels
+    image_data_array = read_ome_tiff_channels(path_to_ome_tiff_file, channel_indices)
 
     # return the metadata
     return image_data_array, metadata
 
 
+def read_unified_ome_tiff_image_and_metadata(path_to_ome_tiff_file, channels_dict=channels_of_interest,
+                                             labels_dict=labels_of_interest):
+    """
+    Reads an OME TIFF file with unified channels, equivalent to unify_channels applied to the output of
+    read_ome_tiff_image_and_metadata. The channels are selected on the metadata first, so only the pages of the
+    channels of interest are read.
+    :param path_to_ome_tiff_file: path to an OME TIFF file (string)
+    :param channels_dict: dictionary that holds the desired channels of the returned image data, see unify_channels
+    :param labels_dict: dictionary that holds the desired labels of the returned image data, see unify_channels
+    :return: image data (Z,C,Y,X) (numpy.ndarray), metadata (dict)
+    """
+    # read metadata
+    metadata_dict = read_ome_tiff_metadata(path_to_ome_tiff_file)
+    # get indices and unified names of the channels and labels of interest
+    channel_indices, channel_names = select_unified_channels(metadata_dict['channel_names'], channels_dict,
+                                                             labels_dict)
+    # read image data of the selected channels
+    image_data_array = read_ome_tiff_channels(path_to_ome_tiff_file, channel_indices)
+
+    # update metadata dictionary channel names and number of channels
+    metadata_dict['channel_names'] = channel_names
+    metadata_dict['channels'] = len(channel_names)
+
+    # return image data array and metadata dict
+    return image_data_array, metadata_dict
+
+
+def get_channel_page_indices(series, channel_indices):
+    """
+    Returns the indices of the TIFF pages that hold the selected channels of an ImageJ hyperstack. The pages are stored
+    in TZCYX order, so the page of plane p and channel c is found at index p * channels + c.
+    :param series: image series of the hyperstack (tifffile.TiffPageSeries)
+    :param channel_indices: indices of the selected channels (list of int)
+    :return: page indices in the order of the output file (list of int)
+    """
+    # get position of the channel axis and the number of planes of each channel
+    channel_axis = series.axes.index('C')
+    n_planes = int(np.prod(series.shape[:channel_axis]))
+    # return page indices of the selected channels
+    return [p * series.shape[channel_axis] + c for p in range(n_planes) for c in channel_indices]
+
+
+def can_copy_channel_pages(f, series, channel_indices):
+    """
+    Checks if the selected channels of an OME TIFF file can be written to a new file by copying their pages byte for
+    byte. This requires a grayscale ImageJ hyperstack with a channel axis and one TIFF page per plane without shared
+    JPEG tables. Like the ImageJ series of tifffile, all pages are expected to be encoded like the first one.
+    :param f: opened OME TIFF file (tifffile.TiffFile)
+    :param series: image series of the hyperstack (tifffile.TiffPageSeries)
+    :param channel_indices: indices of the selected channels (list of int)
+    :return: True if the pages can be copied (bool)
+    """
+    # check if the image has a channel axis and if channels are selected
+    if 'C' not in series.axes or not series.axes.endswith('YX') or not channel_indices:
+        return False
+    # check if every plane is stored in its own page, large ImageJ files may only have a single page
+    if len(f.pages) != int(np.prod(series.shape[:-2])):
+        return False
+    # check if the first page is a grayscale page without JPEG tables
+    first_page = f.pages.first
+    return first_page.photometric == tif.PHOTOMETRIC.MINISBLACK and first_page.samplesperpixel == 1 and \
+        first_page.jpegtables is None
+
+
+def iterate_encoded_segments(f, page_indices):
+    """
+    Yields the encoded strips or tiles of the passed pages of an opened TIFF file as bytes, without decoding them. The
+    pages are parsed as light-weight frames that only hold the positions of their strips or tiles.
+    :param f: opened TIFF file (tifffile.TiffFile)
+    :param page_indices: indices of the pages (list of int)
+    :return: generator of encoded strips or tiles (bytes)
+    """
+    # parse only the strip or tile positions of the pages
+    f.pages.useframes = True
+    # iterate pages
+    for page_index in page_indices:
+        page = f.pages[page_index]
+        # iterate strips or tiles of the page
+        for offset, bytecount in zip(page.dataoffsets, page.databytecounts):
+            # read the encoded segment
+            f.filehandle.seek(offset)
+            yield f.filehandle.read(bytecount)
+
+
+def write_unified_ome_tiff_file(path_to_ome_tiff_file, path_to_unified_ome_tiff_file,
+                                channels_dict=channels_of_interest, labels_dict=labels_of_interest):
+    """
+    Writes an OME TIFF file with the unified channels of the passed file. Selecting channels only filters and reorders
+    the TIFF pages, so the strips or tiles of the selected pages are copied byte for byte together with rewritten
+    ImageJ metadata. The pixel data is only decoded and encoded again if the pages cannot be copied, see
+    can_copy_channel_pages.
+    :param path_to_ome_tiff_file: path to an OME TIFF file (string)
+    :param path_to_unified_ome_tiff_file: path of the unified OME TIFF file that is written (string)
+    :param channels_dict: dictionary that holds the desired channels of the returned image data, see unify_channels
+    :param labels_dict: dictionary that holds the desired labels of the returned image data, see unify_channels
+    :return: number of uncompressed image bytes of the unified file (int)
+    """
+    # read metadata
+    metadata_dict = read_ome_tiff_metadata(path_to_ome_tiff_file)
+    # get indices and unified names of the channels and labels of interest
+    channel_indices, channel_names = select_unified_channels(metadata_dict['channel_names'], channels_dict,
+                                                             labels_dict)
+    # update metadata dictionary channel names and number of channels
+    metadata_dict['channel_names'] = channel_names
+    metadata_dict['channels'] = len(channel_names)
+
+    with tif.TiffFile(path_to_ome_tiff_file) as f:
+        # get image series of the hyperstack
+        series = f.series[0]
+        # check if the pages of the selected channels can be copied
+        if can_copy_channel_pages(f, series, channel_indices):
+            # get shape of the unified image and the encoding of the pages
+            shape = list(series.shape)
+            shape[series.axes.index('C')] = len(channel_indices)
+            page = f.pages.first
+            # copy the encoded strips or tiles of the selected pages into the new file
+            with profile_stage('copy_ome_tiff_pages', file=path_to_unified_ome_tiff_file) as stage:
+                tif.imwrite(path_to_unified_ome_tiff_file,
+                            iterate_encoded_segments(f, get_channel_page_indices(series, channel_indices)),
+                            shape=tuple(shape),
+                            dtype=series.dtype,
+                            byteorder=f.byteorder,
+                            imagej=True,
+                            metadata=metadata_dict,
+                            photometric='minisblack',
+                            compression=page.compression,
+                            predictor=page.predictor,
+                            tile=(page.tilelength, page.tilewidth) if page.is_tiled else None,
+                            rowsperstrip=None if page.is_tiled else page.rowsperstrip)
+                stage['bytes_written'] = os.path.getsize(path_to_unified_ome_tiff_file)
+            # return number of image bytes
+            return int(np.prod(shape)) * series.dtype.itemsize
+
+    # read and decode the image data of the selected channels
+    image_data_array = read_ome_tiff_channels(path_to_ome_tiff_file, channel_indices)
+    # save the image data array as OME TIFF file
+    with profile_stage('write_ome_tiff', file=path_to_unified_ome_tiff_file) as stage:
+        tif.imwrite(path_to_unified_ome_tiff_file,
+                    image_data_array,
+                    shape=image_data_array.shape,
+                    imagej=True,
+                    metadata=metadata_dict)
+        stage['bytes_written'] = image_data_array.nbytes
+    # return number of image bytes
+    return image_data_array.nbytes
+
+
 def main():
     """
     Main function for unifying the data channels and names of a given OME TIFF file or for all OME TIFF files in a
@@ -143,9 +377,13 @@ def main():
                         help='Path to input OME TIFF file or directory')
     parser.add_argument('-o', '--output', required=True,
                         help='Directory for storing the unified OME TIFF image file')
+    # add arguments for profiling the processing stages
+    add_instrumentation_arguments(parser)
 
     # Parse the arguments
     args = parser.parse_args()
+    # enable the instrumentation if requested
+    configure_instrumentation_from_arguments(args)
 
     # check if output directory exists, if not create it
     if not os.path.exists(args.output):
@@ -164,25 +402,21 @@ def main():
 
     # iterate ome tiff files
     for i, f in enumerate(ome_tiff_files, start=1):
-        # read image data array and metadata from the passed file
-        image_data_array, metadata_dict = read_ome_tiff_image_and_metadata(f)
-        # call function for unifying image data
-        image_data_array, metadata_dict = unify_channels(image_data_array, metadata_dict,
-                                                         channels_of_interest, labels_of_interest)
         # define output file name
         path_to_unified_ome_tiff_file = os.path.join(args.output,
                                                      f'{os.path.basename(f)[:-8]}_unified.ome.tif')
-
-        # save the image data array as OME TIFF file
-        tif.imwrite(path_to_unified_ome_tiff_file,
-                    image_data_array,
-                    shape=image_data_array.shape,
-                    imagej=True,
-                    metadata=metadata_dict)
+        # write the channels of interest with unified names into the new file
+        with profile_stage('unify_channels', file=f) as stage:
+            stage['bytes_written'] = write_unified_ome_tiff_file(f, path_to_unified_ome_tiff_file,
+                                                                 channels_of_interest, labels_of_interest)
 
         # print status message
         print(f'[{i}/{len(ome_tiff_files)}] Saved unified image data at {path_to_unified_ome_tiff_file}!')
 
+    # print time, bytes and memory of the processing stages if requested
+    if args.profile:
+        print_stage_summary()
+
 
 if __name__ == "__main__":
     main()